@@ -36,12 +36,14 @@ from urllib.parse import urlparse
 
 
 class VOSpaceFS(Operations):
-    def __init__(self, host, port, username, password, mountpoint, ssl):
+    def __init__(self, host, port, username, password, mountpoint, ssl, wait=0):
         self.host = host
         self.port = port
         self.conn = {}
         self.mountpoint = mountpoint
         self.ssl = True if ssl == 1 else False
+        # seconds the storage waits for a busy node before refusing a transfer
+        self.wait = wait
         self.session = requests.session()
         self.uid = os.getuid()
         self.gid = os.getgid()
@@ -190,7 +192,8 @@ class VOSpaceFS(Operations):
 
             poll_until = ('COMPLETED', 'ERROR')
             while True:
-                with self.session.get(url) as r:
+                # blocks until the phase changes, for as long as the server allows
+                with self.session.get(url, params={'WAIT': -1}) as r:
                     r.raise_for_status()
                     result = r.text
                 if result in poll_until:
@@ -247,7 +250,7 @@ class VOSpaceFS(Operations):
                 conn = client.HTTPConnection(pr.netloc)
             if isinstance(transfer, PullFromSpace):
                 method = 'GET'
-            conn.putrequest(method, pr.path)
+            conn.putrequest(method, f'{pr.path}?wait={self.wait}' if self.wait else pr.path)
             conn.putheader('Cookie', self.cookie_str)
             if isinstance(transfer, PushToSpace):
                 conn.putheader('Content-Type', 'application/octet-stream')
@@ -310,9 +313,11 @@ def main():
     parser.add_argument("--password", type=str)
     parser.add_argument("--mountpoint", type=str)
     parser.add_argument("--usessl", type=int, default=0)
+    parser.add_argument("--wait", type=float, default=10.0)
     args = parser.parse_args()
 
-    space = VOSpaceFS(args.host, args.port, args.username, args.password, args.mountpoint, args.usessl)
+    space = VOSpaceFS(args.host, args.port, args.username, args.password, args.mountpoint, args.usessl,
+                      args.wait)
     FUSE(space, args.mountpoint, nothreads=True, foreground=True, allow_other=True)
 
 if __name__ == '__main__':
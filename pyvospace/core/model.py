@@ -26,6 +26,7 @@ import lxml.etree as ET
 
 from urllib.parse import urlparse
 from collections import namedtuple, OrderedDict
+from xml.sax.saxutils import escape
 
 from .exception import *
 
@@ -53,6 +54,9 @@ NodeTextLookup = {0: 'vos:Node',
 
 NodeType = Node_Type(0, 1, 2, 3, 4, 5)
 
+# Characters escaped by lxml in attribute values in addition to &, < and >.
+XML_ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
 
 def validate_property_uri(uri):
     if not uri:
@@ -542,7 +546,6 @@ class Node(object):
         self.owner = owner
         self.group_read = group_read
         self.group_write = group_write
-        self.path_modified = 0
         self.size = 0
         self.storage = None
 
@@ -900,6 +903,10 @@ class DataNode(Node):
     def tostring(self):
         root = super().toxml()
         root.set("busy", str(self.busy).lower())
+        self.views_toxml(root)
+        return ET.tostring(root).decode("utf-8")
+
+    def views_toxml(self, root):
         if self.accepts:
             accepts_elem = ET.SubElement(root, '{http://www.ivoa.net/xml/VOSpace/v2.1}accepts')
             for view in self.accepts:
@@ -910,7 +917,6 @@ class DataNode(Node):
             for view in self.provides:
                 view_element = ET.SubElement(accepts_elem, '{http://www.ivoa.net/xml/VOSpace/v2.1}view')
                 view_element.set('uri', view.uri)
-        return ET.tostring(root).decode("utf-8")
 
 
 class ContainerNode(DataNode):
@@ -1028,6 +1034,7 @@ class ContainerNode(DataNode):
 
     def tostring(self):
         root = super().toxml()
+        self.views_toxml(root)
         nodes_element = ET.SubElement(root, "{http://www.ivoa.net/xml/VOSpace/v2.1}nodes")
         for node in self.nodes:
             node_element = ET.SubElement(nodes_element, '{http://www.ivoa.net/xml/VOSpace/v2.1}node')
@@ -1035,6 +1042,31 @@ class ContainerNode(DataNode):
             node_element.set("{http://www.w3.org/2001/XMLSchema-instance}type", node.node_type_text())
         return ET.tostring(root).decode("utf-8")
 
+    def tostring_envelope(self):
+        """
+        Serialise the node without its children, split where the children belong.
+        Used to write a large listing incrementally: head, then tostring_child()
+        for each child, then tail.
+
+        :return: tuple(head, tail) of utf-8 encoded bytes.
+        """
+        root = super().toxml()
+        self.views_toxml(root)
+        ET.SubElement(root, "{http://www.ivoa.net/xml/VOSpace/v2.1}nodes")
+        head, tail = ET.tostring(root).rsplit(b'<vos:nodes/>', 1)
+        return head + b'<vos:nodes>', b'</vos:nodes>' + tail
+
+    @classmethod
+    def tostring_child(cls, node):
+        """
+        Serialise a child entry of a container listing.
+
+        :param node: :func:`Node <pyvospace.core.model.Node>`
+        :return: utf-8 encoded bytes.
+        """
+        uri = escape(node.to_uri(), XML_ATTR_ENTITIES)
+        return f'<vos:node uri="{uri}" xsi:type="{node.node_type_text()}"/>'.encode('utf-8')
+
 
 class UnstructuredDataNode(DataNode):
     """
@@ -1524,7 +1556,7 @@ class UWSJob(object):
         self.error = error
         self.transfer = None
         self.owner = None
-        self.node_path_modified = None
+        self.node_id = None
 
     @property
     def results(self):
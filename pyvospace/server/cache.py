@@ -0,0 +1,195 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+import json
+import asyncpg
+
+from collections import OrderedDict
+
+
+# Channel the nodes and storage tables notify on when a cached row may have changed.
+NODE_CACHE_CHANNEL = 'nodes'
+
+
+class NodeCache(object):
+    """
+    Size bounded LRU of the node rows of a space, keyed by ltree path.
+
+    Entries are dropped when a row changes: locally as soon as this server
+    writes it and on every server through the notifications sent by the
+    triggers on nodes and storage. While the listener is down nothing is served.
+
+    :param space_id: space of the cached rows.
+    :param maxsize: maximum number of rows kept.
+    """
+    def __init__(self, space_id, maxsize):
+        self.space_id = space_id
+        self.maxsize = maxsize
+        self.listener = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # bumped on every invalidation, a row read before it is not cached
+        self.generation = 0
+        self._rows = OrderedDict()
+
+    async def setup(self, dsn):
+        self.listener = await asyncpg.connect(dsn=dsn)
+        self.listener.add_termination_listener(self._terminated)
+        await self.listener.add_listener(NODE_CACHE_CHANNEL, self._notify_callback)
+
+    async def close(self):
+        if self.listener:
+            listener, self.listener = self.listener, None
+            await listener.close()
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.listener is not None and not self.listener.is_closed()
+
+    def stats(self):
+        return {'size': len(self._rows), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def get(self, path_tree):
+        if not self.enabled:
+            return None
+        row = self._rows.get(path_tree)
+        if row is None:
+            self.misses += 1
+            return None
+        self._rows.move_to_end(path_tree)
+        self.hits += 1
+        return row
+
+    def put(self, path_tree, row, generation):
+        if not self.enabled or generation != self.generation:
+            return
+        self._rows[path_tree] = row
+        self._rows.move_to_end(path_tree)
+        while len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, path_tree):
+        """
+        Drop a path, its ancestors, whose totals change with it, and its descendants.
+        """
+        self.generation += 1
+        self.invalidations += 1
+        labels = path_tree.split('.')
+        for i in range(1, len(labels) + 1):
+            self._rows.pop('.'.join(labels[:i]), None)
+        prefix = f'{path_tree}.'
+        for key in [key for key in self._rows if key.startswith(prefix)]:
+            del self._rows[key]
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += 1
+        self._rows.clear()
+
+    def _terminated(self, connection):
+        self.listener = None
+        self.clear()
+
+    def _notify_callback(self, connection, pid, channel, payload):
+        message = json.loads(payload)
+        space_id = message['space_id']
+        if space_id is not None and int(space_id) != self.space_id:
+            return
+        paths = message['paths']
+        if paths is None:
+            self.clear()
+            return
+        self.generation += 1
+        self.invalidations += 1
+        for path in paths:
+            if path.endswith('.*'):
+                # moved or deleted, so is everything below it
+                path = path[:-2]
+                prefix = f'{path}.'
+                for key in [key for key in self._rows if key.startswith(prefix)]:
+                    del self._rows[key]
+            self._rows.pop(path, None)
+
+
+# Channel update_property_summary notifies on when the set of uris of a space changes.
+PROPERTY_SUMMARY_CHANNEL = 'properties'
+
+
+class PropertySummary(object):
+    """
+    The property uris used by the nodes of a space, read from the reference
+    counted property_summary table and kept in memory until a notification
+    says the set has changed. While the listener is down every call reads it.
+
+    :param space_id: space of the summary.
+    :param db_pool: pool of the primary, the summary is not read from replicas.
+    """
+    def __init__(self, space_id, db_pool):
+        self.space_id = space_id
+        self.db_pool = db_pool
+        self.listener = None
+        # bumped on every notification, a set read before it is not kept
+        self.generation = 0
+        self._uris = None
+
+    async def setup(self, dsn):
+        self.listener = await asyncpg.connect(dsn=dsn)
+        self.listener.add_termination_listener(self._terminated)
+        await self.listener.add_listener(PROPERTY_SUMMARY_CHANNEL, self._notify_callback)
+
+    async def close(self):
+        if self.listener:
+            listener, self.listener = self.listener, None
+            await listener.close()
+        self._uris = None
+
+    @property
+    def enabled(self):
+        return self.listener is not None and not self.listener.is_closed()
+
+    async def get(self):
+        uris = self._uris
+        if uris is not None and self.enabled:
+            return uris
+        generation = self.generation
+        async with self.db_pool.acquire() as conn:
+            results = await conn.fetch("select uri from property_summary "
+                                       "where space_id=$1 order by uri", self.space_id)
+        uris = [result['uri'] for result in results]
+        if self.enabled and generation == self.generation:
+            self._uris = uris
+        return uris
+
+    def _terminated(self, connection):
+        self.listener = None
+        self._uris = None
+
+    def _notify_callback(self, connection, pid, channel, payload):
+        if int(payload) != self.space_id:
+            return
+        self.generation += 1
+        self._uris = None
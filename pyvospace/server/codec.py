@@ -0,0 +1,136 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+"""
+Encoding of VOSpace path names into ltree labels.
+
+ltree labels are restricted to [A-Za-z0-9_]. A name is encoded byte by byte
+from its utf-8 representation: letters and digits are kept as they are and
+every other byte is escaped as '_' followed by two upper case hex digits.
+Names made mostly of escaped bytes (e.g. non latin scripts) are instead
+written as '_Z' followed by the unpadded base32hex of the name.
+
+Labels written by earlier releases are the base16 of the name. They are
+still decoded: a label that is nothing but pairs of upper case hex digits
+is a legacy label. An encoded name that would look like one is prefixed
+with '_H' so that the two never collide.
+"""
+
+import re
+import base64
+import string
+
+from functools import lru_cache
+from urllib.parse import unquote
+
+from pyvospace.core.exception import InvalidURI
+
+
+_PLAIN = frozenset((string.ascii_letters + string.digits).encode())
+_ESCAPES = [chr(b) if b in _PLAIN else f'_{b:02X}' for b in range(256)]
+_UNESCAPES = {f'{b:02X}': chr(b) for b in range(128)}
+_LEGACY_LABEL = re.compile(r'^(?:[0-9A-F]{2})+$')
+
+# base64.b32hexencode is not available before python 3.10
+_B32 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+_B32HEX = '0123456789ABCDEFGHIJKLMNOPQRSTUV'
+_TO_B32HEX = str.maketrans(_B32, _B32HEX)
+_FROM_B32HEX = str.maketrans(_B32HEX, _B32)
+
+
+def is_legacy_label(label):
+    return _LEGACY_LABEL.match(label) is not None
+
+
+def encode_name(name):
+    data = name.encode()
+    label = ''.join([_ESCAPES[b] for b in data])
+    packed = base64.b32encode(data).decode('ascii').rstrip('=').translate(_TO_B32HEX)
+    if len(packed) + 2 < len(label):
+        return f'_Z{packed}'
+    if is_legacy_label(label):
+        return f'_H{label}'
+    return label
+
+
+def decode_name(label):
+    if '_' not in label:
+        if is_legacy_label(label):
+            return base64.b16decode(label).decode().replace('%2E', '.')
+        return label
+    if label.startswith('_Z'):
+        packed = label[2:]
+        return base64.b32decode(packed.translate(_FROM_B32HEX) + '=' * (-len(packed) % 8)).decode()
+    if label.startswith('_H'):
+        return label[2:]
+    parts = label.split('_')
+    chars = [parts[0]]
+    for part in parts[1:]:
+        char = _UNESCAPES.get(part[:2])
+        if char is None:
+            # multi-byte utf-8 sequence
+            return unquote(label.replace('_', '%'), errors='strict')
+        chars.append(char)
+        chars.append(part[2:])
+    return ''.join(chars)
+
+
+def encode_path(path, as_array=False):
+    path_array = list(filter(None, path.split('/')))
+    if not path_array:
+        raise InvalidURI("Path is empty")
+    labels = [encode_name(name) for name in path_array]
+    if as_array:
+        return labels
+    return '.'.join(labels)
+
+
+def decode_path(ltree_path):
+    prefix, _, label = ltree_path.rpartition('.')
+    if not prefix:
+        return decode_name(label)
+    return f'{_decode_prefix(prefix)}/{decode_name(label)}'
+
+
+def decode_paths(ltree_paths):
+    """
+    Decode the paths of a result set. Rows of a subtree share a handful of
+    parents so each distinct parent is only decoded once.
+    """
+    parents = {}
+    paths = []
+    for ltree_path in ltree_paths:
+        prefix, _, label = ltree_path.rpartition('.')
+        if not prefix:
+            paths.append(decode_name(label))
+            continue
+        parent = parents.get(prefix)
+        if parent is None:
+            parent = parents[prefix] = _decode_prefix(prefix)
+        paths.append(f'{parent}/{decode_name(label)}')
+    return paths
+
+
+# Decoded parent paths. Bounded, the leaf of each path is decoded every time
+# as it is rarely shared between rows.
+@lru_cache(maxsize=8192)
+def _decode_prefix(ltree_prefix):
+    return decode_path(ltree_prefix)
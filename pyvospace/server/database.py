@@ -20,70 +20,90 @@
 #    MA 02111-1307  USA
 
 import os
+import json
+import uuid
 import asyncpg
-import base64
 
 from pyvospace.core.exception import VOSpaceError, InvalidURI, NodeDoesNotExistError, PermissionDenied, \
     ContainerDoesNotExistError, DuplicateNodeError, InvalidArgument
 from pyvospace.core.model import Node, DataNode, UnstructuredDataNode, StructuredDataNode, LinkNode, ContainerNode, \
     NodeType, Property, DeleteProperty, NodeTextLookup, Storage
 
+from .codec import encode_path, decode_path, decode_paths
+from .replica import ReadPool
+
+
+# Orderings supported for container listings mapped to the column they sort on.
+LIST_SORT_COLUMNS = {'name': 'name', 'size': 'size', 'mtime': 'modified'}
+
+# The root of a detached subtree is relabelled with this prefix and its id until it is reaped.
+# An encoded name never starts with '_t' so it can not clash with a node.
+TRASH_LABEL = '_trash'
+
+# parent_id of the root of a detached subtree, not reachable from any listing.
+TRASH_PARENT_ID = uuid.UUID(int=0)
+
+# Read only properties of a container holding the total size and number of
+# nodes below it. Maintained by triggers on the nodes table.
+TREE_SIZE_URI = 'ivo://icrar.org/vospace/core#treesize'
+TREE_COUNT_URI = 'ivo://icrar.org/vospace/core#treecount'
+
 
 class NodeDatabase(object):
-    def __init__(self, space_id, db_pool, permission):
+    # Number of child rows fetched per round trip when streaming a container listing.
+    cursor_prefetch = 1000
+    # Trees with at least this many nodes are inserted with COPY instead of executemany.
+    bulk_threshold = 1000
+
+    def __init__(self, space_id, db_pool, permission, read_pool=None, cache=None, summary=None):
         self.space_id = space_id
         self.permission = permission
         self.db_pool = db_pool
+        self.read_pool = read_pool if read_pool else ReadPool(db_pool)
+        self.cache = cache
+        self.summary = summary
+
+    def invalidate(self, path_tree):
+        if self.cache:
+            self.cache.invalidate(path_tree)
 
     @classmethod
     def ltree_to_path(cls, ltree_path):
-        path_array = list(filter(None, ltree_path.split('.')))
-        path_array_result = [base64.b16decode(i).decode() for i in path_array]
-        path = '/'.join(path_array_result)
-        return path.replace('%2E', '.')
+        return decode_path(ltree_path)
+
+    @classmethod
+    def ltree_to_paths(cls, ltree_paths):
+        return decode_paths(ltree_paths)
 
     @classmethod
     def path_to_ltree(cls, path, as_array=False):
-        path_array = list(filter(None, path.replace('.', '%2E').split('/')))
-        if not path_array:
-            raise InvalidURI("Path is empty")
-        path_array_result = [base64.b16encode(i.encode()).decode('ascii') for i in path_array]
-        if as_array:
-            return path_array_result
-        else:
-            return '.'.join(path_array_result)
+        return encode_path(path, as_array)
 
     @classmethod
-    def resultset_to_node_tree(cls, results, prop_results=None):
-        prop_dict = {}
-        if prop_results:
-            for result in prop_results:
-                prop_dict.setdefault(result['node_path'], []).append(
-                    Property(result['uri'], result['value'], result['read_only']))
-
-        root = NodeDatabase._create_node(results.pop(0))
-        if results:
+    def resultset_to_node_tree(cls, results, properties=False):
+        nodes = NodeDatabase._create_nodes(results)
+        root = nodes.pop(0)
+        if nodes:
             if not isinstance(root, ContainerNode):
                 raise InvalidURI(f'{root} is not a container')
-        for result in results:
-            node = NodeDatabase._create_node(result)
-            props = prop_dict.get(result['path'], [])
-            node.set_properties(props)
+        for result, node in zip(results[1:], nodes):
+            if properties:
+                node.set_properties(NodeDatabase._json_to_properties(result['properties']))
             root.insert_node_into_tree(node)
         return root
 
     @classmethod
-    def _resultset_to_node(cls, root_node_rows, root_properties_row):
+    def _resultset_to_node(cls, root_node_rows, properties=False):
         if root_node_rows[0] is None:
             return None
-        node = NodeDatabase._create_node(root_node_rows[0])
-        root_node_rows.pop(0)
-        child_nodes = [NodeDatabase._create_node(node_row) for node_row in root_node_rows]
+        child_nodes = NodeDatabase._create_nodes(root_node_rows)
+        node = child_nodes.pop(0)
         if len(child_nodes) > 0:
             if node.node_type != NodeType.ContainerNode:
                 raise InvalidArgument('Attempting to add child node to non-container.')
             node.nodes = child_nodes
-        node.set_properties(NodeDatabase._resultset_to_properties(root_properties_row))
+        if properties:
+            node.set_properties(NodeDatabase._json_to_properties(root_node_rows[0]['properties']))
         return node
 
     @classmethod
@@ -95,8 +115,26 @@ class NodeDatabase(object):
         return properties
 
     @classmethod
-    def _create_node(cls, node_row):
-        path = NodeDatabase.ltree_to_path(node_row['path'])
+    def _json_to_properties(cls, document):
+        # properties are stored on the node as {uri: {"value": ..., "read_only": ...}}
+        if not document or document == '{}':
+            return []
+        return [Property(uri, prop['value'], prop['read_only']) for uri, prop in json.loads(document).items()]
+
+    @classmethod
+    def _properties_to_json(cls, properties):
+        return json.dumps({prop.uri: {'value': prop.value, 'read_only': prop.read_only}
+                           for prop in properties if prop.persist})
+
+    @classmethod
+    def _create_nodes(cls, node_rows):
+        paths = NodeDatabase.ltree_to_paths([node_row['path'] for node_row in node_rows])
+        return [NodeDatabase._create_node(node_row, path) for node_row, path in zip(node_rows, paths)]
+
+    @classmethod
+    def _create_node(cls, node_row, path=None):
+        if path is None:
+            path = NodeDatabase.ltree_to_path(node_row['path'])
         node_type = node_row['type']
         id = node_row['id']
         if node_type == NodeType.Node:
@@ -117,7 +155,6 @@ class NodeDatabase(object):
         node.owner = node_row['owner']
         node.group_read = node_row['groupread']
         node.group_write = node_row['groupwrite']
-        node.path_modified = node_row['path_modified']
         node.size = node_row['size']
         if node_row['storage_id'] is not None:
             node.storage = Storage(node_row['storage_id'], node_row['space_name'], node_row['host'], node_row['port'],
@@ -125,20 +162,25 @@ class NodeDatabase(object):
         return node
 
     async def _get_node_and_parent(self, path, conn):
+        """
+        Read the node at path and its parent, no rows are locked.
+
+        :return: tuple(parent row, node row), either is None if it does not exist.
+        """
         path_list = NodeDatabase.path_to_ltree(path, as_array=True)
         path_parent = path_list[:-1]
         path_parent_tree = '.'.join(path_parent)
         path_tree = '.'.join(path_list)
 
         try:
-            # share lock both node and parent, important so we
-            # dont have a dead lock with move/copy/create
-            query = """with node_cte as 
-                       (select * from nodes where path=$1 or path=$2 and space_id=$3 order by path asc for update)
-                       select node_cte.*, storage.name as space_name, 
-                       storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
-                       from node_cte left join storage on node_cte.storage_id=storage.id 
-                       order by node_cte.path asc"""
+            query = f"""with node_cte as 
+                        (select nodes.*, walk.path from node_walk($3, $1) walk 
+                        join nodes on nodes.space_id=$3 and nodes.id=walk.id 
+                        where walk.path=$1 or walk.path=$2)
+                        select node_cte.*, storage.name as space_name, 
+                        storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
+                        from node_cte left join storage on node_cte.storage_id=storage.id 
+                        order by node_cte.path asc"""
 
             result = await conn.fetch(query, path_tree, path_parent_tree, self.space_id)
 
@@ -162,45 +204,148 @@ class NodeDatabase(object):
             return result[0], result[1]
         return None, None
 
-    async def directory(self, path, conn, identity=None):
-        path = os.path.normpath(path)
-        if not any(path in s for s in ['/', '//']):
-            path_tree = NodeDatabase.path_to_ltree(path)
+    async def _lock_node_and_parent(self, path, conn, mode='IS'):
+        """
+        Same as _get_node_and_parent() but path is locked with lock_path() first.
+        In the default IS mode neither node can be deleted or moved until the
+        transaction ends while reads and writes of the rest of the tree go on.
+        """
+        await self.lock_path(NodeDatabase.path_to_ltree(path), conn, mode)
+        return await self._get_node_and_parent(path, conn)
+
+    async def lock_path(self, path_tree, conn, mode, nowait=False):
+        """
+        Take a hierarchical intent lock on path_tree until the end of the transaction.
+        Its ancestors are intent locked from the root down, IS for a reader and IX for
+        a writer, so the cost is the depth of the path and not the size of the subtree.
+
+        ====  ==================================================
+        IS    a node below path is read.
+        IX    a node below path is written.
+        S     the subtree at path is read, conflicts with IX and X.
+        X     the subtree at path is written, conflicts with all.
+        ====  ==================================================
+
+        :raises LockNotAvailableError: if nowait and the lock is held by another transaction.
+        """
+        try:
+            await conn.execute("select lock_path($1, $2, $3, $4)",
+                               self.space_id, path_tree, mode, nowait)
+        except asyncpg.exceptions.PostgresSyntaxError:
+            raise InvalidURI(f"{NodeDatabase.ltree_to_path(path_tree)} contains invalid characters.")
 
-            query = """with node_cte as 
-                       (select * from nodes where path <@ $1 and nlevel(path)-nlevel($1)<=1 and space_id=$2 
-                       order by path asc) 
-                       select node_cte.*, storage.name as space_name, 
-                       storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
-                       from node_cte left join storage on node_cte.storage_id=storage.id 
-                       order by node_cte.path asc"""
+    async def directory(self, path, conn, identity=None, limit=None, start=None, sort='name', order='asc'):
+        node, parent_id = await self._get_directory_node(path, conn, identity)
+        if isinstance(node, ContainerNode):
+            query, args = await self._get_child_rows_query(parent_id, node.path, conn, limit, start, sort, order)
+            for result in await conn.fetch(query, *args):
+                node.add_node(NodeDatabase._create_node(result))
 
-            results = await conn.fetch(query, path_tree, self.space_id)
-            if len(results) == 0:
-                raise NodeDoesNotExistError(f"{path} not found.")
+        if not await self.permission.permits(identity, 'getNode', context=node):
+            raise PermissionDenied('getNode denied.')
+        return node
 
-            properties = await conn.fetch("select * from properties "
-                                          "where node_path=$1 and space_id=$2",
-                                          results[0]['path'], self.space_id)
+    async def directory_cursor(self, path, conn, identity=None, limit=None, start=None, sort='name', order='asc'):
+        """
+        Same as directory() but the children of a container are not loaded.
+        Instead a cursor over the child rows is returned so that a listing can be
+        consumed incrementally. Must be called within a transaction.
 
-            node = self._resultset_to_node(results, properties)
+        :return: tuple(node, cursor) where cursor is None if the node is not a container.
+        """
+        node, parent_id = await self._get_directory_node(path, conn, identity)
+        if not await self.permission.permits(identity, 'getNode', context=node):
+            raise PermissionDenied('getNode denied.')
 
-        else:
-            query = """with node_cte as 
-                       (select * from nodes where nlevel(path)=1 and space_id=$1 order by path asc) 
-                       select node_cte.*, storage.name as space_name, 
+        if not isinstance(node, ContainerNode):
+            return node, None
+        query, args = await self._get_child_rows_query(parent_id, node.path, conn, limit, start, sort, order)
+        return node, conn.cursor(query, *args, prefetch=self.cursor_prefetch)
+
+    async def _get_directory_node(self, path, conn, identity):
+        path = os.path.normpath(path)
+        if any(path in s for s in ['/', '//']):
+            return ContainerNode('/', group_read=[identity]), None
+
+        path_tree = NodeDatabase.path_to_ltree(path)
+
+        result = self.cache.get(path_tree) if self.cache else None
+        if result is None:
+            generation = self.cache.generation if self.cache else None
+            query = """select nodes.*, walk.path, storage.name as space_name, 
                        storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
-                       from node_cte left join storage on node_cte.storage_id=storage.id 
-                       order by node_cte.path asc"""
+                       from node_walk($2, $1) walk join nodes on nodes.space_id=$2 and nodes.id=walk.id 
+                       left join storage on nodes.storage_id=storage.id 
+                       where walk.path=$1"""
 
-            results = await conn.fetch(query, self.space_id)
-            node = ContainerNode('/', group_read=[identity])
-            for result in results:
-                node.insert_node_into_tree(NodeDatabase._create_node(result))
+            result = await conn.fetchrow(query, path_tree, self.space_id)
+            if not result:
+                raise NodeDoesNotExistError(f"{path} not found.")
+            if self.cache:
+                self.cache.put(path_tree, result, generation)
+
+        node = self._resultset_to_node([result], properties=True)
+        if isinstance(node, ContainerNode):
+            # the changes not yet folded into the row, see fold_tree_deltas
+            pending = await conn.fetchrow("select * from tree_delta($1, $2)", self.space_id, result['id'])
+            node.add_property(Property(TREE_SIZE_URI, str(result['tree_size'] + pending['size']),
+                                       True, persist=False))
+            node.add_property(Property(TREE_COUNT_URI, str(result['tree_count'] + pending['count']),
+                                       True, persist=False))
+        return node, result['id']
+
+    async def _get_child_rows_query(self, parent_id, path, conn, limit=None, start=None, sort='name', order='asc'):
+        if sort not in LIST_SORT_COLUMNS:
+            raise InvalidArgument(f'sort invalid: {sort}')
+        if order not in ('asc', 'desc'):
+            raise InvalidArgument(f'order invalid: {order}')
+        sort_column = LIST_SORT_COLUMNS[sort]
+
+        # parent_id of None lists the nodes at the root of the space
+        if parent_id is None:
+            args = [self.space_id]
+            where = "parent_id is null and space_id=$1"
+        else:
+            args = [parent_id, self.space_id]
+            where = "parent_id=$1 and space_id=$2"
+
+        if start:
+            # Keyset pagination: the listing starts at the child identified by start
+            # and is resumed from its position in the requested ordering.
+            if os.path.dirname(start) != path:
+                raise InvalidURI(f'{start} is not a child of {path}')
+            start_row = await conn.fetchrow(f"select name, size, modified from nodes "
+                                            f"where {where} and name=${len(args)+1}",
+                                            *args, os.path.basename(start))
+            if not start_row:
+                raise NodeDoesNotExistError(f"{start} not found.")
+
+            operator = '>=' if order == 'asc' else '<='
+            if sort_column == 'name':
+                args.append(start_row['name'])
+                where += f" and name{operator}${len(args)}"
+            else:
+                args += [start_row[sort_column], start_row['name']]
+                where += f" and ({sort_column}, name){operator}(${len(args)-1}, ${len(args)})"
+
+        columns = [sort_column] if sort_column == 'name' else [sort_column, 'name']
+        ordering = ', '.join([f"{column} {order}" for column in columns])
+        cte_ordering = ', '.join([f"node_cte.{column} {order}" for column in columns])
+        if parent_id is None:
+            child_path = "text2ltree(node_cte.label)"
+        else:
+            args.append(NodeDatabase.path_to_ltree(path))
+            child_path = f"${len(args)}::ltree||node_cte.label"
+        args.append(limit)
 
-        if not await self.permission.permits(identity, 'getNode', context=node):
-            raise PermissionDenied('getNode denied.')
-        return node
+        query = f"""with node_cte as 
+                    (select * from nodes where {where} order by {ordering} limit ${len(args)}) 
+                    select node_cte.*, {child_path} as path, storage.name as space_name, 
+                    storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
+                    from node_cte left join storage on node_cte.storage_id=storage.id 
+                    order by {cte_ordering}"""
+
+        return query, args
 
     async def create(self, node, conn, identity):
         try:
@@ -217,10 +362,10 @@ class NodeDatabase(object):
             node_name = os.path.basename(node.path)
             path_tree = '.'.join(path_list)
             # get parent node and check if its valid to add node to it
-            parent_row, child_row = await self._get_node_and_parent(node.path, conn)
+            parent_row, child_row = await self._lock_node_and_parent(node.path, conn, 'X')
             # if the parent is not found but its expected to exist
             if not parent_row and len(path_parent) > 0:
-                raise ContainerDoesNotExistError(f"{NodeDatabase.ltree_to_path(''.join(path_parent))} not found.")
+                raise ContainerDoesNotExistError(f"{NodeDatabase.ltree_to_path('.'.join(path_parent))} not found.")
 
             if parent_row:
                 if parent_row['type'] == NodeType.LinkNode:
@@ -229,25 +374,21 @@ class NodeDatabase(object):
                 if parent_row['type'] != NodeType.ContainerNode:
                     raise ContainerDoesNotExistError(f"{parent_row['name']} is not a container.")
 
-                parent_node = NodeDatabase._resultset_to_node([parent_row], [])
+                parent_node = NodeDatabase._resultset_to_node([parent_row])
             else:
                 parent_node = ContainerNode('/', group_read=[identity])
             if not await self.permission.permits(identity, 'createNode', context=(parent_node, node)):
                 raise PermissionDenied('createNode denied.')
 
-            await conn.fetchrow("insert into nodes (type, name, path, owner, "
-                                "groupread, groupwrite, space_id, link) "
-                                "values ($1, $2, $3, $4, $5, $6, $7, $8)",
-                                node.node_type, node_name, path_tree, identity,
-                                node.group_read, node.group_write, self.space_id, target)
-            node_properties = []
-            for prop in node.properties.values():
-                if prop.persist:
-                    node_properties.append(prop.tolist()+[path_tree, self.space_id])
-
-            if node_properties:
-                await conn.executemany("insert into properties (uri, value, read_only, node_path, space_id) "
-                                       "values ($1, $2, $3, $4, $5)", node_properties)
+            node.id = await conn.fetchval("insert into nodes (type, name, label, parent_id, owner, "
+                                          "groupread, groupwrite, space_id, link, properties) "
+                                          "values ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10) returning id",
+                                          node.node_type, node_name, path_list[-1],
+                                          parent_row['id'] if parent_row else None, identity,
+                                          node.group_read, node.group_write, self.space_id, target,
+                                          NodeDatabase._properties_to_json(node.properties.values()))
+            # the totals of the ancestors change with the new node
+            self.invalidate(path_tree)
             return parent_row, child_row
         except asyncpg.exceptions.UniqueViolationError as f:
             raise DuplicateNodeError(f"{node.path} already exists.")
@@ -261,40 +402,118 @@ class NodeDatabase(object):
             return
         nodes.sort()
 
-        node_insert = []
+        trees = []
         for node in nodes:
             if not isinstance(node, Node):
                 raise InvalidArgument(f'{node} is not a Node.')
-            path = NodeDatabase.path_to_ltree(node.path)
-            node_row = [node.node_type, node.name, path, node.owner,
-                        node.group_read, node.group_write, node.id,
-                        node.size, node.storage.storage_id if node.storage else None,
-                        self.space_id, node.target if isinstance(node, LinkNode) else None]
-            node_insert.append(node_row)
-        if node_insert:
-            await conn.executemany("insert into nodes (type, name, path, owner, groupread, groupwrite, "
-                                   "id, size, storage_id, space_id, link) "
-                                   "values ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11) "
-                                   "on conflict (path, space_id) do update set size=$8, storage_id=$9",
-                                   node_insert)
-
-        node_properties = []
-        for node in nodes:
-            for prop in node.properties.values():
-                prop_list = prop.tolist() + [NodeDatabase.path_to_ltree(node.path), self.space_id]
-                node_properties.append(prop_list)
+            trees.append(NodeDatabase.path_to_ltree(node.path))
+
+        # everything under the longest path the nodes share, and its ancestors
+        common = os.path.commonprefix([tree.split('.') for tree in trees])
+        if common:
+            self.invalidate('.'.join(common))
+        elif self.cache:
+            self.cache.clear()
+
+        # id of every path of the batch and of the parents it is inserted under
+        ids = {}
+        parents = {tree.rpartition('.')[0] for tree in trees} - set(trees) - {''}
+        if parents:
+            results = await conn.fetch("select walk.path, walk.id from unnest($2::ltree[]) as p(path), "
+                                       "node_walk($1, p.path) walk where walk.path=p.path",
+                                       self.space_id, list(parents))
+            ids.update({result['path']: result['id'] for result in results})
+            missing = parents - set(ids)
+            if missing:
+                raise ContainerDoesNotExistError(f"{NodeDatabase.ltree_to_path(min(missing))} not found.")
+
+        # nodes that already exist are merged with the new ones, looked up a level
+        # at a time as only the children of an existing node can exist
+        node_update = []
+        node_insert = []
+        inserted = set()
+        for level in sorted({tree.count('.') for tree in trees}):
+            batch = [(node, tree) for node, tree in zip(nodes, trees) if tree.count('.') == level]
+            lookup = [tree.rpartition('.') for _, tree in batch]
+            lookup = [(ids.get(parent_tree), label)
+                      for parent_tree, _, label in lookup if parent_tree not in inserted]
+            if level == 0:
+                results = await conn.fetch("select id, parent_id, label from nodes "
+                                           "where space_id=$1 and parent_id is null and label=any($2::text[])",
+                                           self.space_id, [label for _, label in lookup])
+            elif lookup:
+                results = await conn.fetch("select nodes.id, nodes.parent_id, nodes.label from nodes "
+                                           "join unnest($2::uuid[], $3::text[]) as u(parent_id, label) "
+                                           "on nodes.parent_id=u.parent_id and nodes.label=u.label "
+                                           "where nodes.space_id=$1",
+                                           self.space_id, [parent_id for parent_id, _ in lookup],
+                                           [label for _, label in lookup])
+            else:
+                results = []
+            existing = {(result['parent_id'], result['label']): result['id'] for result in results}
+
+            for node, tree in batch:
+                parent_tree, _, label = tree.rpartition('.')
+                parent_id = ids.get(parent_tree)
+                properties = NodeDatabase._properties_to_json(node.properties.values())
+                storage_id = node.storage.storage_id if node.storage else None
+                node_id = existing.get((parent_id, label))
+                if node_id:
+                    node_update.append((node_id, node.size, storage_id, properties))
+                else:
+                    node_id = node.id
+                    inserted.add(tree)
+                    node_insert.append([node.node_type, node.name, label, parent_id, node.owner,
+                                        node.group_read, node.group_write, node_id, node.size, storage_id,
+                                        self.space_id, node.target if isinstance(node, LinkNode) else None,
+                                        properties])
+                ids[tree] = node_id
+
+        if node_update:
+            # properties of an existing node are merged with the new ones
+            await conn.execute("update nodes set size=u.size, storage_id=u.storage_id, "
+                               "properties=nodes.properties||u.properties "
+                               "from unnest($1::uuid[], $2::bigint[], $3::bigint[], $4::jsonb[]) "
+                               "as u(id, size, storage_id, properties) where nodes.space_id=$5 and nodes.id=u.id",
+                               *[list(column) for column in zip(*node_update)], self.space_id)
+
+        if not node_insert:
+            return
+        if len(node_insert) >= self.bulk_threshold:
+            await self._copy_tree(node_insert, conn)
+            return
 
-        if node_properties:
-            await conn.executemany("insert into properties (uri, value, read_only, node_path, space_id) "
-                                   "values ($1, $2, $3, $4, $5) on conflict (uri, node_path, space_id) "
-                                   "do update set value=$2 where properties.value!=$2",
-                                   node_properties)
+        await conn.executemany("insert into nodes (type, name, label, parent_id, owner, groupread, groupwrite, "
+                               "id, size, storage_id, space_id, link, properties) "
+                               "values ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)",
+                               node_insert)
+
+    async def _copy_tree(self, node_insert, conn):
+        # COPY the rows into a temporary staging table then merge it with one statement.
+        # Every parent id is known up front, a row that appeared since the lookups is merged
+        # the same way as the nodes that already existed.
+        await conn.execute("create temporary table nodes_staging "
+                           "(type smallint, name text, label text, parent_id uuid, owner text, "
+                           "groupread text[], groupwrite text[], id uuid, size bigint, storage_id bigint, "
+                           "space_id bigint, link text, properties jsonb) on commit drop")
+        await conn.copy_records_to_table('nodes_staging', records=node_insert)
+        await conn.execute("insert into nodes (type, name, label, parent_id, owner, groupread, groupwrite, "
+                           "id, size, storage_id, space_id, link, properties) "
+                           "(select type, name, label, parent_id, owner, groupread, groupwrite, "
+                           "id, size, storage_id, space_id, link, properties from nodes_staging) "
+                           "on conflict (space_id, parent_id, label) do update "
+                           "set size=excluded.size, storage_id=excluded.storage_id, "
+                           "properties=nodes.properties||excluded.properties")
+        await conn.execute("drop table nodes_staging")
 
     async def update(self, node, conn, identity, check_identity=True):
         node_path_tree = NodeDatabase.path_to_ltree(node.path)
+        await self.lock_path(node_path_tree, conn, 'X')
 
         query = """with node_cte as
-                   (select * from nodes where path=$1 and type=$2 and space_id=$3 for update of nodes)
+                   (select nodes.*, walk.path from node_walk($3, $1) walk 
+                   join nodes on nodes.space_id=$3 and nodes.id=walk.id 
+                   where walk.path=$1 and nodes.type=$2 for no key update of nodes)
                    select node_cte.*, storage.name as space_name,
                    storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
                    from node_cte left join storage on node_cte.storage_id=storage.id"""
@@ -310,46 +529,38 @@ class NodeDatabase(object):
             if not await self.permission.permits(identity, 'setNode', context=node):
                 raise PermissionDenied('setNode denied.')
 
+        # the row is locked so the properties are merged here and written back whole
+        properties = {prop.uri: prop for prop in NodeDatabase._json_to_properties(results['properties'])}
         pass_through_properties = []
-        node_props_delete = []
-        node_props_insert = []
         for prop in node.properties.values():
             if isinstance(prop, DeleteProperty):
-                node_props_delete.append(prop.uri)
+                properties.pop(prop.uri, None)
             else:
                 if prop.persist:
-                    node_props_insert.append([prop.uri, prop.value, False, node_path_tree, self.space_id])
+                    # if a property already exists then update it
+                    existing = properties.get(prop.uri)
+                    properties[prop.uri] = Property(prop.uri, prop.value,
+                                                    existing.read_only if existing else False)
                 else:
                     pass_through_properties.append(prop)
 
-        await conn.execute("update nodes set groupread=$1, groupwrite=$2, size=$3, storage_id=$4 "
-                           "where path=$5 and space_id=$6",
+        await conn.execute("update nodes set groupread=$1, groupwrite=$2, size=$3, storage_id=$4, "
+                           "properties=$5 where space_id=$7 and id=$6",
                            node.group_read, node.group_write,
                            node.size, node.storage.storage_id if node.storage else None,
-                           node_path_tree, self.space_id)
-
-        if node_props_insert:
-            # if a property already exists then update it
-            await conn.executemany("insert into properties (uri, value, read_only, node_path, space_id) "
-                                   "values ($1, $2, $3, $4, $5) on conflict (uri, node_path, space_id) "
-                                   "do update set value=$2 where properties.value!=$2",
-                                   node_props_insert)
-
-        if node_props_delete:
-            await conn.execute("delete from properties where uri=any($1::text[]) "
-                               "and node_path=$2 and space_id=$3",
-                               node_props_delete, node_path_tree, self.space_id)
-
-        node_properties = await conn.fetch("select * from properties "
-                                           "where node_path=$1 and space_id=$2",
-                                           node_path_tree, self.space_id)
-        node.set_properties(NodeDatabase._resultset_to_properties(node_properties) + pass_through_properties)
+                           NodeDatabase._properties_to_json(properties.values()),
+                           results['id'], self.space_id)
+        self.invalidate(node_path_tree)
+
+        node.set_properties(list(properties.values()) + pass_through_properties)
         return node
 
     async def delete(self, path, conn, identity):
         path_tree = NodeDatabase.path_to_ltree(path)
-        results = await conn.fetch("with delete_cte as "
-                                   "(delete from nodes where path <@ $1 and space_id=$2 returning *) "
+        await self.lock_path(path_tree, conn, 'X')
+        results = await conn.fetch("with tree as (select * from node_tree($2, $1)), "
+                                   "delete_cte as (delete from nodes using tree where nodes.space_id=$2 and nodes.id=tree.id "
+                                   "returning nodes.*, tree.path) "
                                    "select delete_cte.*, nlevel(delete_cte.path), "
                                    "storage.name as space_name, storage.host, "
                                    "storage.port, storage.parameters, storage.https, storage.enabled from delete_cte "
@@ -358,6 +569,7 @@ class NodeDatabase(object):
                                    path_tree, self.space_id)
         if not results:
             raise NodeDoesNotExistError(f"{path} not found.")
+        self.invalidate(path_tree)
 
         node = NodeDatabase.resultset_to_node_tree(results)
 
@@ -365,13 +577,131 @@ class NodeDatabase(object):
             raise PermissionDenied('deleteNode denied.')
         return node
 
+    async def detach(self, path, conn, identity):
+        """
+        Delete a node in trash mode. The root of the subtree is moved out of
+        the namespace and the subtree is left for reap_trash() to remove.
+
+        :return: the root node of the subtree, without its children.
+        """
+        path_tree = NodeDatabase.path_to_ltree(path)
+        await self.lock_path(path_tree, conn, 'X')
+        query = """with node_cte as 
+                   (select nodes.*, walk.path from node_walk($2, $1) walk 
+                   join nodes on nodes.space_id=$2 and nodes.id=walk.id 
+                   where walk.path=$1 for update of nodes) 
+                   select node_cte.*, storage.name as space_name, 
+                   storage.host, storage.port, storage.parameters, storage.https, storage.enabled 
+                   from node_cte left join storage on node_cte.storage_id=storage.id"""
+        result = await conn.fetchrow(query, path_tree, self.space_id)
+        if not result:
+            raise NodeDoesNotExistError(f"{path} not found.")
+
+        node = NodeDatabase._resultset_to_node([result])
+        if not await self.permission.permits(identity, 'deleteNode', context=node):
+            raise PermissionDenied('deleteNode denied.')
+
+        await conn.execute("update nodes set parent_id=$2, label=$3 where space_id=$4 and id=$1",
+                           result['id'], TRASH_PARENT_ID, f"{TRASH_LABEL}{result['id'].hex}", self.space_id)
+        self.invalidate(path_tree)
+        await conn.execute("insert into trash (id, space_id, path) values ($1, $2, $3)",
+                           result['id'], self.space_id, path_tree)
+        return node
+
+    async def reap_trash(self, conn, limit):
+        """
+        Remove up to limit detached nodes. Only nodes without children are
+        removed so that the root of a subtree is the last of it to go.
+
+        :return: list of (node, root) of the removed nodes and the roots of their trees,
+                 with the paths they had before being detached.
+        """
+        results = await conn.fetch("with recursive tree as "
+                                   "(select id, id as root_id, ''::ltree as path from nodes "
+                                   "where space_id=$1 and parent_id=$2 "
+                                   "union all "
+                                   "select nodes.id, tree.root_id, tree.path||nodes.label from tree "
+                                   "join nodes on nodes.space_id=$1 and nodes.parent_id=tree.id), "
+                                   "leaves as (select nodes.id, tree.root_id, tree.path from tree "
+                                   "join nodes on nodes.space_id=$1 and nodes.id=tree.id where not exists "
+                                   "(select 1 from nodes child where child.space_id=$1 and child.parent_id=tree.id) "
+                                   "limit $3 for update of nodes skip locked), "
+                                   "delete_cte as (delete from nodes using leaves where nodes.space_id=$1 and nodes.id=leaves.id "
+                                   "returning nodes.*, leaves.root_id, leaves.path) "
+                                   "select delete_cte.*, storage.name as space_name, storage.host, "
+                                   "storage.port, storage.parameters, storage.https, storage.enabled "
+                                   "from delete_cte left join storage on delete_cte.storage_id=storage.id",
+                                   self.space_id, TRASH_PARENT_ID, limit)
+        if not results:
+            return []
+
+        trash_ids = {result['root_id'] for result in results}
+        trash_results = await conn.fetch("select id, path from trash where id=any($1::uuid[])",
+                                         list(trash_ids))
+        roots = {result['id']: f"/{NodeDatabase.ltree_to_path(result['path'])}" for result in trash_results}
+
+        nodes = []
+        for result in results:
+            path = roots[result['root_id']]
+            root = Node(path, id=result['root_id'])
+            if result['path']:
+                path = f"{path}/{NodeDatabase.ltree_to_path(result['path'])}"
+            nodes.append((NodeDatabase._create_node(result, path), root))
+
+        await conn.execute("delete from trash where id=any($1::uuid[])",
+                           [result['id'] for result in results if result['id'] in trash_ids])
+        return nodes
+
+    async def fold_tree_deltas(self, conn, limit):
+        """
+        Add the changes to the totals of up to limit containers, appended to
+        tree_deltas by their writers, to their rows.
+
+        :return: number of containers updated.
+        """
+        return await conn.fetchval("select fold_tree_deltas($1, $2)", self.space_id, limit)
+
+    async def get_tree(self, path_tree, conn):
+        """
+        Read the subtree at path_tree, no rows are locked.
+
+        :return: rows of the subtree ordered by level, the root first.
+        """
+        query = """select nodes.*, tree.path, nlevel(tree.path), storage.name as space_name, 
+                   storage.host, storage.port, storage.parameters, 
+                   storage.https, storage.enabled from node_tree($2, $1) tree 
+                   join nodes on nodes.space_id=$2 and nodes.id=tree.id 
+                   left join storage on nodes.storage_id=storage.id 
+                   order by nlevel(tree.path) asc"""
+        return await conn.fetch(query, path_tree, self.space_id)
+
+    async def lock_tree(self, path_tree, conn, exclusive=True, nowait=False):
+        """
+        Lock the subtree at path_tree for a transfer, X if exclusive otherwise S.
+        No rows are locked, the intent locks of its ancestors keep any of them
+        from being moved or deleted from under it.
+
+        :return: rows of the subtree ordered by level, the root first.
+        """
+        await self.lock_path(path_tree, conn, 'X' if exclusive else 'S', nowait)
+        return await self.get_tree(path_tree, conn)
+
     async def delete_properties(self, path, conn):
         path_tree = NodeDatabase.path_to_ltree(path)
-        await conn.execute("delete from properties where node_path=$1 and space_id=$2",
+        await conn.execute("update nodes set properties='{}' "
+                           "where space_id=$2 and id=(select id from node_walk($2, $1) where path=$1)",
                            path_tree, self.space_id)
+        self.invalidate(path_tree)
 
     async def get_contains_properties(self):
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await conn.fetch("select distinct(uri), value, read_only from properties where space_id=$1",
-                                        self.space_id)
\ No newline at end of file
+        """
+        The properties used by the nodes of the space, uri only.
+        """
+        if self.summary:
+            uris = await self.summary.get()
+        else:
+            async with self.read_pool.acquire() as conn:
+                results = await conn.fetch("select uri from property_summary "
+                                           "where space_id=$1 order by uri", self.space_id)
+            uris = [result['uri'] for result in results]
+        return [Property(uri, None) for uri in uris]
\ No newline at end of file
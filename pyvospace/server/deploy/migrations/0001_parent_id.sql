@@ -0,0 +1,42 @@
+--
+-- Maintain a parent_id column on nodes so that a container listing is an
+-- index range scan over its direct children instead of a walk of its subtree.
+--
+
+\connect vospace
+
+ALTER TABLE public.nodes ADD COLUMN IF NOT EXISTS parent_id uuid;
+
+ALTER TABLE public.nodes ALTER COLUMN name TYPE text COLLATE pg_catalog."C";
+
+
+CREATE OR REPLACE FUNCTION public.update_parent_id_column() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+   IF nlevel(NEW.path) > 1 THEN
+   NEW.parent_id := (SELECT id FROM public.nodes
+                     WHERE path = subpath(NEW.path, 0, nlevel(NEW.path) - 1) AND space_id = NEW.space_id);
+   ELSE
+   NEW.parent_id := NULL;
+   END IF;
+   RETURN NEW;
+END;
+$$;
+
+
+ALTER FUNCTION public.update_parent_id_column() OWNER TO vos_user;
+
+DROP TRIGGER IF EXISTS parent_id_trigger ON public.nodes;
+
+CREATE TRIGGER parent_id_trigger BEFORE INSERT ON public.nodes FOR EACH ROW EXECUTE PROCEDURE public.update_parent_id_column();
+
+
+UPDATE public.nodes SET parent_id = parent.id
+    FROM public.nodes parent
+    WHERE parent.space_id = nodes.space_id
+    AND parent.path = subpath(nodes.path, 0, nlevel(nodes.path) - 1)
+    AND nlevel(nodes.path) > 1
+    AND nodes.parent_id IS DISTINCT FROM parent.id;
+
+CREATE INDEX IF NOT EXISTS parent_idx ON public.nodes USING btree (space_id, parent_id, name);
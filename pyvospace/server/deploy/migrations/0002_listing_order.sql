@@ -0,0 +1,16 @@
+--
+-- Track when the data of a node last changed and index the direct children
+-- of a container by each of the supported listing orders.
+--
+
+\connect vospace
+
+ALTER TABLE public.nodes ADD COLUMN IF NOT EXISTS modified timestamp without time zone DEFAULT now() NOT NULL;
+
+DROP TRIGGER IF EXISTS node_modified_trigger ON public.nodes;
+
+CREATE TRIGGER node_modified_trigger BEFORE UPDATE OF size, storage_id ON public.nodes FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column();
+
+CREATE INDEX IF NOT EXISTS parent_modified_idx ON public.nodes USING btree (space_id, parent_id, modified, name);
+
+CREATE INDEX IF NOT EXISTS parent_size_idx ON public.nodes USING btree (space_id, parent_id, size, name);
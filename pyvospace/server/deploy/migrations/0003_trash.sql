@@ -0,0 +1,16 @@
+--
+-- Roots of subtrees detached by a delete in trash mode, waiting to be reaped.
+--
+
+\connect vospace
+
+CREATE TABLE IF NOT EXISTS public.trash (
+    id uuid NOT NULL,
+    space_id bigint NOT NULL,
+    path public.ltree NOT NULL,
+    created timestamp without time zone DEFAULT now() NOT NULL,
+    CONSTRAINT trash_pk PRIMARY KEY (id),
+    CONSTRAINT space_fk FOREIGN KEY (space_id) REFERENCES public.space(id) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+ALTER TABLE public.trash OWNER TO vos_user;
@@ -0,0 +1,107 @@
+--
+-- Keep the recursive size and number of descendants of every node up to
+-- date so that the totals of a container are read without a subtree scan.
+--
+
+\connect vospace
+
+ALTER TABLE public.nodes ADD COLUMN IF NOT EXISTS tree_size bigint DEFAULT 0 NOT NULL;
+
+ALTER TABLE public.nodes ADD COLUMN IF NOT EXISTS tree_count bigint DEFAULT 0 NOT NULL;
+
+CREATE OR REPLACE FUNCTION public.update_tree_totals() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   delta_space bigint[];
+   delta_path public.ltree[];
+   delta_size bigint[];
+   delta_count bigint[];
+BEGIN
+   -- the totals written below are not themselves a change to count
+   IF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+   END IF;
+
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(space_id), array_agg(path), array_agg(size), array_agg(count)
+   INTO delta_space, delta_path, delta_size, delta_count
+   FROM (SELECT n.space_id, subpath(n.path, 0, i) AS path, sum(n.size) AS size, count(*) AS count
+         FROM new_nodes n, generate_series(1, nlevel(n.path) - 1) AS i
+         GROUP BY 1, 2) AS delta;
+   ELSIF TG_OP = 'DELETE' THEN
+   SELECT array_agg(space_id), array_agg(path), array_agg(size), array_agg(count)
+   INTO delta_space, delta_path, delta_size, delta_count
+   FROM (SELECT o.space_id, subpath(o.path, 0, i) AS path, -sum(o.size) AS size, -count(*) AS count
+         FROM old_nodes o, generate_series(1, nlevel(o.path) - 1) AS i
+         GROUP BY 1, 2) AS delta;
+   ELSE
+   -- A moved subtree carries its own totals with it, only the ancestors
+   -- above it on either side change.
+   WITH changed AS (
+        SELECT o.space_id, o.path AS old_path, n.path AS new_path, o.size AS old_size, n.size AS new_size
+        FROM old_nodes o JOIN new_nodes n ON o.id = n.id
+        WHERE o.path <> n.path OR o.size <> n.size),
+   moved AS (
+        SELECT old_path AS path FROM changed WHERE old_path <> new_path
+        UNION ALL
+        SELECT new_path FROM changed WHERE old_path <> new_path),
+   change AS (
+        SELECT space_id, old_path AS path, -old_size AS size, -1 AS count FROM changed
+        UNION ALL
+        SELECT space_id, new_path, new_size, 1 FROM changed)
+   SELECT array_agg(space_id), array_agg(path), array_agg(size), array_agg(count)
+   INTO delta_space, delta_path, delta_size, delta_count
+   FROM (SELECT c.space_id, subpath(c.path, 0, i) AS path, sum(c.size) AS size, sum(c.count) AS count
+         FROM change c, generate_series(1, nlevel(c.path) - 1) AS i
+         WHERE subpath(c.path, 0, i) NOT IN (SELECT path FROM moved)
+         GROUP BY 1, 2
+         HAVING sum(c.size) <> 0 OR sum(c.count) <> 0) AS delta;
+   END IF;
+
+   IF delta_path IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   -- lock the ancestors top down, the same order as every other writer
+   WITH locked AS (
+        SELECT nodes.id, delta.size, delta.count
+        FROM public.nodes JOIN unnest(delta_space, delta_path, delta_size, delta_count) AS delta(space_id, path, size, count)
+        ON nodes.path = delta.path AND nodes.space_id = delta.space_id
+        ORDER BY nodes.path FOR UPDATE OF nodes)
+   UPDATE public.nodes SET tree_size = nodes.tree_size + locked.size, tree_count = nodes.tree_count + locked.count
+   FROM locked WHERE nodes.id = locked.id;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.update_tree_totals() OWNER TO vos_user;
+
+-- backfill and install the triggers without letting writers in between
+BEGIN;
+
+DROP TRIGGER IF EXISTS tree_insert_trigger ON public.nodes;
+
+DROP TRIGGER IF EXISTS tree_update_trigger ON public.nodes;
+
+DROP TRIGGER IF EXISTS tree_delete_trigger ON public.nodes;
+
+LOCK TABLE public.nodes IN SHARE ROW EXCLUSIVE MODE;
+
+UPDATE public.nodes SET tree_size = coalesce(totals.size, 0), tree_count = coalesce(totals.count, 0)
+    FROM public.nodes node LEFT JOIN
+         (SELECT d.space_id, subpath(d.path, 0, i) AS path, sum(d.size) AS size, count(*) AS count
+          FROM public.nodes d, generate_series(1, nlevel(d.path) - 1) AS i
+          GROUP BY 1, 2) AS totals
+    ON totals.space_id = node.space_id AND totals.path = node.path
+    WHERE nodes.id = node.id
+    AND (nodes.tree_size, nodes.tree_count) IS DISTINCT FROM (coalesce(totals.size, 0), coalesce(totals.count, 0));
+
+CREATE TRIGGER tree_insert_trigger AFTER INSERT ON public.nodes REFERENCING NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+
+CREATE TRIGGER tree_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+
+CREATE TRIGGER tree_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+
+COMMIT;
@@ -0,0 +1,32 @@
+--
+-- Store the properties of a node inline as a jsonb document keyed by uri
+-- instead of in a separate table, so that a node and its properties are
+-- read with one query and a move no longer cascades to the property rows.
+--
+
+\connect vospace
+
+BEGIN;
+
+ALTER TABLE public.nodes ADD COLUMN IF NOT EXISTS properties jsonb DEFAULT '{}'::jsonb NOT NULL;
+
+DO $$
+BEGIN
+   IF to_regclass('public.properties') IS NOT NULL THEN
+   LOCK TABLE public.nodes, public.properties IN SHARE ROW EXCLUSIVE MODE;
+
+   UPDATE public.nodes SET properties = props.document
+       FROM (SELECT node_path, space_id,
+                    jsonb_object_agg(uri, jsonb_build_object('value', value, 'read_only', coalesce(read_only, true)))
+                    AS document
+             FROM public.properties GROUP BY node_path, space_id) AS props
+       WHERE nodes.path = props.node_path AND nodes.space_id = props.space_id;
+
+   DROP TABLE public.properties;
+   END IF;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS properties_idx ON public.nodes USING gin (properties);
+
+COMMIT;
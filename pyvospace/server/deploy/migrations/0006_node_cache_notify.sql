@@ -0,0 +1,46 @@
+--
+-- Notify the servers caching node rows when rows of nodes or storage change.
+--
+
+\connect vospace
+
+CREATE OR REPLACE FUNCTION public.node_cache_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   payload text;
+BEGIN
+   -- storage details are joined into every cached row
+   IF TG_TABLE_NAME = 'storage' THEN
+   PERFORM pg_notify('nodes', '{"space_id":null,"paths":null}');
+   RETURN NULL;
+   END IF;
+
+   FOR payload IN
+       SELECT json_build_object('space_id', space_id, 'paths', json_agg(path::text))::text
+       FROM old_nodes GROUP BY space_id
+   LOOP
+   -- a notification is limited to 8000 bytes, past that the whole space is dropped
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.node_cache_notify_trigger() OWNER TO vos_user;
+
+DROP TRIGGER IF EXISTS node_cache_update_trigger ON public.nodes;
+
+CREATE TRIGGER node_cache_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+DROP TRIGGER IF EXISTS node_cache_delete_trigger ON public.nodes;
+
+CREATE TRIGGER node_cache_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+DROP TRIGGER IF EXISTS storage_cache_trigger ON public.storage;
+
+CREATE TRIGGER storage_cache_trigger AFTER UPDATE OR DELETE ON public.storage FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
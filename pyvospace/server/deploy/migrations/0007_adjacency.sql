@@ -0,0 +1,274 @@
+--
+-- Store the node tree as an adjacency list. A node keeps the id of its
+-- parent and its own ltree label, paths are resolved by walking the labels
+-- from the root of the space. Moving or renaming a subtree then rewrites its
+-- root row only, instead of the path of every node below it.
+--
+-- The servers of every space should be stopped while it is applied.
+--
+
+\connect vospace
+
+BEGIN;
+
+ALTER TABLE public.nodes ADD COLUMN IF NOT EXISTS label text COLLATE pg_catalog."C";
+
+ALTER TABLE public.uws_jobs ADD COLUMN IF NOT EXISTS node_id uuid;
+
+DROP TRIGGER IF EXISTS path_change_trigger ON public.nodes;
+
+DROP TRIGGER IF EXISTS parent_id_trigger ON public.nodes;
+
+DROP FUNCTION IF EXISTS public.update_path_modified_column();
+
+DROP FUNCTION IF EXISTS public.update_parent_id_column();
+
+DO $$
+BEGIN
+   IF EXISTS (SELECT 1 FROM information_schema.columns
+              WHERE table_schema = 'public' AND table_name = 'nodes' AND column_name = 'path') THEN
+   LOCK TABLE public.nodes, public.uws_jobs IN EXCLUSIVE MODE;
+
+   -- totals, parents and jobs are unchanged, nothing to count or notify
+   ALTER TABLE public.nodes DISABLE TRIGGER USER;
+   ALTER TABLE public.uws_jobs DISABLE TRIGGER USER;
+
+   UPDATE public.nodes SET label = subpath(path, -1)::text;
+   -- the root of a detached subtree gets a label no name encodes to
+   UPDATE public.nodes SET label = '_trash' || replace(id::text, '-', '')
+   WHERE parent_id = '00000000-0000-0000-0000-000000000000';
+
+   UPDATE public.uws_jobs SET node_id = nodes.id FROM public.nodes
+   WHERE nodes.path = uws_jobs.node_path AND nodes.space_id = uws_jobs.space_id;
+
+   ALTER TABLE public.nodes ENABLE TRIGGER USER;
+   ALTER TABLE public.uws_jobs ENABLE TRIGGER USER;
+
+   ALTER TABLE public.nodes DROP CONSTRAINT IF EXISTS node_pk;
+   ALTER TABLE public.nodes DROP CONSTRAINT IF EXISTS nodes_unique;
+   ALTER TABLE public.nodes DROP CONSTRAINT IF EXISTS node_id_unique;
+   ALTER TABLE public.nodes ADD CONSTRAINT node_pk PRIMARY KEY (id);
+   -- path_gist_idx and path_idx go with the column
+   ALTER TABLE public.nodes DROP COLUMN path;
+   END IF;
+END;
+$$;
+
+ALTER TABLE public.nodes DROP COLUMN IF EXISTS path_modified;
+
+ALTER TABLE public.nodes ALTER COLUMN label SET NOT NULL;
+
+ALTER TABLE public.uws_jobs DROP COLUMN IF EXISTS node_path_modified;
+
+CREATE UNIQUE INDEX IF NOT EXISTS node_label_idx ON public.nodes USING btree (space_id, parent_id, label);
+
+CREATE UNIQUE INDEX IF NOT EXISTS root_label_idx ON public.nodes USING btree (space_id, label) WHERE (parent_id IS NULL);
+
+
+CREATE OR REPLACE FUNCTION public.node_walk(node_space bigint, node_path public.ltree) RETURNS TABLE(id uuid, path public.ltree)
+    LANGUAGE sql STABLE
+    AS $$
+-- the nodes along node_path, one label at a time from the root of the space
+WITH RECURSIVE walk AS (
+     SELECT n.id, subltree(node_path, 0, 1) AS path
+     FROM public.nodes n
+     WHERE n.space_id = node_space AND n.parent_id IS NULL AND n.label = subltree(node_path, 0, 1)::text
+     UNION ALL
+     SELECT n.id, subltree(node_path, 0, nlevel(walk.path) + 1)
+     FROM walk JOIN public.nodes n
+     ON n.space_id = node_space AND n.parent_id = walk.id
+     AND n.label = subltree(node_path, nlevel(walk.path), nlevel(walk.path) + 1)::text
+     WHERE nlevel(walk.path) < nlevel(node_path))
+SELECT walk.id, walk.path FROM walk;
+$$;
+
+
+ALTER FUNCTION public.node_walk(node_space bigint, node_path public.ltree) OWNER TO vos_user;
+
+
+CREATE OR REPLACE FUNCTION public.node_path(node_id uuid) RETURNS public.ltree
+    LANGUAGE sql STABLE
+    AS $$
+-- the path of a node, from its label up the parent links to the root of the space
+WITH RECURSIVE up AS (
+     SELECT n.parent_id, text2ltree(n.label) AS path
+     FROM public.nodes n WHERE n.id = node_id
+     UNION ALL
+     SELECT n.parent_id, n.label || up.path
+     FROM up JOIN public.nodes n ON n.id = up.parent_id)
+SELECT up.path FROM up WHERE up.parent_id IS NULL;
+$$;
+
+
+ALTER FUNCTION public.node_path(node_id uuid) OWNER TO vos_user;
+
+
+CREATE OR REPLACE FUNCTION public.node_tree(node_space bigint, node_path public.ltree) RETURNS TABLE(id uuid, path public.ltree)
+    LANGUAGE sql STABLE
+    AS $$
+-- the node at node_path and every node below it
+WITH RECURSIVE tree AS (
+     SELECT walk.id, walk.path
+     FROM public.node_walk(node_space, node_path) walk
+     WHERE walk.path = node_path
+     UNION ALL
+     SELECT n.id, tree.path || n.label
+     FROM tree JOIN public.nodes n
+     ON n.space_id = node_space AND n.parent_id = tree.id)
+SELECT tree.id, tree.path FROM tree;
+$$;
+
+
+ALTER FUNCTION public.node_tree(node_space bigint, node_path public.ltree) OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.update_tree_totals() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   delta_id uuid[];
+   delta_size bigint[];
+   delta_count bigint[];
+BEGIN
+   -- the totals written below are not themselves a change to count
+   IF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+   END IF;
+
+   -- Every change is credited to the parent of the node it happened to
+   -- and carried up the parent links from there.
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(n.parent_id), array_agg(n.size), array_agg(1::bigint)
+   INTO delta_id, delta_size, delta_count
+   FROM new_nodes n
+   WHERE n.parent_id IS NOT NULL;
+   ELSIF TG_OP = 'DELETE' THEN
+   -- the totals of the topmost deleted nodes cover the nodes deleted below them
+   SELECT array_agg(o.parent_id), array_agg(-(o.size + o.tree_size)), array_agg(-(1 + o.tree_count))
+   INTO delta_id, delta_size, delta_count
+   FROM old_nodes o
+   WHERE o.parent_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id);
+   ELSE
+   -- a moved node takes the totals of its subtree from one parent to the other
+   WITH changed AS (
+        SELECT o.parent_id AS old_parent, n.parent_id AS new_parent,
+               o.size AS old_size, n.size AS new_size, n.tree_size, n.tree_count
+        FROM old_nodes o JOIN new_nodes n ON o.id = n.id
+        WHERE o.parent_id IS DISTINCT FROM n.parent_id OR o.size <> n.size),
+   change AS (
+        SELECT old_parent AS id, -(old_size + tree_size) AS size, -(1 + tree_count) AS count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT new_parent, new_size + tree_size, 1 + tree_count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT new_parent, new_size - old_size, 0
+        FROM changed WHERE old_parent IS NOT DISTINCT FROM new_parent)
+   SELECT array_agg(id), array_agg(size), array_agg(count)
+   INTO delta_id, delta_size, delta_count
+   FROM change
+   WHERE id IS NOT NULL;
+   END IF;
+
+   IF delta_id IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   WITH RECURSIVE up AS (
+        SELECT delta.id, sum(delta.size)::bigint AS size, sum(delta.count)::bigint AS count
+        FROM unnest(delta_id, delta_size, delta_count) AS delta(id, size, count)
+        GROUP BY delta.id
+        UNION ALL
+        SELECT nodes.parent_id, up.size, up.count
+        FROM up JOIN public.nodes ON nodes.id = up.id
+        WHERE nodes.parent_id IS NOT NULL),
+   total AS (
+        SELECT up.id, sum(up.size) AS size, sum(up.count) AS count
+        FROM up GROUP BY up.id
+        HAVING sum(up.size) <> 0 OR sum(up.count) <> 0),
+   -- lock the ancestors in id order, the same order in every statement
+   locked AS (
+        SELECT nodes.id, total.size, total.count
+        FROM public.nodes JOIN total ON nodes.id = total.id
+        ORDER BY nodes.id FOR NO KEY UPDATE OF nodes)
+   UPDATE public.nodes SET tree_size = nodes.tree_size + locked.size, tree_count = nodes.tree_count + locked.count
+   FROM locked WHERE nodes.id = locked.id;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.update_tree_totals() OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.node_cache_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   payload text;
+BEGIN
+   -- storage details are joined into every cached row
+   IF TG_TABLE_NAME = 'storage' THEN
+   PERFORM pg_notify('nodes', '{"space_id":null,"paths":null}');
+   RETURN NULL;
+   END IF;
+
+   -- The old path of each changed node. A node that was moved or deleted
+   -- is sent as path.* as every path below it has gone with it.
+   IF TG_OP = 'DELETE' THEN
+   FOR payload IN
+       SELECT json_build_object('space_id', c.space_id, 'paths', json_agg(c.path || '.*'))::text
+       FROM (SELECT o.space_id,
+                    CASE WHEN o.parent_id IS NULL THEN o.label
+                    ELSE public.node_path(o.parent_id)::text || '.' || o.label END AS path
+             FROM old_nodes o
+             WHERE NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id)) AS c
+       WHERE c.path IS NOT NULL
+       GROUP BY c.space_id
+   LOOP
+   -- a notification is limited to 8000 bytes, past that the whole space is dropped
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+   END IF;
+
+   -- too many to be worth resolving, drop the space
+   IF (SELECT count(*) FROM old_nodes) > 200 THEN
+   FOR payload IN
+       SELECT DISTINCT json_build_object('space_id', o.space_id, 'paths', null)::text FROM old_nodes o
+   LOOP
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+   END IF;
+
+   FOR payload IN
+       SELECT json_build_object('space_id', c.space_id, 'paths', json_agg(c.path))::text
+       FROM (SELECT o.space_id,
+                    CASE WHEN o.parent_id IS NULL THEN o.label
+                    ELSE public.node_path(o.parent_id)::text || '.' || o.label END ||
+                    CASE WHEN o.parent_id IS DISTINCT FROM n.parent_id OR o.label <> n.label
+                    THEN '.*' ELSE '' END AS path
+             FROM old_nodes o JOIN new_nodes n ON n.id = o.id) AS c
+       WHERE c.path IS NOT NULL
+       GROUP BY c.space_id
+   LOOP
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.node_cache_notify_trigger() OWNER TO vos_user;
+
+DROP TRIGGER IF EXISTS node_cache_update_trigger ON public.nodes;
+
+CREATE TRIGGER node_cache_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+COMMIT;
@@ -0,0 +1,120 @@
+--
+-- Keep a reference counted summary of the property uris used in each space so
+-- that the contains list of /vospace/properties is read without a node scan.
+--
+
+\connect vospace
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.property_summary (
+    space_id bigint NOT NULL,
+    uri text NOT NULL,
+    refs bigint DEFAULT 0 NOT NULL,
+    CONSTRAINT property_summary_pk PRIMARY KEY (space_id, uri),
+    CONSTRAINT space_fk FOREIGN KEY (space_id) REFERENCES public.space(id) ON UPDATE CASCADE ON DELETE CASCADE
+);
+
+ALTER TABLE public.property_summary OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.update_property_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   delta_space bigint[];
+   delta_uri text[];
+   delta_refs bigint[];
+   spaces bigint[];
+BEGIN
+   -- references to each property uri added or removed by the statement
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(d.space_id), array_agg(d.uri), array_agg(d.refs)
+   INTO delta_space, delta_uri, delta_refs
+   FROM (SELECT n.space_id, p.uri, count(*) AS refs
+         FROM new_nodes n, jsonb_object_keys(n.properties) AS p(uri)
+         GROUP BY n.space_id, p.uri) AS d;
+
+   ELSIF TG_OP = 'DELETE' THEN
+   SELECT array_agg(d.space_id), array_agg(d.uri), array_agg(d.refs)
+   INTO delta_space, delta_uri, delta_refs
+   FROM (SELECT o.space_id, p.uri, -count(*) AS refs
+         FROM old_nodes o, jsonb_object_keys(o.properties) AS p(uri)
+         GROUP BY o.space_id, p.uri) AS d;
+
+   -- the totals written by update_tree_totals leave the properties alone
+   ELSIF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+
+   ELSE
+   SELECT array_agg(d.space_id), array_agg(d.uri), array_agg(d.refs)
+   INTO delta_space, delta_uri, delta_refs
+   FROM (SELECT c.space_id, c.uri, sum(c.refs)::bigint AS refs
+         FROM (SELECT n.space_id, p.uri, 1 AS refs
+               FROM old_nodes o JOIN new_nodes n ON n.id = o.id, jsonb_object_keys(n.properties) AS p(uri)
+               WHERE o.properties <> n.properties
+               UNION ALL
+               SELECT o.space_id, p.uri, -1 AS refs
+               FROM old_nodes o JOIN new_nodes n ON n.id = o.id, jsonb_object_keys(o.properties) AS p(uri)
+               WHERE o.properties <> n.properties) AS c
+         GROUP BY c.space_id, c.uri
+         HAVING sum(c.refs) <> 0) AS d;
+   END IF;
+
+   IF delta_uri IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   -- rows are updated in key order so concurrent statements do not deadlock
+   WITH delta AS (
+        SELECT * FROM unnest(delta_space, delta_uri, delta_refs) AS d(space_id, uri, refs)),
+   upsert AS (
+        INSERT INTO public.property_summary AS s (space_id, uri, refs)
+        SELECT d.space_id, d.uri, d.refs FROM delta d
+        ORDER BY d.space_id, d.uri
+        ON CONFLICT (space_id, uri) DO UPDATE SET refs = s.refs + excluded.refs
+        RETURNING s.space_id, s.uri, s.refs)
+   -- a uri is new when all its references are the ones just added
+   SELECT array_agg(DISTINCT u.space_id) INTO spaces
+   FROM upsert u JOIN delta d ON d.space_id = u.space_id AND d.uri = u.uri
+   WHERE u.refs = d.refs OR u.refs <= 0;
+
+   IF spaces IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   DELETE FROM public.property_summary s
+   USING unnest(delta_space, delta_uri) AS d(space_id, uri)
+   WHERE s.space_id = d.space_id AND s.uri = d.uri AND s.refs <= 0;
+
+   -- the set of uris of these spaces has changed
+   PERFORM pg_notify('properties', space_id::text) FROM unnest(spaces) AS space_id;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.update_property_summary() OWNER TO vos_user;
+
+-- no writes between the count and the triggers
+LOCK TABLE public.nodes IN SHARE ROW EXCLUSIVE MODE;
+
+DELETE FROM public.property_summary;
+
+INSERT INTO public.property_summary (space_id, uri, refs)
+SELECT n.space_id, p.uri, count(*)
+FROM public.nodes n, jsonb_object_keys(n.properties) AS p(uri)
+GROUP BY n.space_id, p.uri;
+
+DROP TRIGGER IF EXISTS property_insert_trigger ON public.nodes;
+
+DROP TRIGGER IF EXISTS property_update_trigger ON public.nodes;
+
+DROP TRIGGER IF EXISTS property_delete_trigger ON public.nodes;
+
+CREATE TRIGGER property_insert_trigger AFTER INSERT ON public.nodes REFERENCING NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+
+CREATE TRIGGER property_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+
+CREATE TRIGGER property_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+
+COMMIT;
@@ -0,0 +1,301 @@
+--
+-- Partition nodes and uws_jobs by space. Every space gets its own heap and
+-- indexes, created by create_space_partitions() when a space or storage
+-- server registers. Apply with the servers stopped, existing rows are copied.
+--
+
+\connect vospace
+
+BEGIN;
+
+-- node_cache_notify_trigger() calls the new node_path(), node_path(uuid)
+-- is only dropped once nothing refers to it
+CREATE OR REPLACE FUNCTION public.delete_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+
+DECLARE
+
+BEGIN
+-- fired on the partitions of uws_jobs, TG_TABLE_NAME is the name of the partition
+PERFORM
+pg_notify('uws_jobs', '{"action":"' || TG_OP || '","table":"uws_jobs","row":' || row_to_json(OLD) || '}');
+RETURN OLD;
+END;
+$$;
+
+ALTER FUNCTION public.delete_notify_trigger() OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.insert_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$DECLARE
+
+BEGIN
+IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.phase <> OLD.phase) THEN
+PERFORM
+pg_notify('uws_jobs', '{"action":"' || TG_OP || '","table":"uws_jobs","row":' || row_to_json(NEW) || '}');
+RETURN NEW;
+END IF;
+RETURN NULL;
+END;
+
+$$;
+
+ALTER FUNCTION public.insert_notify_trigger() OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.create_space_partitions(space bigint) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+BEGIN
+   -- every space has its own partition of nodes and uws_jobs
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.nodes FOR VALUES IN (%s)',
+                  'nodes_' || space, space);
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.uws_jobs FOR VALUES IN (%s)',
+                  'uws_jobs_' || space, space);
+
+   -- before row triggers are only defined on partitioned tables from PostgreSQL 13
+   IF NOT EXISTS (SELECT 1 FROM pg_catalog.pg_trigger
+                  WHERE tgrelid = format('public.%I', 'nodes_' || space)::regclass
+                  AND tgname = 'node_modified_trigger') THEN
+   EXECUTE format('CREATE TRIGGER node_modified_trigger BEFORE UPDATE OF size, storage_id ON public.%I '
+                  'FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column()', 'nodes_' || space);
+   END IF;
+END;
+$$;
+
+ALTER FUNCTION public.create_space_partitions(space bigint) OWNER TO vos_user;
+
+DROP FUNCTION IF EXISTS public.node_path(uuid);
+
+CREATE OR REPLACE FUNCTION public.node_path(node_space bigint, node_id uuid) RETURNS public.ltree
+    LANGUAGE sql STABLE
+    AS $$
+-- the path of a node, from its label up the parent links to the root of the space
+WITH RECURSIVE up AS (
+     SELECT n.parent_id, text2ltree(n.label) AS path
+     FROM public.nodes n WHERE n.space_id = node_space AND n.id = node_id
+     UNION ALL
+     SELECT n.parent_id, n.label || up.path
+     FROM up JOIN public.nodes n ON n.space_id = node_space AND n.id = up.parent_id)
+SELECT up.path FROM up WHERE up.parent_id IS NULL;
+$$;
+
+ALTER FUNCTION public.node_path(node_space bigint, node_id uuid) OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.node_cache_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   payload text;
+BEGIN
+   -- storage details are joined into every cached row
+   IF TG_TABLE_NAME = 'storage' THEN
+   PERFORM pg_notify('nodes', '{"space_id":null,"paths":null}');
+   RETURN NULL;
+   END IF;
+
+   -- The old path of each changed node. A node that was moved or deleted
+   -- is sent as path.* as every path below it has gone with it.
+   IF TG_OP = 'DELETE' THEN
+   FOR payload IN
+       SELECT json_build_object('space_id', c.space_id, 'paths', json_agg(c.path || '.*'))::text
+       FROM (SELECT o.space_id,
+                    CASE WHEN o.parent_id IS NULL THEN o.label
+                    ELSE public.node_path(o.space_id, o.parent_id)::text || '.' || o.label END AS path
+             FROM old_nodes o
+             WHERE NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id)) AS c
+       WHERE c.path IS NOT NULL
+       GROUP BY c.space_id
+   LOOP
+   -- a notification is limited to 8000 bytes, past that the whole space is dropped
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+   END IF;
+
+   -- too many to be worth resolving, drop the space
+   IF (SELECT count(*) FROM old_nodes) > 200 THEN
+   FOR payload IN
+       SELECT DISTINCT json_build_object('space_id', o.space_id, 'paths', null)::text FROM old_nodes o
+   LOOP
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+   END IF;
+
+   FOR payload IN
+       SELECT json_build_object('space_id', c.space_id, 'paths', json_agg(c.path))::text
+       FROM (SELECT o.space_id,
+                    CASE WHEN o.parent_id IS NULL THEN o.label
+                    ELSE public.node_path(o.space_id, o.parent_id)::text || '.' || o.label END ||
+                    CASE WHEN o.parent_id IS DISTINCT FROM n.parent_id OR o.label <> n.label
+                    THEN '.*' ELSE '' END AS path
+             FROM old_nodes o JOIN new_nodes n ON n.id = o.id) AS c
+       WHERE c.path IS NOT NULL
+       GROUP BY c.space_id
+   LOOP
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+END;
+$$;
+
+ALTER FUNCTION public.node_cache_notify_trigger() OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.update_tree_totals() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   delta_space bigint[];
+   delta_id uuid[];
+   delta_size bigint[];
+   delta_count bigint[];
+BEGIN
+   -- the totals written below are not themselves a change to count
+   IF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+   END IF;
+
+   -- Every change is credited to the parent of the node it happened to
+   -- and carried up the parent links from there.
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(n.space_id), array_agg(n.parent_id), array_agg(n.size), array_agg(1::bigint)
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM new_nodes n
+   WHERE n.parent_id IS NOT NULL;
+   ELSIF TG_OP = 'DELETE' THEN
+   -- the totals of the topmost deleted nodes cover the nodes deleted below them
+   SELECT array_agg(o.space_id), array_agg(o.parent_id), array_agg(-(o.size + o.tree_size)),
+          array_agg(-(1 + o.tree_count))
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM old_nodes o
+   WHERE o.parent_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id);
+   ELSE
+   -- a moved node takes the totals of its subtree from one parent to the other
+   WITH changed AS (
+        SELECT n.space_id, o.parent_id AS old_parent, n.parent_id AS new_parent,
+               o.size AS old_size, n.size AS new_size, n.tree_size, n.tree_count
+        FROM old_nodes o JOIN new_nodes n ON o.id = n.id
+        WHERE o.parent_id IS DISTINCT FROM n.parent_id OR o.size <> n.size),
+   change AS (
+        SELECT space_id, old_parent AS id, -(old_size + tree_size) AS size, -(1 + tree_count) AS count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT space_id, new_parent, new_size + tree_size, 1 + tree_count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT space_id, new_parent, new_size - old_size, 0
+        FROM changed WHERE old_parent IS NOT DISTINCT FROM new_parent)
+   SELECT array_agg(space_id), array_agg(id), array_agg(size), array_agg(count)
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM change
+   WHERE id IS NOT NULL;
+   END IF;
+
+   IF delta_id IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   WITH RECURSIVE up AS (
+        SELECT delta.space_id, delta.id, sum(delta.size)::bigint AS size, sum(delta.count)::bigint AS count
+        FROM unnest(delta_space, delta_id, delta_size, delta_count) AS delta(space_id, id, size, count)
+        GROUP BY delta.space_id, delta.id
+        UNION ALL
+        SELECT nodes.space_id, nodes.parent_id, up.size, up.count
+        FROM up JOIN public.nodes ON nodes.space_id = up.space_id AND nodes.id = up.id
+        WHERE nodes.parent_id IS NOT NULL),
+   total AS (
+        SELECT up.space_id, up.id, sum(up.size) AS size, sum(up.count) AS count
+        FROM up GROUP BY up.space_id, up.id
+        HAVING sum(up.size) <> 0 OR sum(up.count) <> 0),
+   -- lock the ancestors in id order, the same order in every statement
+   locked AS (
+        SELECT nodes.space_id, nodes.id, total.size, total.count
+        FROM public.nodes JOIN total ON nodes.space_id = total.space_id AND nodes.id = total.id
+        ORDER BY nodes.id FOR NO KEY UPDATE OF nodes)
+   UPDATE public.nodes SET tree_size = nodes.tree_size + locked.size, tree_count = nodes.tree_count + locked.count
+   FROM locked WHERE nodes.space_id = locked.space_id AND nodes.id = locked.id;
+   RETURN NULL;
+END;
+$$;
+
+ALTER FUNCTION public.update_tree_totals() OWNER TO vos_user;
+
+DO $$
+DECLARE
+   space bigint;
+BEGIN
+   IF (SELECT c.relkind FROM pg_catalog.pg_class c WHERE c.oid = 'public.nodes'::regclass) = 'r' THEN
+   ALTER TABLE public.nodes RENAME TO nodes_unpartitioned;
+   ALTER TABLE public.uws_jobs RENAME TO uws_jobs_unpartitioned;
+
+   CREATE TABLE public.nodes (LIKE public.nodes_unpartitioned INCLUDING DEFAULTS) PARTITION BY LIST (space_id);
+   ALTER TABLE public.nodes OWNER TO vos_user;
+   CREATE TABLE public.uws_jobs (LIKE public.uws_jobs_unpartitioned INCLUDING DEFAULTS) PARTITION BY LIST (space_id);
+   ALTER TABLE public.uws_jobs OWNER TO vos_user;
+
+   FOR space IN SELECT id FROM public.space
+                UNION SELECT DISTINCT space_id FROM public.nodes_unpartitioned
+                UNION SELECT DISTINCT space_id FROM public.uws_jobs_unpartitioned
+   LOOP
+   PERFORM public.create_space_partitions(space);
+   END LOOP;
+
+   -- the triggers are created once the rows are in, the totals and summaries are already right
+   INSERT INTO public.nodes SELECT * FROM public.nodes_unpartitioned;
+   INSERT INTO public.uws_jobs SELECT * FROM public.uws_jobs_unpartitioned;
+   DROP TABLE public.nodes_unpartitioned;
+   DROP TABLE public.uws_jobs_unpartitioned;
+
+   ALTER TABLE public.nodes ADD CONSTRAINT node_pk PRIMARY KEY (space_id, id);
+   CREATE UNIQUE INDEX node_label_idx ON public.nodes USING btree (space_id, parent_id, label);
+   CREATE UNIQUE INDEX root_label_idx ON public.nodes USING btree (space_id, label) WHERE (parent_id IS NULL);
+   CREATE INDEX parent_idx ON public.nodes USING btree (space_id, parent_id, name);
+   CREATE INDEX parent_modified_idx ON public.nodes USING btree (space_id, parent_id, modified, name);
+   CREATE INDEX parent_size_idx ON public.nodes USING btree (space_id, parent_id, size, name);
+   CREATE INDEX properties_idx ON public.nodes USING gin (properties);
+   ALTER TABLE public.nodes ADD CONSTRAINT space_fk FOREIGN KEY (space_id)
+   REFERENCES public.space(id) ON UPDATE SET NULL ON DELETE SET NULL;
+   ALTER TABLE public.nodes ADD CONSTRAINT storage_fk FOREIGN KEY (storage_id) REFERENCES public.storage(id);
+
+   CREATE TRIGGER tree_insert_trigger AFTER INSERT ON public.nodes REFERENCING NEW TABLE AS new_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+   CREATE TRIGGER tree_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+   CREATE TRIGGER tree_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+   CREATE TRIGGER property_insert_trigger AFTER INSERT ON public.nodes REFERENCING NEW TABLE AS new_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+   CREATE TRIGGER property_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+   CREATE TRIGGER property_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+   CREATE TRIGGER node_cache_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+   CREATE TRIGGER node_cache_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes
+   FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+   ALTER TABLE public.uws_jobs ADD CONSTRAINT job_id_pk PRIMARY KEY (space_id, id);
+   CREATE INDEX owner_idx ON public.uws_jobs USING btree (owner bpchar_pattern_ops);
+   CREATE INDEX phase_idx ON public.uws_jobs USING btree (phase);
+   ALTER TABLE public.uws_jobs ADD CONSTRAINT space_fk FOREIGN KEY (space_id)
+   REFERENCES public.space(id) ON UPDATE CASCADE ON DELETE CASCADE;
+
+   CREATE TRIGGER delete_trigger AFTER DELETE ON public.uws_jobs
+   FOR EACH ROW EXECUTE PROCEDURE public.delete_notify_trigger();
+   CREATE TRIGGER insert_trigger AFTER INSERT OR UPDATE ON public.uws_jobs
+   FOR EACH ROW EXECUTE PROCEDURE public.insert_notify_trigger();
+   CREATE TRIGGER update_trigger AFTER UPDATE ON public.uws_jobs
+   FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column();
+   END IF;
+END;
+$$;
+
+COMMIT;
@@ -0,0 +1,145 @@
+--
+-- Partition the jobs of each space by the day they are created on, so that
+-- the reaper drops days of expired jobs instead of deleting them row by row.
+-- Apply with the servers stopped, the jobs of each space are copied.
+--
+
+\connect vospace
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.uuid_generate_v7() RETURNS uuid
+    LANGUAGE sql
+    AS $$
+-- unix time in milliseconds followed by random bits, the ids of a day fall in one range
+SELECT encode(set_bit(set_bit(overlay(uuid_send(public.uuid_generate_v4())
+              PLACING substring(int8send(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint) FROM 3)
+              FROM 1 FOR 6), 52, 1), 53, 1), 'hex')::uuid;
+$$;
+
+ALTER FUNCTION public.uuid_generate_v7() OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.job_id_bound(day date) RETURNS uuid
+    LANGUAGE sql IMMUTABLE
+    AS $$
+-- lowest uuid_generate_v7() id of a day (utc)
+SELECT encode(substring(int8send(extract(epoch FROM day::timestamp)::bigint * 1000) FROM 3)
+              || '\x00000000000000000000'::bytea, 'hex')::uuid;
+$$;
+
+ALTER FUNCTION public.job_id_bound(day date) OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.create_job_partitions(space bigint, days integer) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+DECLARE
+   day date;
+   part text;
+BEGIN
+   -- one partition per day from today (utc), jobs outside of them go to the default partition
+   FOR day IN SELECT generate_series(timezone('utc', now())::date,
+                                     timezone('utc', now())::date + days, '1 day')::date
+   LOOP
+   part := 'uws_jobs_' || space || '_' || to_char(day, 'YYYYMMDD');
+   IF to_regclass(format('public.%I', part)) IS NULL THEN
+   BEGIN
+   EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+                  part, 'uws_jobs_' || space, public.job_id_bound(day), public.job_id_bound(day + 1));
+   EXCEPTION WHEN lock_not_available THEN
+   -- uws_jobs is busy, created on the next call
+   END;
+   END IF;
+   END LOOP;
+END;
+$$;
+
+ALTER FUNCTION public.create_job_partitions(space bigint, days integer) OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.drop_job_partitions(space bigint) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+DECLARE
+   part text;
+   live boolean;
+   dropped integer := 0;
+BEGIN
+   -- a day before today is dropped whole once none of its jobs is live
+   FOR part IN SELECT c.relname FROM pg_catalog.pg_inherits i
+               JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = format('public.%I', 'uws_jobs_' || space)::regclass
+               AND c.relname <> 'uws_jobs_' || space || '_default'
+               AND c.relname < 'uws_jobs_' || space || '_' || to_char(timezone('utc', now()), 'YYYYMMDD')
+   LOOP
+   EXECUTE format('SELECT EXISTS (SELECT 1 FROM public.%I WHERE destruction >= $1 OR phase = ANY($2))', part)
+   INTO live USING timezone('utc', now()), ARRAY[1, 2];
+   IF NOT live THEN
+   BEGIN
+   EXECUTE format('DROP TABLE public.%I', part);
+   dropped := dropped + 1;
+   EXCEPTION WHEN lock_not_available THEN
+   -- jobs of the day are being read, dropped on the next call
+   END;
+   END IF;
+   END LOOP;
+   RETURN dropped;
+END;
+$$;
+
+ALTER FUNCTION public.drop_job_partitions(space bigint) OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.create_space_partitions(space bigint) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+BEGIN
+   -- every space has its own partition of nodes and uws_jobs
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.nodes FOR VALUES IN (%s)',
+                  'nodes_' || space, space);
+   -- jobs are further partitioned by the day they are created on, see create_job_partitions()
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.uws_jobs FOR VALUES IN (%s) '
+                  'PARTITION BY RANGE (id)', 'uws_jobs_' || space, space);
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.%I DEFAULT',
+                  'uws_jobs_' || space || '_default', 'uws_jobs_' || space);
+   PERFORM public.create_job_partitions(space, 1);
+
+   -- before row triggers are only defined on partitioned tables from PostgreSQL 13
+   IF NOT EXISTS (SELECT 1 FROM pg_catalog.pg_trigger
+                  WHERE tgrelid = format('public.%I', 'nodes_' || space)::regclass
+                  AND tgname = 'node_modified_trigger') THEN
+   EXECUTE format('CREATE TRIGGER node_modified_trigger BEFORE UPDATE OF size, storage_id ON public.%I '
+                  'FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column()', 'nodes_' || space);
+   END IF;
+END;
+$$;
+
+ALTER FUNCTION public.create_space_partitions(space bigint) OWNER TO vos_user;
+
+ALTER TABLE public.uws_jobs ALTER COLUMN id SET DEFAULT public.uuid_generate_v7();
+
+CREATE INDEX IF NOT EXISTS destruction_idx ON public.uws_jobs USING btree (destruction);
+
+DO $$
+DECLARE
+   spaces bigint[];
+   space bigint;
+   part text;
+BEGIN
+   -- read up front, a loop over a query on uws_jobs would keep its partitions open
+   spaces := array(SELECT id FROM public.space UNION SELECT DISTINCT space_id FROM public.uws_jobs);
+   FOREACH space IN ARRAY spaces
+   LOOP
+   part := 'uws_jobs_' || space;
+   IF (SELECT c.relkind FROM pg_catalog.pg_class c WHERE c.oid = to_regclass(format('public.%I', part))) = 'r' THEN
+   EXECUTE format('CREATE TEMP TABLE uws_jobs_copy AS SELECT * FROM public.%I', part);
+   EXECUTE format('DROP TABLE public.%I', part);
+   PERFORM public.create_space_partitions(space);
+   -- legacy ids are random, their jobs end up in the default partition
+   INSERT INTO public.uws_jobs SELECT * FROM uws_jobs_copy;
+   DROP TABLE uws_jobs_copy;
+   ELSE
+   PERFORM public.create_space_partitions(space);
+   END IF;
+   END LOOP;
+END;
+$$;
+
+COMMIT;
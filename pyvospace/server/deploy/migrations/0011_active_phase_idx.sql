@@ -0,0 +1,15 @@
+--
+-- Index only the jobs that are still to run or running. Almost every job is
+-- COMPLETED, ERROR or ABORTED and no query looks them up by phase.
+--
+
+\connect vospace
+
+BEGIN;
+
+DROP INDEX IF EXISTS public.phase_idx;
+
+CREATE INDEX IF NOT EXISTS active_phase_idx ON public.uws_jobs USING btree (phase)
+WHERE (phase = ANY (ARRAY[0, 1, 2, 7, 8]));
+
+COMMIT;
@@ -0,0 +1,121 @@
+--
+-- Hierarchical intent locks on paths, a writer of a subtree no longer row locks
+-- all of it. lock_path takes IS, IX, S or X transaction advisory locks on a path
+-- and intent locks on its ancestors.
+--
+
+\connect vospace
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.lock_path_key(space bigint, prefix text, kind text) RETURNS bigint
+    LANGUAGE sql IMMUTABLE
+    AS $$
+SELECT hashtextextended(space || '/' || prefix || '/' || kind, 0);
+$$;
+
+
+ALTER FUNCTION public.lock_path_key(space bigint, prefix text, kind text) OWNER TO vos_user;
+
+--
+-- Name: lock_path(bigint, public.ltree, text, boolean); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE OR REPLACE FUNCTION public.lock_path(space bigint, path public.ltree, mode text, nowait boolean) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   level integer;
+   prefix text;
+   node_mode text;
+   intent_key bigint;
+   write_key bigint;
+   read_key bigint;
+   acquired boolean;
+BEGIN
+   -- Hierarchical intent lock on a path until the end of the transaction, modes IS, IX, S and X.
+   -- The ancestors are intent locked from the root down then the path itself in mode.
+   -- Every mode but X shares the intent key of a path, X holds it exclusively. IX holders
+   -- share its write key and S holders its read key. Each waits for the other kind to be
+   -- gone by taking the key of the other exclusively for a moment, the write key first.
+   IF mode NOT IN ('IS', 'IX', 'S', 'X') THEN
+   RAISE EXCEPTION 'invalid lock mode %', mode;
+   END IF;
+   FOR level IN 1..nlevel(path) LOOP
+   prefix := subpath(path, 0, level)::text;
+   IF level < nlevel(path) THEN
+   node_mode := CASE WHEN mode IN ('IS', 'S') THEN 'IS' ELSE 'IX' END;
+   ELSE
+   node_mode := mode;
+   END IF;
+   intent_key := public.lock_path_key(space, prefix, 'i');
+   write_key := public.lock_path_key(space, prefix, 'w');
+   read_key := public.lock_path_key(space, prefix, 'r');
+
+   IF node_mode = 'X' THEN
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock(intent_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock(intent_key);
+   acquired := true;
+   END IF;
+   ELSE
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock_shared(intent_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock_shared(intent_key);
+   acquired := true;
+   END IF;
+   END IF;
+
+   IF acquired AND node_mode = 'IX' THEN
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock_shared(write_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock_shared(write_key);
+   END IF;
+   IF acquired THEN
+   -- wait for the readers of the subtree
+   IF nowait THEN
+   acquired := pg_try_advisory_lock(read_key);
+   ELSE
+   PERFORM pg_advisory_lock(read_key);
+   END IF;
+   IF acquired THEN
+   PERFORM pg_advisory_unlock(read_key);
+   END IF;
+   END IF;
+   ELSIF acquired AND node_mode = 'S' THEN
+   -- wait for the writers of the subtree, new ones wait until the read key is held
+   IF nowait THEN
+   acquired := pg_try_advisory_lock(write_key);
+   ELSE
+   PERFORM pg_advisory_lock(write_key);
+   END IF;
+   IF acquired THEN
+   BEGIN
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock_shared(read_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock_shared(read_key);
+   END IF;
+   EXCEPTION WHEN OTHERS THEN
+   PERFORM pg_advisory_unlock(write_key);
+   RAISE;
+   END;
+   PERFORM pg_advisory_unlock(write_key);
+   END IF;
+   END IF;
+
+   IF NOT acquired THEN
+   RAISE EXCEPTION 'could not obtain % lock on path %', node_mode, prefix
+   USING ERRCODE = 'lock_not_available';
+   END IF;
+   END LOOP;
+END;
+$$;
+
+
+ALTER FUNCTION public.lock_path(space bigint, path public.ltree, mode text, nowait boolean) OWNER TO vos_user;
+
+COMMIT;
@@ -0,0 +1,12 @@
+--
+-- Priority a job is scheduled at, 0 for a synchronous transfer a client is
+-- waiting on and 1 for everything else.
+--
+
+\connect vospace
+
+BEGIN;
+
+ALTER TABLE public.uws_jobs ADD COLUMN IF NOT EXISTS priority integer DEFAULT 1 NOT NULL;
+
+COMMIT;
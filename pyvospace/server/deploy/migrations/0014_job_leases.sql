@@ -0,0 +1,14 @@
+--
+-- Jobs claimed by a worker, posix_worker or ngas_worker, and the time its
+-- lease on them runs out. A QUEUED job without a worker is free to claim.
+--
+
+\connect vospace
+
+BEGIN;
+
+ALTER TABLE public.uws_jobs ADD COLUMN IF NOT EXISTS worker text;
+
+ALTER TABLE public.uws_jobs ADD COLUMN IF NOT EXISTS lease_expires timestamp without time zone;
+
+COMMIT;
@@ -0,0 +1,45 @@
+--
+-- Notify the changes of the jobs of a space on a channel of its own,
+-- uws_jobs_<space id>, with only the id, space_id, phase and owner of the job
+-- rather than the whole row with its xml. The space and storage servers have
+-- to be restarted along with this migration to listen on the new channels.
+--
+
+\connect vospace
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION public.delete_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+
+DECLARE
+
+BEGIN
+-- fired on the partitions of uws_jobs, each space notifies on its own channel
+PERFORM
+pg_notify('uws_jobs_' || OLD.space_id,
+          json_build_object('action', TG_OP, 'id', OLD.id, 'space_id', OLD.space_id,
+                            'phase', OLD.phase, 'owner', OLD.owner)::text);
+RETURN OLD;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.insert_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$DECLARE
+
+BEGIN
+IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.phase <> OLD.phase) THEN
+PERFORM
+pg_notify('uws_jobs_' || NEW.space_id,
+          json_build_object('action', TG_OP, 'id', NEW.id, 'space_id', NEW.space_id,
+                            'phase', NEW.phase, 'owner', NEW.owner)::text);
+RETURN NEW;
+END IF;
+RETURN NULL;
+END;
+
+$$;
+
+COMMIT;
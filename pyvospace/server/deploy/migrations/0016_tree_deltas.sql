@@ -0,0 +1,150 @@
+--
+-- Writes no longer lock the rows of all the ancestors of a node to update
+-- their totals. The changes are appended to tree_deltas, added to the totals
+-- read, and folded into the rows of nodes in the background by fold_tree_deltas.
+--
+
+\connect vospace
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS public.tree_deltas (
+    space_id bigint NOT NULL,
+    id uuid NOT NULL,
+    size bigint NOT NULL,
+    count bigint NOT NULL
+);
+
+ALTER TABLE public.tree_deltas OWNER TO vos_user;
+
+CREATE INDEX IF NOT EXISTS tree_deltas_idx ON public.tree_deltas USING btree (space_id, id);
+
+CREATE OR REPLACE FUNCTION public.tree_delta(space bigint, node uuid, OUT size bigint, OUT count bigint) RETURNS record
+    LANGUAGE sql STABLE
+    AS $$
+-- the change to the totals of a node not yet folded into its row
+SELECT coalesce(sum(d.size), 0)::bigint, coalesce(sum(d.count), 0)::bigint
+FROM public.tree_deltas d WHERE d.space_id = space AND d.id = node;
+$$;
+
+
+ALTER FUNCTION public.tree_delta(space bigint, node uuid, OUT size bigint, OUT count bigint) OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.update_tree_totals() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   delta_space bigint[];
+   delta_id uuid[];
+   delta_size bigint[];
+   delta_count bigint[];
+BEGIN
+   -- the totals written below are not themselves a change to count
+   IF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+   END IF;
+
+   -- Every change is credited to the parent of the node it happened to
+   -- and carried up the parent links from there.
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(n.space_id), array_agg(n.parent_id), array_agg(n.size), array_agg(1::bigint)
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM new_nodes n
+   WHERE n.parent_id IS NOT NULL;
+   ELSIF TG_OP = 'DELETE' THEN
+   -- the totals of the topmost deleted nodes cover the nodes deleted below them
+   SELECT array_agg(o.space_id), array_agg(o.parent_id), array_agg(-(o.size + o.tree_size + pending.size)),
+          array_agg(-(1 + o.tree_count + pending.count))
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM old_nodes o, public.tree_delta(o.space_id, o.id) pending
+   WHERE o.parent_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id);
+   ELSE
+   -- a moved node takes the totals of its subtree from one parent to the other
+   WITH changed AS (
+        SELECT n.space_id, o.parent_id AS old_parent, n.parent_id AS new_parent,
+               o.size AS old_size, n.size AS new_size,
+               n.tree_size + pending.size AS tree_size, n.tree_count + pending.count AS tree_count
+        FROM old_nodes o JOIN new_nodes n ON o.id = n.id, public.tree_delta(n.space_id, n.id) pending
+        WHERE o.parent_id IS DISTINCT FROM n.parent_id OR o.size <> n.size),
+   change AS (
+        SELECT space_id, old_parent AS id, -(old_size + tree_size) AS size, -(1 + tree_count) AS count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT space_id, new_parent, new_size + tree_size, 1 + tree_count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT space_id, new_parent, new_size - old_size, 0
+        FROM changed WHERE old_parent IS NOT DISTINCT FROM new_parent)
+   SELECT array_agg(space_id), array_agg(id), array_agg(size), array_agg(count)
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM change
+   WHERE id IS NOT NULL;
+   END IF;
+
+   IF delta_id IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   -- The ancestors are not updated here, that would serialise every write
+   -- under a container on its row. Their deltas are appended to tree_deltas
+   -- and added to the rows later by fold_tree_deltas.
+   WITH RECURSIVE up AS (
+        SELECT delta.space_id, delta.id, sum(delta.size)::bigint AS size, sum(delta.count)::bigint AS count
+        FROM unnest(delta_space, delta_id, delta_size, delta_count) AS delta(space_id, id, size, count)
+        GROUP BY delta.space_id, delta.id
+        UNION ALL
+        SELECT nodes.space_id, nodes.parent_id, up.size, up.count
+        FROM up JOIN public.nodes ON nodes.space_id = up.space_id AND nodes.id = up.id
+        WHERE nodes.parent_id IS NOT NULL)
+   INSERT INTO public.tree_deltas (space_id, id, size, count)
+   SELECT up.space_id, up.id, sum(up.size), sum(up.count)
+   FROM up GROUP BY up.space_id, up.id
+   HAVING sum(up.size) <> 0 OR sum(up.count) <> 0;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.update_tree_totals() OWNER TO vos_user;
+
+CREATE OR REPLACE FUNCTION public.fold_tree_deltas(space bigint, batch integer) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   folded integer;
+BEGIN
+   -- Add the deltas of up to batch nodes to their totals. The rows of nodes
+   -- locked by a writer are skipped and left for a later run.
+   WITH pending AS (
+        SELECT DISTINCT d.id FROM public.tree_deltas d WHERE d.space_id = space LIMIT batch),
+   locked AS (
+        SELECT nodes.id FROM public.nodes JOIN pending ON nodes.id = pending.id
+        WHERE nodes.space_id = space
+        ORDER BY nodes.id FOR NO KEY UPDATE OF nodes SKIP LOCKED),
+   deleted AS (
+        DELETE FROM public.tree_deltas d USING locked
+        WHERE d.space_id = space AND d.id = locked.id
+        RETURNING d.id, d.size, d.count),
+   total AS (
+        SELECT deleted.id, sum(deleted.size) AS size, sum(deleted.count) AS count
+        FROM deleted GROUP BY deleted.id)
+   UPDATE public.nodes SET tree_size = nodes.tree_size + total.size, tree_count = nodes.tree_count + total.count
+   FROM total WHERE nodes.space_id = space AND nodes.id = total.id;
+   GET DIAGNOSTICS folded = ROW_COUNT;
+
+   -- the deltas of nodes that have been deleted since
+   DELETE FROM public.tree_deltas d
+   WHERE d.ctid = ANY (ARRAY(SELECT o.ctid FROM public.tree_deltas o
+                             WHERE o.space_id = space
+                             AND NOT EXISTS (SELECT 1 FROM public.nodes
+                                             WHERE nodes.space_id = space AND nodes.id = o.id)
+                             LIMIT batch));
+   RETURN folded;
+END;
+$$;
+
+
+ALTER FUNCTION public.fold_tree_deltas(space bigint, batch integer) OWNER TO vos_user;
+
+COMMIT;
@@ -82,8 +82,11 @@ CREATE FUNCTION public.delete_notify_trigger() RETURNS trigger
 DECLARE
 
 BEGIN
+-- fired on the partitions of uws_jobs, each space notifies on its own channel
 PERFORM
-pg_notify(TG_TABLE_NAME, '{"action":"' || TG_OP || '","table":"' || TG_TABLE_NAME || '","row":' || row_to_json(OLD) || '}');
+pg_notify('uws_jobs_' || OLD.space_id,
+          json_build_object('action', TG_OP, 'id', OLD.id, 'space_id', OLD.space_id,
+                            'phase', OLD.phase, 'owner', OLD.owner)::text);
 RETURN OLD;
 END;
 $$;
@@ -103,7 +106,9 @@ CREATE FUNCTION public.insert_notify_trigger() RETURNS trigger
 BEGIN
 IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.phase <> OLD.phase) THEN
 PERFORM
-pg_notify(TG_TABLE_NAME, '{"action":"' || TG_OP || '","table":"' || TG_TABLE_NAME || '","row":' || row_to_json(NEW) || '}');
+pg_notify('uws_jobs_' || NEW.space_id,
+          json_build_object('action', TG_OP, 'id', NEW.id, 'space_id', NEW.space_id,
+                            'phase', NEW.phase, 'owner', NEW.owner)::text);
 RETURN NEW;
 END IF;
 RETURN NULL;
@@ -114,6 +119,77 @@ $$;
 
 ALTER FUNCTION public.insert_notify_trigger() OWNER TO vos_user;
 
+--
+-- Name: node_cache_notify_trigger(); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.node_cache_notify_trigger() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   payload text;
+BEGIN
+   -- storage details are joined into every cached row
+   IF TG_TABLE_NAME = 'storage' THEN
+   PERFORM pg_notify('nodes', '{"space_id":null,"paths":null}');
+   RETURN NULL;
+   END IF;
+
+   -- The old path of each changed node. A node that was moved or deleted
+   -- is sent as path.* as every path below it has gone with it.
+   IF TG_OP = 'DELETE' THEN
+   FOR payload IN
+       SELECT json_build_object('space_id', c.space_id, 'paths', json_agg(c.path || '.*'))::text
+       FROM (SELECT o.space_id,
+                    CASE WHEN o.parent_id IS NULL THEN o.label
+                    ELSE public.node_path(o.space_id, o.parent_id)::text || '.' || o.label END AS path
+             FROM old_nodes o
+             WHERE NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id)) AS c
+       WHERE c.path IS NOT NULL
+       GROUP BY c.space_id
+   LOOP
+   -- a notification is limited to 8000 bytes, past that the whole space is dropped
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+   END IF;
+
+   -- too many to be worth resolving, drop the space
+   IF (SELECT count(*) FROM old_nodes) > 200 THEN
+   FOR payload IN
+       SELECT DISTINCT json_build_object('space_id', o.space_id, 'paths', null)::text FROM old_nodes o
+   LOOP
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+   END IF;
+
+   FOR payload IN
+       SELECT json_build_object('space_id', c.space_id, 'paths', json_agg(c.path))::text
+       FROM (SELECT o.space_id,
+                    CASE WHEN o.parent_id IS NULL THEN o.label
+                    ELSE public.node_path(o.space_id, o.parent_id)::text || '.' || o.label END ||
+                    CASE WHEN o.parent_id IS DISTINCT FROM n.parent_id OR o.label <> n.label
+                    THEN '.*' ELSE '' END AS path
+             FROM old_nodes o JOIN new_nodes n ON n.id = o.id) AS c
+       WHERE c.path IS NOT NULL
+       GROUP BY c.space_id
+   LOOP
+   IF octet_length(payload) > 7900 THEN
+   payload := json_build_object('space_id', (payload::json)->'space_id', 'paths', null)::text;
+   END IF;
+   PERFORM pg_notify('nodes', payload);
+   END LOOP;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.node_cache_notify_trigger() OWNER TO vos_user;
+
 --
 -- TOC entry 300 (class 1255 OID 16574)
 -- Name: update_modified_column(); Type: FUNCTION; Schema: public; Owner: vos_user
@@ -132,23 +208,536 @@ $$;
 ALTER FUNCTION public.update_modified_column() OWNER TO vos_user;
 
 --
--- TOC entry 301 (class 1255 OID 16575)
--- Name: update_path_modified_column(); Type: FUNCTION; Schema: public; Owner: vos_user
+-- Name: uuid_generate_v7(); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.uuid_generate_v7() RETURNS uuid
+    LANGUAGE sql
+    AS $$
+-- unix time in milliseconds followed by random bits, the ids of a day fall in one range
+SELECT encode(set_bit(set_bit(overlay(uuid_send(public.uuid_generate_v4())
+              PLACING substring(int8send(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint) FROM 3)
+              FROM 1 FOR 6), 52, 1), 53, 1), 'hex')::uuid;
+$$;
+
+
+ALTER FUNCTION public.uuid_generate_v7() OWNER TO vos_user;
+
+--
+-- Name: job_id_bound(date); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.job_id_bound(day date) RETURNS uuid
+    LANGUAGE sql IMMUTABLE
+    AS $$
+-- lowest uuid_generate_v7() id of a day (utc)
+SELECT encode(substring(int8send(extract(epoch FROM day::timestamp)::bigint * 1000) FROM 3)
+              || '\x00000000000000000000'::bytea, 'hex')::uuid;
+$$;
+
+
+ALTER FUNCTION public.job_id_bound(day date) OWNER TO vos_user;
+
+--
+-- Name: create_job_partitions(bigint, integer); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.create_job_partitions(space bigint, days integer) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+DECLARE
+   day date;
+   part text;
+BEGIN
+   -- one partition per day from today (utc), jobs outside of them go to the default partition
+   FOR day IN SELECT generate_series(timezone('utc', now())::date,
+                                     timezone('utc', now())::date + days, '1 day')::date
+   LOOP
+   part := 'uws_jobs_' || space || '_' || to_char(day, 'YYYYMMDD');
+   IF to_regclass(format('public.%I', part)) IS NULL THEN
+   BEGIN
+   EXECUTE format('CREATE TABLE public.%I PARTITION OF public.%I FOR VALUES FROM (%L) TO (%L)',
+                  part, 'uws_jobs_' || space, public.job_id_bound(day), public.job_id_bound(day + 1));
+   EXCEPTION WHEN lock_not_available THEN
+   -- uws_jobs is busy, created on the next call
+   END;
+   END IF;
+   END LOOP;
+END;
+$$;
+
+
+ALTER FUNCTION public.create_job_partitions(space bigint, days integer) OWNER TO vos_user;
+
+--
+-- Name: drop_job_partitions(bigint); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.drop_job_partitions(space bigint) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+DECLARE
+   part text;
+   live boolean;
+   dropped integer := 0;
+BEGIN
+   -- a day before today is dropped whole once none of its jobs is live
+   FOR part IN SELECT c.relname FROM pg_catalog.pg_inherits i
+               JOIN pg_catalog.pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = format('public.%I', 'uws_jobs_' || space)::regclass
+               AND c.relname <> 'uws_jobs_' || space || '_default'
+               AND c.relname < 'uws_jobs_' || space || '_' || to_char(timezone('utc', now()), 'YYYYMMDD')
+   LOOP
+   EXECUTE format('SELECT EXISTS (SELECT 1 FROM public.%I WHERE destruction >= $1 OR phase = ANY($2))', part)
+   INTO live USING timezone('utc', now()), ARRAY[1, 2];
+   IF NOT live THEN
+   BEGIN
+   EXECUTE format('DROP TABLE public.%I', part);
+   dropped := dropped + 1;
+   EXCEPTION WHEN lock_not_available THEN
+   -- jobs of the day are being read, dropped on the next call
+   END;
+   END IF;
+   END LOOP;
+   RETURN dropped;
+END;
+$$;
+
+
+ALTER FUNCTION public.drop_job_partitions(space bigint) OWNER TO vos_user;
+
+--
+-- Name: create_space_partitions(bigint); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.create_space_partitions(space bigint) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    AS $$
+BEGIN
+   -- every space has its own partition of nodes and uws_jobs
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.nodes FOR VALUES IN (%s)',
+                  'nodes_' || space, space);
+   -- jobs are further partitioned by the day they are created on, see create_job_partitions()
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.uws_jobs FOR VALUES IN (%s) '
+                  'PARTITION BY RANGE (id)', 'uws_jobs_' || space, space);
+   EXECUTE format('CREATE TABLE IF NOT EXISTS public.%I PARTITION OF public.%I DEFAULT',
+                  'uws_jobs_' || space || '_default', 'uws_jobs_' || space);
+   PERFORM public.create_job_partitions(space, 1);
+
+   -- before row triggers are only defined on partitioned tables from PostgreSQL 13
+   IF NOT EXISTS (SELECT 1 FROM pg_catalog.pg_trigger
+                  WHERE tgrelid = format('public.%I', 'nodes_' || space)::regclass
+                  AND tgname = 'node_modified_trigger') THEN
+   EXECUTE format('CREATE TRIGGER node_modified_trigger BEFORE UPDATE OF size, storage_id ON public.%I '
+                  'FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column()', 'nodes_' || space);
+   END IF;
+END;
+$$;
+
+
+ALTER FUNCTION public.create_space_partitions(space bigint) OWNER TO vos_user;
+
+--
+-- Name: lock_path_key(bigint, text, text); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.lock_path_key(space bigint, prefix text, kind text) RETURNS bigint
+    LANGUAGE sql IMMUTABLE
+    AS $$
+SELECT hashtextextended(space || '/' || prefix || '/' || kind, 0);
+$$;
+
+
+ALTER FUNCTION public.lock_path_key(space bigint, prefix text, kind text) OWNER TO vos_user;
+
+--
+-- Name: lock_path(bigint, public.ltree, text, boolean); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.lock_path(space bigint, path public.ltree, mode text, nowait boolean) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   level integer;
+   prefix text;
+   node_mode text;
+   intent_key bigint;
+   write_key bigint;
+   read_key bigint;
+   acquired boolean;
+BEGIN
+   -- Hierarchical intent lock on a path until the end of the transaction, modes IS, IX, S and X.
+   -- The ancestors are intent locked from the root down then the path itself in mode.
+   -- Every mode but X shares the intent key of a path, X holds it exclusively. IX holders
+   -- share its write key and S holders its read key. Each waits for the other kind to be
+   -- gone by taking the key of the other exclusively for a moment, the write key first.
+   IF mode NOT IN ('IS', 'IX', 'S', 'X') THEN
+   RAISE EXCEPTION 'invalid lock mode %', mode;
+   END IF;
+   FOR level IN 1..nlevel(path) LOOP
+   prefix := subpath(path, 0, level)::text;
+   IF level < nlevel(path) THEN
+   node_mode := CASE WHEN mode IN ('IS', 'S') THEN 'IS' ELSE 'IX' END;
+   ELSE
+   node_mode := mode;
+   END IF;
+   intent_key := public.lock_path_key(space, prefix, 'i');
+   write_key := public.lock_path_key(space, prefix, 'w');
+   read_key := public.lock_path_key(space, prefix, 'r');
+
+   IF node_mode = 'X' THEN
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock(intent_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock(intent_key);
+   acquired := true;
+   END IF;
+   ELSE
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock_shared(intent_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock_shared(intent_key);
+   acquired := true;
+   END IF;
+   END IF;
+
+   IF acquired AND node_mode = 'IX' THEN
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock_shared(write_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock_shared(write_key);
+   END IF;
+   IF acquired THEN
+   -- wait for the readers of the subtree
+   IF nowait THEN
+   acquired := pg_try_advisory_lock(read_key);
+   ELSE
+   PERFORM pg_advisory_lock(read_key);
+   END IF;
+   IF acquired THEN
+   PERFORM pg_advisory_unlock(read_key);
+   END IF;
+   END IF;
+   ELSIF acquired AND node_mode = 'S' THEN
+   -- wait for the writers of the subtree, new ones wait until the read key is held
+   IF nowait THEN
+   acquired := pg_try_advisory_lock(write_key);
+   ELSE
+   PERFORM pg_advisory_lock(write_key);
+   END IF;
+   IF acquired THEN
+   BEGIN
+   IF nowait THEN
+   acquired := pg_try_advisory_xact_lock_shared(read_key);
+   ELSE
+   PERFORM pg_advisory_xact_lock_shared(read_key);
+   END IF;
+   EXCEPTION WHEN OTHERS THEN
+   PERFORM pg_advisory_unlock(write_key);
+   RAISE;
+   END;
+   PERFORM pg_advisory_unlock(write_key);
+   END IF;
+   END IF;
+
+   IF NOT acquired THEN
+   RAISE EXCEPTION 'could not obtain % lock on path %', node_mode, prefix
+   USING ERRCODE = 'lock_not_available';
+   END IF;
+   END LOOP;
+END;
+$$;
+
+
+ALTER FUNCTION public.lock_path(space bigint, path public.ltree, mode text, nowait boolean) OWNER TO vos_user;
+
+--
+-- Name: node_walk(bigint, public.ltree); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.node_walk(node_space bigint, node_path public.ltree) RETURNS TABLE(id uuid, path public.ltree)
+    LANGUAGE sql STABLE
+    AS $$
+-- the nodes along node_path, one label at a time from the root of the space
+WITH RECURSIVE walk AS (
+     SELECT n.id, subltree(node_path, 0, 1) AS path
+     FROM public.nodes n
+     WHERE n.space_id = node_space AND n.parent_id IS NULL AND n.label = subltree(node_path, 0, 1)::text
+     UNION ALL
+     SELECT n.id, subltree(node_path, 0, nlevel(walk.path) + 1)
+     FROM walk JOIN public.nodes n
+     ON n.space_id = node_space AND n.parent_id = walk.id
+     AND n.label = subltree(node_path, nlevel(walk.path), nlevel(walk.path) + 1)::text
+     WHERE nlevel(walk.path) < nlevel(node_path))
+SELECT walk.id, walk.path FROM walk;
+$$;
+
+
+ALTER FUNCTION public.node_walk(node_space bigint, node_path public.ltree) OWNER TO vos_user;
+
+--
+-- Name: node_path(bigint, uuid); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.node_path(node_space bigint, node_id uuid) RETURNS public.ltree
+    LANGUAGE sql STABLE
+    AS $$
+-- the path of a node, from its label up the parent links to the root of the space
+WITH RECURSIVE up AS (
+     SELECT n.parent_id, text2ltree(n.label) AS path
+     FROM public.nodes n WHERE n.space_id = node_space AND n.id = node_id
+     UNION ALL
+     SELECT n.parent_id, n.label || up.path
+     FROM up JOIN public.nodes n ON n.space_id = node_space AND n.id = up.parent_id)
+SELECT up.path FROM up WHERE up.parent_id IS NULL;
+$$;
+
+
+ALTER FUNCTION public.node_path(node_space bigint, node_id uuid) OWNER TO vos_user;
+
+--
+-- Name: node_tree(bigint, public.ltree); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.node_tree(node_space bigint, node_path public.ltree) RETURNS TABLE(id uuid, path public.ltree)
+    LANGUAGE sql STABLE
+    AS $$
+-- the node at node_path and every node below it
+WITH RECURSIVE tree AS (
+     SELECT walk.id, walk.path
+     FROM public.node_walk(node_space, node_path) walk
+     WHERE walk.path = node_path
+     UNION ALL
+     SELECT n.id, tree.path || n.label
+     FROM tree JOIN public.nodes n
+     ON n.space_id = node_space AND n.parent_id = tree.id)
+SELECT tree.id, tree.path FROM tree;
+$$;
+
+
+ALTER FUNCTION public.node_tree(node_space bigint, node_path public.ltree) OWNER TO vos_user;
+
+--
+-- Name: update_property_summary(); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.update_property_summary() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   delta_space bigint[];
+   delta_uri text[];
+   delta_refs bigint[];
+   spaces bigint[];
+BEGIN
+   -- references to each property uri added or removed by the statement
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(d.space_id), array_agg(d.uri), array_agg(d.refs)
+   INTO delta_space, delta_uri, delta_refs
+   FROM (SELECT n.space_id, p.uri, count(*) AS refs
+         FROM new_nodes n, jsonb_object_keys(n.properties) AS p(uri)
+         GROUP BY n.space_id, p.uri) AS d;
+
+   ELSIF TG_OP = 'DELETE' THEN
+   SELECT array_agg(d.space_id), array_agg(d.uri), array_agg(d.refs)
+   INTO delta_space, delta_uri, delta_refs
+   FROM (SELECT o.space_id, p.uri, -count(*) AS refs
+         FROM old_nodes o, jsonb_object_keys(o.properties) AS p(uri)
+         GROUP BY o.space_id, p.uri) AS d;
+
+   -- the totals written by update_tree_totals leave the properties alone
+   ELSIF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+
+   ELSE
+   SELECT array_agg(d.space_id), array_agg(d.uri), array_agg(d.refs)
+   INTO delta_space, delta_uri, delta_refs
+   FROM (SELECT c.space_id, c.uri, sum(c.refs)::bigint AS refs
+         FROM (SELECT n.space_id, p.uri, 1 AS refs
+               FROM old_nodes o JOIN new_nodes n ON n.id = o.id, jsonb_object_keys(n.properties) AS p(uri)
+               WHERE o.properties <> n.properties
+               UNION ALL
+               SELECT o.space_id, p.uri, -1 AS refs
+               FROM old_nodes o JOIN new_nodes n ON n.id = o.id, jsonb_object_keys(o.properties) AS p(uri)
+               WHERE o.properties <> n.properties) AS c
+         GROUP BY c.space_id, c.uri
+         HAVING sum(c.refs) <> 0) AS d;
+   END IF;
+
+   IF delta_uri IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   -- rows are updated in key order so concurrent statements do not deadlock
+   WITH delta AS (
+        SELECT * FROM unnest(delta_space, delta_uri, delta_refs) AS d(space_id, uri, refs)),
+   upsert AS (
+        INSERT INTO public.property_summary AS s (space_id, uri, refs)
+        SELECT d.space_id, d.uri, d.refs FROM delta d
+        ORDER BY d.space_id, d.uri
+        ON CONFLICT (space_id, uri) DO UPDATE SET refs = s.refs + excluded.refs
+        RETURNING s.space_id, s.uri, s.refs)
+   -- a uri is new when all its references are the ones just added
+   SELECT array_agg(DISTINCT u.space_id) INTO spaces
+   FROM upsert u JOIN delta d ON d.space_id = u.space_id AND d.uri = u.uri
+   WHERE u.refs = d.refs OR u.refs <= 0;
+
+   IF spaces IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   DELETE FROM public.property_summary s
+   USING unnest(delta_space, delta_uri) AS d(space_id, uri)
+   WHERE s.space_id = d.space_id AND s.uri = d.uri AND s.refs <= 0;
+
+   -- the set of uris of these spaces has changed
+   PERFORM pg_notify('properties', space_id::text) FROM unnest(spaces) AS space_id;
+   RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.update_property_summary() OWNER TO vos_user;
+
+--
+-- Name: update_tree_totals(); Type: FUNCTION; Schema: public; Owner: vos_user
 --
 
-CREATE FUNCTION public.update_path_modified_column() RETURNS trigger
+CREATE FUNCTION public.update_tree_totals() RETURNS trigger
     LANGUAGE plpgsql
     AS $$
+DECLARE
+   delta_space bigint[];
+   delta_id uuid[];
+   delta_size bigint[];
+   delta_count bigint[];
 BEGIN
-   IF NEW.path <> OLD.path THEN
-   NEW.path_modified := OLD.path_modified + 1;
+   -- the totals written below are not themselves a change to count
+   IF pg_trigger_depth() > 1 THEN
+   RETURN NULL;
+   END IF;
+
+   -- Every change is credited to the parent of the node it happened to
+   -- and carried up the parent links from there.
+   IF TG_OP = 'INSERT' THEN
+   SELECT array_agg(n.space_id), array_agg(n.parent_id), array_agg(n.size), array_agg(1::bigint)
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM new_nodes n
+   WHERE n.parent_id IS NOT NULL;
+   ELSIF TG_OP = 'DELETE' THEN
+   -- the totals of the topmost deleted nodes cover the nodes deleted below them
+   SELECT array_agg(o.space_id), array_agg(o.parent_id), array_agg(-(o.size + o.tree_size + pending.size)),
+          array_agg(-(1 + o.tree_count + pending.count))
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM old_nodes o, public.tree_delta(o.space_id, o.id) pending
+   WHERE o.parent_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1 FROM old_nodes p WHERE p.id = o.parent_id);
+   ELSE
+   -- a moved node takes the totals of its subtree from one parent to the other
+   WITH changed AS (
+        SELECT n.space_id, o.parent_id AS old_parent, n.parent_id AS new_parent,
+               o.size AS old_size, n.size AS new_size,
+               n.tree_size + pending.size AS tree_size, n.tree_count + pending.count AS tree_count
+        FROM old_nodes o JOIN new_nodes n ON o.id = n.id, public.tree_delta(n.space_id, n.id) pending
+        WHERE o.parent_id IS DISTINCT FROM n.parent_id OR o.size <> n.size),
+   change AS (
+        SELECT space_id, old_parent AS id, -(old_size + tree_size) AS size, -(1 + tree_count) AS count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT space_id, new_parent, new_size + tree_size, 1 + tree_count
+        FROM changed WHERE old_parent IS DISTINCT FROM new_parent
+        UNION ALL
+        SELECT space_id, new_parent, new_size - old_size, 0
+        FROM changed WHERE old_parent IS NOT DISTINCT FROM new_parent)
+   SELECT array_agg(space_id), array_agg(id), array_agg(size), array_agg(count)
+   INTO delta_space, delta_id, delta_size, delta_count
+   FROM change
+   WHERE id IS NOT NULL;
    END IF;
-   RETURN NEW;
+
+   IF delta_id IS NULL THEN
+   RETURN NULL;
+   END IF;
+
+   -- The ancestors are not updated here, that would serialise every write
+   -- under a container on its row. Their deltas are appended to tree_deltas
+   -- and added to the rows later by fold_tree_deltas.
+   WITH RECURSIVE up AS (
+        SELECT delta.space_id, delta.id, sum(delta.size)::bigint AS size, sum(delta.count)::bigint AS count
+        FROM unnest(delta_space, delta_id, delta_size, delta_count) AS delta(space_id, id, size, count)
+        GROUP BY delta.space_id, delta.id
+        UNION ALL
+        SELECT nodes.space_id, nodes.parent_id, up.size, up.count
+        FROM up JOIN public.nodes ON nodes.space_id = up.space_id AND nodes.id = up.id
+        WHERE nodes.parent_id IS NOT NULL)
+   INSERT INTO public.tree_deltas (space_id, id, size, count)
+   SELECT up.space_id, up.id, sum(up.size), sum(up.count)
+   FROM up GROUP BY up.space_id, up.id
+   HAVING sum(up.size) <> 0 OR sum(up.count) <> 0;
+   RETURN NULL;
 END;
 $$;
 
 
-ALTER FUNCTION public.update_path_modified_column() OWNER TO vos_user;
+ALTER FUNCTION public.update_tree_totals() OWNER TO vos_user;
+
+--
+-- Name: tree_delta(bigint, uuid); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.tree_delta(space bigint, node uuid, OUT size bigint, OUT count bigint) RETURNS record
+    LANGUAGE sql STABLE
+    AS $$
+-- the change to the totals of a node not yet folded into its row
+SELECT coalesce(sum(d.size), 0)::bigint, coalesce(sum(d.count), 0)::bigint
+FROM public.tree_deltas d WHERE d.space_id = space AND d.id = node;
+$$;
+
+
+ALTER FUNCTION public.tree_delta(space bigint, node uuid, OUT size bigint, OUT count bigint) OWNER TO vos_user;
+
+--
+-- Name: fold_tree_deltas(bigint, integer); Type: FUNCTION; Schema: public; Owner: vos_user
+--
+
+CREATE FUNCTION public.fold_tree_deltas(space bigint, batch integer) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+   folded integer;
+BEGIN
+   -- Add the deltas of up to batch nodes to their totals. The rows of nodes
+   -- locked by a writer are skipped and left for a later run.
+   WITH pending AS (
+        SELECT DISTINCT d.id FROM public.tree_deltas d WHERE d.space_id = space LIMIT batch),
+   locked AS (
+        SELECT nodes.id FROM public.nodes JOIN pending ON nodes.id = pending.id
+        WHERE nodes.space_id = space
+        ORDER BY nodes.id FOR NO KEY UPDATE OF nodes SKIP LOCKED),
+   deleted AS (
+        DELETE FROM public.tree_deltas d USING locked
+        WHERE d.space_id = space AND d.id = locked.id
+        RETURNING d.id, d.size, d.count),
+   total AS (
+        SELECT deleted.id, sum(deleted.size) AS size, sum(deleted.count) AS count
+        FROM deleted GROUP BY deleted.id)
+   UPDATE public.nodes SET tree_size = nodes.tree_size + total.size, tree_count = nodes.tree_count + total.count
+   FROM total WHERE nodes.space_id = space AND nodes.id = total.id;
+   GET DIAGNOSTICS folded = ROW_COUNT;
+
+   -- the deltas of nodes that have been deleted since
+   DELETE FROM public.tree_deltas d
+   WHERE d.ctid = ANY (ARRAY(SELECT o.ctid FROM public.tree_deltas o
+                             WHERE o.space_id = space
+                             AND NOT EXISTS (SELECT 1 FROM public.nodes
+                                             WHERE nodes.space_id = space AND nodes.id = o.id)
+                             LIMIT batch));
+   RETURN folded;
+END;
+$$;
+
+
+ALTER FUNCTION public.fold_tree_deltas(space bigint, batch integer) OWNER TO vos_user;
 
 SET default_tablespace = '';
 
@@ -161,8 +750,8 @@ SET default_with_oids = false;
 
 CREATE TABLE public.nodes (
     type smallint,
-    name text,
-    path public.ltree NOT NULL,
+    name text COLLATE pg_catalog."C",
+    label text COLLATE pg_catalog."C" NOT NULL,
     busy boolean DEFAULT false NOT NULL,
     space_id bigint NOT NULL,
     link text,
@@ -170,30 +759,19 @@ CREATE TABLE public.nodes (
     groupwrite text[] DEFAULT ARRAY[]::text[],
     owner character varying(128) NOT NULL,
     id uuid DEFAULT public.uuid_generate_v4() NOT NULL,
-    path_modified bigint DEFAULT 0 NOT NULL,
     storage_id bigint,
-    size bigint DEFAULT 0 NOT NULL
-);
+    size bigint DEFAULT 0 NOT NULL,
+    parent_id uuid,
+    modified timestamp without time zone DEFAULT now() NOT NULL,
+    tree_size bigint DEFAULT 0 NOT NULL,
+    tree_count bigint DEFAULT 0 NOT NULL,
+    properties jsonb DEFAULT '{}'::jsonb NOT NULL
+)
+PARTITION BY LIST (space_id);
 
 
 ALTER TABLE public.nodes OWNER TO vos_user;
 
---
--- TOC entry 199 (class 1259 OID 16587)
--- Name: properties; Type: TABLE; Schema: public; Owner: vos_user
---
-
-CREATE TABLE public.properties (
-    uri text NOT NULL,
-    value text,
-    read_only boolean DEFAULT true,
-    node_path public.ltree NOT NULL,
-    space_id bigint NOT NULL
-);
-
-
-ALTER TABLE public.properties OWNER TO vos_user;
-
 --
 -- TOC entry 200 (class 1259 OID 16594)
 -- Name: space; Type: TABLE; Schema: public; Owner: vos_user
@@ -276,6 +854,61 @@ ALTER TABLE public.storage_id_seq OWNER TO vos_user;
 ALTER SEQUENCE public.storage_id_seq OWNED BY public.storage.id;
 
 
+--
+-- Name: property_summary; Type: TABLE; Schema: public; Owner: vos_user
+--
+
+CREATE TABLE public.property_summary (
+    space_id bigint NOT NULL,
+    uri text NOT NULL,
+    refs bigint DEFAULT 0 NOT NULL
+);
+
+
+ALTER TABLE public.property_summary OWNER TO vos_user;
+
+--
+-- Name: schema_migrations; Type: TABLE; Schema: public; Owner: vos_user
+--
+
+CREATE TABLE public.schema_migrations (
+    version integer NOT NULL,
+    name text NOT NULL,
+    applied timestamp without time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.schema_migrations OWNER TO vos_user;
+
+--
+-- Name: trash; Type: TABLE; Schema: public; Owner: vos_user
+--
+
+CREATE TABLE public.trash (
+    id uuid NOT NULL,
+    space_id bigint NOT NULL,
+    path public.ltree NOT NULL,
+    created timestamp without time zone DEFAULT now() NOT NULL
+);
+
+
+ALTER TABLE public.trash OWNER TO vos_user;
+
+--
+-- Name: tree_deltas; Type: TABLE; Schema: public; Owner: vos_user
+--
+
+CREATE TABLE public.tree_deltas (
+    space_id bigint NOT NULL,
+    id uuid NOT NULL,
+    size bigint NOT NULL,
+    count bigint NOT NULL
+);
+
+
+ALTER TABLE public.tree_deltas OWNER TO vos_user;
+
+
 --
 -- TOC entry 204 (class 1259 OID 16613)
 -- Name: users; Type: TABLE; Schema: public; Owner: vos_user
@@ -308,10 +941,14 @@ CREATE TABLE public.uws_jobs (
     results xml,
     owner text NOT NULL,
     modified timestamp without time zone DEFAULT now() NOT NULL,
-    id uuid DEFAULT public.uuid_generate_v4() NOT NULL,
-    node_path_modified bigint,
-    node_path public.ltree
-);
+    id uuid DEFAULT public.uuid_generate_v7() NOT NULL,
+    node_id uuid,
+    node_path public.ltree,
+    priority integer DEFAULT 1 NOT NULL,
+    worker text,
+    lease_expires timestamp without time zone
+)
+PARTITION BY LIST (space_id);
 
 
 ALTER TABLE public.uws_jobs OWNER TO vos_user;
@@ -333,21 +970,35 @@ ALTER TABLE ONLY public.storage ALTER COLUMN id SET DEFAULT nextval('public.stor
 
 
 --
--- TOC entry 2948 (class 2606 OID 16633)
--- Name: uws_jobs job_id_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
+-- Data for Name: schema_migrations; Type: TABLE DATA; Schema: public; Owner: vos_user
+-- Migrations this schema already contains, see pyvospace.server.migrate
 --
 
-ALTER TABLE ONLY public.uws_jobs
-    ADD CONSTRAINT job_id_pk PRIMARY KEY (id);
+INSERT INTO public.schema_migrations (version, name) VALUES (1, '0001_parent_id.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (2, '0002_listing_order.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (3, '0003_trash.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (4, '0004_tree_totals.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (5, '0005_properties_jsonb.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (6, '0006_node_cache_notify.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (7, '0007_adjacency.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (8, '0008_property_summary.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (9, '0009_space_partitions.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (10, '0010_job_partitions.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (11, '0011_active_phase_idx.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (12, '0012_intent_locks.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (13, '0013_job_priority.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (14, '0014_job_leases.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (15, '0015_job_notify_channels.sql');
+INSERT INTO public.schema_migrations (version, name) VALUES (16, '0016_tree_deltas.sql');
 
 
 --
--- TOC entry 2924 (class 2606 OID 16635)
--- Name: nodes node_id_unique; Type: CONSTRAINT; Schema: public; Owner: vos_user
+-- TOC entry 2948 (class 2606 OID 16633)
+-- Name: uws_jobs job_id_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
 --
 
-ALTER TABLE ONLY public.nodes
-    ADD CONSTRAINT node_id_unique UNIQUE (id);
+ALTER TABLE public.uws_jobs
+    ADD CONSTRAINT job_id_pk PRIMARY KEY (space_id, id);
 
 
 --
@@ -355,26 +1006,8 @@ ALTER TABLE ONLY public.nodes
 -- Name: nodes node_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
 --
 
-ALTER TABLE ONLY public.nodes
-    ADD CONSTRAINT node_pk PRIMARY KEY (path, space_id);
-
-
---
--- TOC entry 2928 (class 2606 OID 16639)
--- Name: nodes nodes_unique; Type: CONSTRAINT; Schema: public; Owner: vos_user
---
-
-ALTER TABLE ONLY public.nodes
-    ADD CONSTRAINT nodes_unique UNIQUE (path, space_id);
-
-
---
--- TOC entry 2933 (class 2606 OID 16641)
--- Name: properties properties_unique; Type: CONSTRAINT; Schema: public; Owner: vos_user
---
-
-ALTER TABLE ONLY public.properties
-    ADD CONSTRAINT properties_unique UNIQUE (uri, node_path, space_id);
+ALTER TABLE public.nodes
+    ADD CONSTRAINT node_pk PRIMARY KEY (space_id, id);
 
 
 --
@@ -422,6 +1055,30 @@ ALTER TABLE ONLY public.storage
     ADD CONSTRAINT storage_unique UNIQUE (name, host, port);
 
 
+--
+-- Name: schema_migrations schema_migrations_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
+--
+
+ALTER TABLE ONLY public.schema_migrations
+    ADD CONSTRAINT schema_migrations_pk PRIMARY KEY (version);
+
+
+--
+-- Name: property_summary property_summary_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
+--
+
+ALTER TABLE ONLY public.property_summary
+    ADD CONSTRAINT property_summary_pk PRIMARY KEY (space_id, uri);
+
+
+--
+-- Name: trash trash_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
+--
+
+ALTER TABLE ONLY public.trash
+    ADD CONSTRAINT trash_pk PRIMARY KEY (id);
+
+
 --
 -- TOC entry 2946 (class 2606 OID 16653)
 -- Name: users user_pk; Type: CONSTRAINT; Schema: public; Owner: vos_user
@@ -432,11 +1089,45 @@ ALTER TABLE ONLY public.users
 
 
 --
--- TOC entry 2922 (class 1259 OID 16654)
--- Name: fki_space_fk; Type: INDEX; Schema: public; Owner: vos_user
+-- Name: node_label_idx; Type: INDEX; Schema: public; Owner: vos_user
 --
 
-CREATE INDEX fki_space_fk ON public.nodes USING btree (space_id);
+CREATE UNIQUE INDEX node_label_idx ON public.nodes USING btree (space_id, parent_id, label);
+
+
+--
+-- Name: root_label_idx; Type: INDEX; Schema: public; Owner: vos_user
+--
+
+CREATE UNIQUE INDEX root_label_idx ON public.nodes USING btree (space_id, label) WHERE (parent_id IS NULL);
+
+
+--
+-- Name: tree_deltas_idx; Type: INDEX; Schema: public; Owner: vos_user
+--
+
+CREATE INDEX tree_deltas_idx ON public.tree_deltas USING btree (space_id, id);
+
+
+--
+-- Name: parent_idx; Type: INDEX; Schema: public; Owner: vos_user
+--
+
+CREATE INDEX parent_idx ON public.nodes USING btree (space_id, parent_id, name);
+
+
+--
+-- Name: parent_modified_idx; Type: INDEX; Schema: public; Owner: vos_user
+--
+
+CREATE INDEX parent_modified_idx ON public.nodes USING btree (space_id, parent_id, modified, name);
+
+
+--
+-- Name: parent_size_idx; Type: INDEX; Schema: public; Owner: vos_user
+--
+
+CREATE INDEX parent_size_idx ON public.nodes USING btree (space_id, parent_id, size, name);
 
 
 --
@@ -456,35 +1147,24 @@ CREATE INDEX owner_idx ON public.uws_jobs USING btree (owner bpchar_pattern_ops)
 
 
 --
--- TOC entry 2929 (class 1259 OID 16657)
--- Name: path_gist_idx; Type: INDEX; Schema: public; Owner: vos_user
+-- Name: active_phase_idx; Type: INDEX; Schema: public; Owner: vos_user
 --
 
-CREATE INDEX path_gist_idx ON public.nodes USING gist (path);
+CREATE INDEX active_phase_idx ON public.uws_jobs USING btree (phase) WHERE (phase = ANY (ARRAY[0, 1, 2, 7, 8]));
 
 
 --
--- TOC entry 2930 (class 1259 OID 16658)
--- Name: path_idx; Type: INDEX; Schema: public; Owner: vos_user
+-- Name: destruction_idx; Type: INDEX; Schema: public; Owner: vos_user
 --
 
-CREATE INDEX path_idx ON public.nodes USING btree (path);
+CREATE INDEX destruction_idx ON public.uws_jobs USING btree (destruction);
 
 
 --
--- TOC entry 2950 (class 1259 OID 16659)
--- Name: phase_idx; Type: INDEX; Schema: public; Owner: vos_user
---
-
-CREATE INDEX phase_idx ON public.uws_jobs USING btree (phase);
-
-
---
--- TOC entry 2931 (class 1259 OID 16660)
 -- Name: properties_idx; Type: INDEX; Schema: public; Owner: vos_user
 --
 
-CREATE INDEX properties_idx ON public.properties USING btree (node_path);
+CREATE INDEX properties_idx ON public.nodes USING gin (properties);
 
 
 --
@@ -504,28 +1184,74 @@ CREATE TRIGGER insert_trigger AFTER INSERT OR UPDATE ON public.uws_jobs FOR EACH
 
 
 --
--- TOC entry 2956 (class 2620 OID 16663)
--- Name: nodes path_change_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+-- Name: nodes tree_insert_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
 --
 
-CREATE TRIGGER path_change_trigger BEFORE UPDATE ON public.nodes FOR EACH ROW EXECUTE PROCEDURE public.update_path_modified_column();
+CREATE TRIGGER tree_insert_trigger AFTER INSERT ON public.nodes REFERENCING NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
 
 
 --
--- TOC entry 2959 (class 2620 OID 16664)
--- Name: uws_jobs update_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+-- Name: nodes tree_update_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
 --
 
-CREATE TRIGGER update_trigger AFTER UPDATE ON public.uws_jobs FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column();
+CREATE TRIGGER tree_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
+
+
+--
+-- Name: nodes tree_delete_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER tree_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_tree_totals();
 
 
 --
--- TOC entry 2953 (class 2606 OID 16665)
--- Name: properties properties_fk; Type: FK CONSTRAINT; Schema: public; Owner: vos_user
+-- Name: nodes property_insert_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
 --
 
-ALTER TABLE ONLY public.properties
-    ADD CONSTRAINT properties_fk FOREIGN KEY (node_path, space_id) REFERENCES public.nodes(path, space_id) ON UPDATE CASCADE ON DELETE CASCADE;
+CREATE TRIGGER property_insert_trigger AFTER INSERT ON public.nodes REFERENCING NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+
+
+--
+-- Name: nodes property_update_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER property_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+
+
+--
+-- Name: nodes property_delete_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER property_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.update_property_summary();
+
+
+--
+-- Name: nodes node_cache_update_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER node_cache_update_trigger AFTER UPDATE ON public.nodes REFERENCING OLD TABLE AS old_nodes NEW TABLE AS new_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+
+--
+-- Name: nodes node_cache_delete_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER node_cache_delete_trigger AFTER DELETE ON public.nodes REFERENCING OLD TABLE AS old_nodes FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+
+--
+-- Name: storage storage_cache_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER storage_cache_trigger AFTER UPDATE OR DELETE ON public.storage FOR EACH STATEMENT EXECUTE PROCEDURE public.node_cache_notify_trigger();
+
+
+--
+-- TOC entry 2959 (class 2620 OID 16664)
+-- Name: uws_jobs update_trigger; Type: TRIGGER; Schema: public; Owner: vos_user
+--
+
+CREATE TRIGGER update_trigger AFTER UPDATE ON public.uws_jobs FOR EACH ROW EXECUTE PROCEDURE public.update_modified_column();
 
 
 --
@@ -533,7 +1259,7 @@ ALTER TABLE ONLY public.properties
 -- Name: nodes space_fk; Type: FK CONSTRAINT; Schema: public; Owner: vos_user
 --
 
-ALTER TABLE ONLY public.nodes
+ALTER TABLE public.nodes
     ADD CONSTRAINT space_fk FOREIGN KEY (space_id) REFERENCES public.space(id) ON UPDATE SET NULL ON DELETE SET NULL;
 
 
@@ -542,7 +1268,7 @@ ALTER TABLE ONLY public.nodes
 -- Name: uws_jobs space_fk; Type: FK CONSTRAINT; Schema: public; Owner: vos_user
 --
 
-ALTER TABLE ONLY public.uws_jobs
+ALTER TABLE public.uws_jobs
     ADD CONSTRAINT space_fk FOREIGN KEY (space_id) REFERENCES public.space(id) ON UPDATE CASCADE ON DELETE CASCADE;
 
 
@@ -560,10 +1286,26 @@ ALTER TABLE ONLY public.storage
 -- Name: nodes storage_fk; Type: FK CONSTRAINT; Schema: public; Owner: vos_user
 --
 
-ALTER TABLE ONLY public.nodes
+ALTER TABLE public.nodes
     ADD CONSTRAINT storage_fk FOREIGN KEY (storage_id) REFERENCES public.storage(id);
 
 
+--
+-- Name: property_summary space_fk; Type: FK CONSTRAINT; Schema: public; Owner: vos_user
+--
+
+ALTER TABLE ONLY public.property_summary
+    ADD CONSTRAINT space_fk FOREIGN KEY (space_id) REFERENCES public.space(id) ON UPDATE CASCADE ON DELETE CASCADE;
+
+
+--
+-- Name: trash space_fk; Type: FK CONSTRAINT; Schema: public; Owner: vos_user
+--
+
+ALTER TABLE ONLY public.trash
+    ADD CONSTRAINT space_fk FOREIGN KEY (space_id) REFERENCES public.space(id) ON UPDATE CASCADE ON DELETE CASCADE;
+
+
 -- Completed on 2018-09-07 14:03:44 AWST
 
 --
@@ -0,0 +1,157 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+"""
+Apply the schema migrations shipped in deploy/migrations to a vospace database.
+
+A migration is versioned by the number its file name starts with. The versions
+applied to a database are recorded in schema_migrations, vo_db.sql records all of
+the migrations it already contains. Each pending migration is applied in a single
+transaction along with its record, in version order.
+
+A database created before schema_migrations existed has to be told the last
+migration applied to it by hand with --baseline.
+"""
+
+import os
+import re
+import asyncio
+import asyncpg
+import argparse
+import configparser
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'deploy', 'migrations')
+
+# Key of the advisory lock held while migrating, one runner at a time.
+MIGRATION_LOCK = 0x766f6d6967
+
+_MIGRATION_NAME = re.compile(r'^(\d+)_\w+\.sql$')
+# psql meta commands and the transaction of the file, the runner provides its own
+_NOT_SQL = re.compile(r'^(?:\\.*|BEGIN;|COMMIT;)\s*$', re.MULTILINE)
+
+
+def list_migrations(path=MIGRATIONS_DIR):
+    """
+    :return: list of (version, file name) in version order.
+    """
+    migrations = []
+    for name in os.listdir(path):
+        match = _MIGRATION_NAME.match(name)
+        if match:
+            migrations.append((int(match.group(1)), name))
+    migrations.sort()
+    versions = [version for version, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Duplicate migration versions in {path}")
+    return migrations
+
+
+def read_migration(filename):
+    with open(filename) as f:
+        return _NOT_SQL.sub('', f.read())
+
+
+async def applied_migrations(conn):
+    exists = await conn.fetchval("select to_regclass('public.schema_migrations') is not null")
+    if not exists:
+        return None
+    results = await conn.fetch("select version from public.schema_migrations")
+    return {result['version'] for result in results}
+
+
+async def migrate(dsn, target=None, baseline=None, dry_run=False, path=MIGRATIONS_DIR):
+    """
+    Apply the pending migrations up to and including target.
+
+    :param dsn: database to migrate, as a user that owns its tables.
+    :param target: last version to apply, all of them if None.
+    :param baseline: record the versions up to and including baseline as applied without running them.
+    :param dry_run: only list the pending migrations.
+    :return: list of the file names of the migrations applied.
+    """
+    conn = await asyncpg.connect(dsn=dsn)
+    try:
+        await conn.execute("select pg_advisory_lock($1)", MIGRATION_LOCK)
+        applied = await applied_migrations(conn)
+        if applied is None:
+            if baseline is None and await conn.fetchval("select to_regclass('public.nodes') is not null"):
+                raise ValueError("Database has no schema_migrations, "
+                                 "set --baseline to the last migration applied to it")
+            if not dry_run:
+                await conn.execute("create table public.schema_migrations "
+                                   "(version integer not null primary key, "
+                                   "name text not null, "
+                                   "applied timestamp without time zone default now() not null)")
+            applied = set()
+
+        done = []
+        for version, name in list_migrations(path):
+            if version in applied or (target is not None and version > target):
+                continue
+            if baseline is not None and version <= baseline:
+                if not dry_run:
+                    await conn.execute("insert into public.schema_migrations (version, name) "
+                                       "values ($1, $2)", version, name)
+                print(f"{name}: baseline")
+                continue
+            if not dry_run:
+                sql = read_migration(os.path.join(path, name))
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("insert into public.schema_migrations (version, name) "
+                                       "values ($1, $2)", version, name)
+            print(f"{name}: {'pending' if dry_run else 'applied'}")
+            done.append(name)
+        if not done:
+            print("no pending migrations")
+        return done
+    finally:
+        await conn.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Apply the schema migrations of a vospace database.')
+    parser.add_argument('--cfg', type=str, action='store',
+                        help='config of a space, its dsn is migrated')
+    parser.add_argument('--dsn', type=str, action='store',
+                        help='database to migrate, instead of the dsn of --cfg')
+    parser.add_argument('--target', type=int, action='store', default=None,
+                        help='last version to apply')
+    parser.add_argument('--baseline', type=int, action='store', default=None,
+                        help='last version already applied to a database without schema_migrations')
+    parser.add_argument('--dry-run', action='store_true', default=False)
+    args = parser.parse_args(args)
+
+    dsn = args.dsn
+    if dsn is None:
+        if args.cfg is None:
+            parser.error('one of --cfg or --dsn is required')
+        config = configparser.ConfigParser()
+        config.read(args.cfg)
+        dsn = config['Space']['dsn']
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(dsn, args.target, args.baseline, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+"""
+Re-encode the node labels and job paths of a space from the legacy base16
+labels to the compact labels of :mod:`pyvospace.server.codec`.
+
+Rows are walked in id order and rewritten in batches, one transaction per batch,
+so locks are short lived and the rest of the database stays available.
+Rows that are already compact
+are left alone which makes the tool safe to interrupt and run again.
+The servers of the space should be stopped until it has completed.
+"""
+
+import asyncio
+import asyncpg
+import argparse
+import configparser
+
+from .codec import is_legacy_label, decode_path, encode_path
+
+
+def reencode_path(ltree_path):
+    labels = ltree_path.split('.')
+    if not any(is_legacy_label(label) for label in labels):
+        return None
+    return encode_path(decode_path(ltree_path))
+
+
+async def reencode_table(conn, table, column, column_type, space_id, batch_size, sleep):
+    total = 0
+    last_id = None
+    while True:
+        if last_id is None:
+            rows = await conn.fetch(f"select id, {column} from {table} "
+                                    f"where space_id=$1 and {column} is not null "
+                                    f"order by id limit $2",
+                                    space_id, batch_size)
+        else:
+            rows = await conn.fetch(f"select id, {column} from {table} "
+                                    f"where space_id=$1 and {column} is not null and id>$3 "
+                                    f"order by id limit $2",
+                                    space_id, batch_size, last_id)
+        if not rows:
+            return total
+        last_id = rows[-1]['id']
+
+        ids, paths = [], []
+        for row in rows:
+            path = reencode_path(row[column])
+            if path is not None:
+                ids.append(row['id'])
+                paths.append(path)
+
+        if ids:
+            async with conn.transaction():
+                await conn.execute(f"update {table} set {column}=v.path::{column_type} "
+                                   f"from unnest($1::uuid[], $2::text[]) as v(id, path) "
+                                   f"where {table}.id=v.id and {table}.space_id=$3",
+                                   ids, paths, space_id)
+            total += len(ids)
+            print(f"{table}: {total} re-encoded")
+
+        if sleep:
+            await asyncio.sleep(sleep)
+
+
+async def reencode_space(dsn, host, port, batch_size, sleep):
+    conn = await asyncpg.connect(dsn=dsn)
+    try:
+        result = await conn.fetchrow("select id from space where host=$1 and port=$2", host, port)
+        if not result:
+            raise ValueError(f"No space registered for {host}:{port}")
+        space_id = result['id']
+        await reencode_table(conn, 'nodes', 'label', 'text', space_id, batch_size, sleep)
+        await reencode_table(conn, 'uws_jobs', 'node_path', 'ltree', space_id, batch_size, sleep)
+    finally:
+        await conn.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Re-encode the ltree paths of a space.')
+    parser.add_argument('--cfg', type=str, action='store', required=True)
+    parser.add_argument('--batch-size', type=int, action='store', default=1000)
+    parser.add_argument('--sleep', type=float, action='store', default=0,
+                        help='seconds to pause between batches')
+    args = parser.parse_args(args)
+
+    config = configparser.ConfigParser()
+    config.read(args.cfg)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(reencode_space(config['Space']['dsn'],
+                                           config['Space']['host'],
+                                           config.getint('Space', 'port'),
+                                           args.batch_size,
+                                           args.sleep))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+import time
+import asyncpg
+
+from contextlib import asynccontextmanager
+
+
+def lsn_to_int(lsn):
+    hi, lo = lsn.split('/')
+    return (int(hi, 16) << 32) | int(lo, 16)
+
+
+class Replica(object):
+    """
+    Pool of a read only replica and the last known state of its replication.
+    """
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.checked = None
+        self.standby = False
+        self.replay_lsn = 0
+        self.lag = 0.0
+
+    async def check(self, conn):
+        result = await conn.fetchrow("select pg_is_in_recovery() as standby, "
+                                     "pg_last_wal_replay_lsn()::text as replay_lsn, "
+                                     "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() as idle, "
+                                     "extract(epoch from now() - pg_last_xact_replay_timestamp()) as lag")
+        self.checked = time.monotonic()
+        self.standby = result['standby']
+        if not self.standby:
+            # a replica dsn may point at the primary itself, it is never stale
+            self.replay_lsn = None
+            self.lag = 0.0
+            return
+        self.replay_lsn = lsn_to_int(result['replay_lsn']) if result['replay_lsn'] else 0
+        # an idle primary does not move the replay timestamp, no lag if all that was received is replayed
+        self.lag = 0.0 if result['idle'] or result['lag'] is None else float(result['lag'])
+
+    def caught_up(self, lsn):
+        return self.replay_lsn is None or self.replay_lsn >= lsn
+
+
+class ReadPool(object):
+    """
+    Routes reads to read only replicas when any are configured, otherwise to the primary.
+
+    A replica is only used while its replication lag is below max_lag seconds.
+    Reads on behalf of an identity that has written through this server are sent
+    to a replica only once it has replayed that write, otherwise to the primary.
+
+    :param primary: pool of the primary.
+    :param replicas: list of pools of the replicas.
+    :param max_lag: replicas lagging more than this many seconds are not used.
+    """
+    # Seconds the replication state of a replica is trusted before it is queried again.
+    check_interval = 1.0
+
+    def __init__(self, primary, replicas=None, max_lag=5.0):
+        self.primary = primary
+        self.replicas = [Replica(pool) for pool in replicas or []]
+        self.max_lag = max_lag
+        self._next = 0
+        # identity -> lsn of the primary after its last write
+        self._written = {}
+
+    async def close(self):
+        for replica in self.replicas:
+            await replica.db_pool.close()
+
+    async def mark_written(self, identity):
+        """
+        Record the position of the primary after a write made on behalf of identity.
+        """
+        if not self.replicas or identity is None:
+            return
+        async with self.primary.acquire() as conn:
+            lsn = await conn.fetchval("select pg_current_wal_lsn()::text")
+        self._written[identity] = lsn_to_int(lsn)
+
+    @asynccontextmanager
+    async def acquire(self, identity=None):
+        """
+        Acquire a connection to read from on behalf of identity.
+        """
+        lsn = self._written.get(identity)
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            try:
+                conn = await replica.db_pool.acquire()
+            except (OSError, asyncpg.PostgresError):
+                continue
+            try:
+                if await self._usable(replica, conn, lsn):
+                    break
+            except (OSError, asyncpg.PostgresError):
+                pass
+            await replica.db_pool.release(conn)
+        else:
+            async with self.primary.acquire() as conn:
+                yield conn
+            return
+
+        # forget the write once every replica has replayed it
+        if lsn is not None and self._written.get(identity) == lsn:
+            if all(r.caught_up(lsn) for r in self.replicas):
+                del self._written[identity]
+        try:
+            yield conn
+        finally:
+            await replica.db_pool.release(conn)
+
+    async def _usable(self, replica, conn, lsn):
+        if replica.checked is None or time.monotonic() - replica.checked > self.check_interval:
+            await replica.check(conn)
+        elif lsn is not None and not replica.caught_up(lsn):
+            await replica.check(conn)
+        if replica.lag > self.max_lag:
+            return False
+        return lsn is None or replica.caught_up(lsn)
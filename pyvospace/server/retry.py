@@ -0,0 +1,94 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+import random
+import asyncio
+import asyncpg
+
+from collections import Counter
+
+
+# Failures of a transaction that succeed when it is run again from the start.
+RETRYABLE_ERRORS = (asyncpg.exceptions.SerializationError,
+                    asyncpg.exceptions.DeadlockDetectedError)
+
+
+class TransactionRetry(object):
+    """
+    Runs a transaction again when it fails with a serialization failure or a
+    deadlock, after a random sleep of up to delay * 2 ** retry seconds.
+
+    Retries are paid for from a budget: every operation run adds budget to it
+    and every retry takes 1, at most max_budget is saved up. When the database
+    is failing most transactions the budget runs out and the errors are raised
+    rather than multiplying the load.
+
+    :param attempts: most times an operation is run.
+    :param delay: seconds of the first backoff.
+    :param max_delay: most seconds of a backoff.
+    :param budget: retries earned by each operation run.
+    :param max_budget: most retries saved up.
+    """
+    def __init__(self, attempts=5, delay=0.01, max_delay=1.0, budget=0.2, max_budget=10.0):
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.max_budget = max_budget
+        self.tokens = max_budget
+        # operation -> count
+        self.retries = Counter()
+        self.failures = Counter()
+
+    def stats(self):
+        return {'retries': dict(self.retries), 'failures': dict(self.failures),
+                'budget': self.tokens}
+
+    async def run(self, operation, func, *args):
+        """
+        Await func(*args) until it does not fail with one of RETRYABLE_ERRORS.
+
+        :param operation: name the retries are counted under.
+        """
+        self.tokens = min(self.max_budget, self.tokens + self.budget)
+        attempt = 1
+        while True:
+            try:
+                return await func(*args)
+            except RETRYABLE_ERRORS:
+                if attempt >= self.attempts or self.tokens < 1:
+                    self.failures[operation] += 1
+                    raise
+            self.tokens -= 1
+            self.retries[operation] += 1
+            await asyncio.sleep(random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt)))
+            attempt += 1
+
+    async def transaction(self, operation, db_pool, func, *args):
+        """
+        Await func(conn, *args) in a transaction on a connection of db_pool,
+        each attempt in a new transaction.
+        """
+        async def attempt():
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    return await func(conn, *args)
+        return await self.run(operation, attempt)
@@ -22,10 +22,11 @@
 import json
 import asyncio
 import asyncpg
+import logging
 import configparser
 
 from aiohttp import web
-from contextlib import suppress
+from contextlib import suppress, contextmanager
 from abc import ABCMeta, abstractmethod
 from aiohttp_security.api import AUTZ_KEY
 from typing import List
@@ -35,12 +36,30 @@ from pyvospace.core.model import Properties, Protocols, Protocol, Views, View, N
 
 from .view import get_node_request, delete_node_request, create_node_request, \
     set_node_properties_request, create_transfer_request, sync_transfer_request, \
-    get_job_request, get_transfer_details_request, get_job_phase_request, modify_job_request, get_properties_request
-from .uws import UWSJobPool
+    get_job_request, get_transfer_details_request, get_job_phase_request, modify_job_request, get_properties_request, \
+    job_events_request
+from .uws import UWSJobPool, UWSJobScheduler, UWSPhaseListener
 from .database import NodeDatabase
+from .cache import NodeCache, PropertySummary
+from .replica import ReadPool
+from .retry import TransactionRetry
 from .auth import SpacePermission
 
 
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _log_errors(task):
+    # a background task logs a failed run and carries on with the next one
+    try:
+        yield
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception('%s failed', task)
+
+
 class AbstractSpace(metaclass=ABCMeta):
     @abstractmethod
     def get_properties(self) -> Properties:
@@ -143,6 +162,33 @@ class AbstractSpace(metaclass=ABCMeta):
         """
         raise NotImplementedError()
 
+    async def trash_storage_node(self, node: Node):
+        """
+        Detach the storage of a node deleted in trash mode. Called once for the
+        root of the deleted tree, which is then removed by purge_storage_node.
+        It is called before the delete commits, so that none of the tree can be
+        purged before its storage has been detached.
+
+        Storage addressed by the node path should be moved out of the way here
+        as a new node can be created at the same path before it is purged.
+
+        :param node: Root node of the deleted tree.
+        :raises VOSpaceError: if node can not be detached.
+        """
+        pass
+
+    async def purge_storage_node(self, node: Node, root: Node):
+        """
+        Delete the storage of a node deleted in trash mode. Called in the background
+        for every node of the deleted tree, deepest first, with the path the node
+        had when it was deleted. A container has no children left when it is purged.
+
+        :param node: Node to be purged.
+        :param root: Root node of the deleted tree, with its id and the path it had.
+        :raises VOSpaceError: if node can not be deleted.
+        """
+        await self.delete_storage_node(node)
+
     @abstractmethod
     async def get_transfer_protocols(self, job: UWSJob) -> List[Protocol]:
         """
@@ -173,6 +219,7 @@ async def register_space(db_pool, name, host, port, parameters):
                                          "values ($1, $2, $3, $4) on conflict (host, port) "
                                          "do update set parameters=$4 returning id",
                                          host, port, name, parameters)
+            await conn.execute("select create_space_partitions($1)", result['id'])
             return int(result['id'])
 
 
@@ -201,6 +248,7 @@ class SpaceServer(web.Application, SpacePermission):
         self.router.add_delete('/vospace/nodes/{name:.*}', self._delete_node)
         self.router.add_post('/vospace/transfers', self._create_transfer)
         self.router.add_post('/vospace/synctrans', self._sync_transfer)
+        self.router.add_get('/vospace/transfers/events', self._get_job_events)
         self.router.add_get('/vospace/transfers/{job_id}', self._get_job)
         self.router.add_post('/vospace/transfers/{job_id}/phase', self._modify_job_phase)
         self.router.add_get('/vospace/transfers/{job_id}/phase', self._get_job_phase)
@@ -223,6 +271,11 @@ class SpaceServer(web.Application, SpacePermission):
         self['uri'] = self.config['Space']['uri']
         self['parameters'] = json.loads(self.config['Space']['parameters'])
         db_pool = await asyncpg.create_pool(dsn=self.config['Space']['dsn'])
+        # optional read only replicas, one dsn per line
+        read_dsns = self.config.get('Space', 'read_dsn', fallback='').split()
+        replica_pools = [await asyncpg.create_pool(dsn=dsn) for dsn in read_dsns]
+        read_pool = ReadPool(db_pool, replica_pools,
+                             self.config.getfloat('Space', 'read_max_lag', fallback=5.0))
         space_id = await register_space(db_pool,
                                         self['space_name'],
                                         self['space_host'],
@@ -230,18 +283,164 @@ class SpaceServer(web.Application, SpacePermission):
                                         json.dumps(self['parameters']))
 
         self['db_pool'] = db_pool
+        self['read_pool'] = read_pool
         self['space_id'] = space_id
-        self['executor'] = UWSJobPool(space_id, db_pool, self)
-        self['db'] = NodeDatabase(space_id, db_pool, self)
+        # rows read from a lagging replica could be cached after their invalidation
+        node_cache = None
+        node_cache_size = self.config.getint('Space', 'node_cache_size', fallback=10000)
+        if node_cache_size > 0 and not read_dsns:
+            node_cache = NodeCache(space_id, node_cache_size)
+            await node_cache.setup(self.config['Space']['dsn'])
+        self['node_cache'] = node_cache
+        property_summary = PropertySummary(space_id, db_pool)
+        await property_summary.setup(self.config['Space']['dsn'])
+        self['property_summary'] = property_summary
+        # serialization failures and deadlocks are retried, counted per operation in stats()
+        self['retry'] = TransactionRetry(attempts=self.config.getint('Space', 'retry_attempts', fallback=5),
+                                         budget=self.config.getfloat('Space', 'retry_budget', fallback=0.2))
+        self['executor'] = UWSJobPool(space_id, db_pool, self, read_pool,
+                                      self.config.getint('Space', 'sync_job_destruction', fallback=3000),
+                                      self.config.getint('Space', 'async_job_destruction', fallback=3000),
+                                      self['retry'],
+                                      UWSJobScheduler(self.config.getint('Space', 'max_jobs', fallback=100),
+                                                      self.config.getint('Space', 'max_user_jobs', fallback=10)))
+        self['db'] = NodeDatabase(space_id, db_pool, self, read_pool, node_cache, property_summary)
+        # requests blocked on the phase of a job with WAIT share a single listener
+        phase_listener = UWSPhaseListener(space_id)
+        await phase_listener.setup(self.config['Space']['dsn'])
+        self['phase_listener'] = phase_listener
+        self['max_job_wait'] = self.config.getfloat('Space', 'max_job_wait', fallback=60.0)
+        self['job_event_queue_size'] = self.config.getint('Space', 'job_event_queue_size', fallback=1000)
+        # copies and moves are left to the workers, see worker.py
+        self['job_queue'] = self.config.getboolean('Space', 'job_queue', fallback=False)
+
+        self['trash'] = self.config.getboolean('Space', 'trash', fallback=False)
+        self['trash_batch_size'] = self.config.getint('Space', 'trash_batch_size', fallback=1000)
+        self['trash_interval'] = self.config.getfloat('Space', 'trash_interval', fallback=1.0)
+        self['trash_reaper'] = None
+        if self['trash']:
+            self['trash_reaper'] = asyncio.ensure_future(self._trash_reaper())
+
+        self['tree_batch_size'] = self.config.getint('Space', 'tree_batch_size', fallback=1000)
+        self['tree_interval'] = self.config.getfloat('Space', 'tree_interval', fallback=1.0)
+        self['tree_folder'] = asyncio.ensure_future(self._tree_folder())
+
+        self['job_batch_size'] = self.config.getint('Space', 'job_batch_size', fallback=1000)
+        self['job_interval'] = self.config.getfloat('Space', 'job_interval', fallback=10.0)
+        self['job_batch_delay'] = self.config.getfloat('Space', 'job_batch_delay', fallback=0.1)
+        self['job_reaper'] = None
+        if self.config.getboolean('Space', 'job_reaper', fallback=True):
+            self['job_reaper'] = asyncio.ensure_future(self._job_reaper())
+
+        # the hit, miss and eviction counts of the node cache are logged to tune node_cache_size
+        self['node_cache_stats_interval'] = self.config.getfloat('Space', 'node_cache_stats_interval',
+                                                                 fallback=300.0)
+        self['node_cache_reporter'] = None
+        if node_cache and self['node_cache_stats_interval'] > 0:
+            self['node_cache_reporter'] = asyncio.ensure_future(
+                self._node_cache_reporter(self['node_cache_stats_interval']))
 
     async def shutdown(self):
         """
         Shutdown VOSpace metadata services.
         """
+        for name in ('trash_reaper', 'tree_folder', 'job_reaper', 'node_cache_reporter'):
+            reaper = self.get(name)
+            if reaper:
+                reaper.cancel()
+                with suppress(asyncio.CancelledError):
+                    await reaper
+
+        node_cache = self.get('node_cache')
+        if node_cache:
+            await node_cache.close()
+
+        property_summary = self.get('property_summary')
+        if property_summary:
+            await property_summary.close()
+
+        phase_listener = self.get('phase_listener')
+        if phase_listener:
+            await phase_listener.close()
+
+        read_pool = self.get('read_pool')
+        if read_pool:
+            await read_pool.close()
+
         pool = self.get('db_pool')
         if pool:
             await pool.close()
 
+    async def reap_trash(self):
+        """
+        Remove a batch of the nodes deleted in trash mode along with their storage.
+
+        :return: number of nodes removed.
+        """
+        async with self['db_pool'].acquire() as conn:
+            async with conn.transaction():
+                nodes = await self['db'].reap_trash(conn, self['trash_batch_size'])
+        # a batch purges at most trash_batch_size nodes, none of them holding the transaction open
+        for node, root in nodes:
+            with suppress(OSError):
+                await self['abstract_space'].purge_storage_node(node, root)
+        return len(nodes)
+
+    async def _trash_reaper(self):
+        while True:
+            with _log_errors('trash reaper'):
+                await self.reap_trash()
+            await asyncio.sleep(self['trash_interval'])
+
+    async def fold_tree_totals(self):
+        """
+        Fold a batch of the pending changes to the container totals into the nodes.
+
+        :return: number of containers updated.
+        """
+        async with self['db_pool'].acquire() as conn:
+            async with conn.transaction():
+                return await self['db'].fold_tree_deltas(conn, self['tree_batch_size'])
+
+    async def _tree_folder(self):
+        while True:
+            with _log_errors('tree folder'):
+                await self.fold_tree_totals()
+            await asyncio.sleep(self['tree_interval'])
+
+    async def reap_jobs(self):
+        """
+        Remove a batch of the jobs past their destruction time.
+
+        :return: number of jobs removed.
+        """
+        return await self['executor'].reap(self['job_batch_size'])
+
+    async def _job_reaper(self):
+        while True:
+            with _log_errors('job partition maintenance'):
+                await self['executor'].maintain_partitions()
+            with _log_errors('job reaper'):
+                # catch up on a backlog before sleeping, yielding to the requests between batches
+                while await self.reap_jobs() >= self['job_batch_size']:
+                    await asyncio.sleep(self['job_batch_delay'])
+            await asyncio.sleep(self['job_interval'])
+
+    def log_node_cache_stats(self):
+        """
+        Log the counters of the node cache at INFO.
+        """
+        stats = self['node_cache'].stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        logger.info('node cache: %s', ' '.join(f'{key}={value}' for key, value in stats.items()))
+
+    async def _node_cache_reporter(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            with _log_errors('node cache stats'):
+                self.log_node_cache_stats()
+
     async def permits(self, identity, permission, context):
         autz_policy = self.get(AUTZ_KEY)
         if autz_policy is None:
@@ -290,13 +489,27 @@ class SpaceServer(web.Application, SpacePermission):
             return web.Response(status=500, text=str(g))
 
     async def _get_node(self, request):
+        chunks = get_node_request(request)
         try:
-            node = await get_node_request(request)
-            return web.Response(status=200, content_type='text/xml', text=node.tostring())
-        except VOSpaceError as e:
-            return web.Response(status=e.code, text=e.error)
-        except Exception as g:
-            return web.Response(status=500, text=str(g))
+            try:
+                chunk = await chunks.__anext__()
+            except VOSpaceError as e:
+                return web.Response(status=e.code, text=e.error)
+            except Exception as g:
+                return web.Response(status=500, text=str(g))
+
+            # Headers are sent from here on, an error can only abort the response.
+            response = web.StreamResponse(status=200)
+            response.content_type = 'text/xml'
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            await response.write(chunk)
+            async for chunk in chunks:
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            await chunks.aclose()
 
     async def _create_node(self, request):
         try:
@@ -351,6 +564,28 @@ class SpaceServer(web.Application, SpacePermission):
         except Exception:
             return web.Response(status=500)
 
+    async def _get_job_events(self, request):
+        events = job_events_request(request)
+        try:
+            try:
+                chunk = await events.__anext__()
+            except VOSpaceError as e:
+                return web.Response(status=e.code, text=e.error)
+            except Exception as g:
+                return web.Response(status=500, text=str(g))
+
+            response = web.StreamResponse(status=200)
+            response.content_type = 'text/event-stream'
+            response.headers['Cache-Control'] = 'no-cache'
+            await response.prepare(request)
+            await response.write(chunk)
+            async for chunk in events:
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            await events.aclose()
+
     async def _get_transfer_details(self, request):
         try:
             xml = await get_transfer_details_request(request)
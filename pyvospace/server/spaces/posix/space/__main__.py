@@ -27,6 +27,7 @@ import configparser
 
 from aiohttp import web
 
+from pyvospace.server.worker import run_worker
 from .posix_space import PosixSpaceServer
 
 
@@ -58,5 +59,19 @@ def main(args=None):
     web.run_app(app, host='localhost', port=port, ssl_context=context)
 
 
+def worker(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', type=str, action='store')
+    args = parser.parse_args()
+
+    if args.cfg:
+        cfg_file = args.cfg
+    else:
+        app_path = os.path.dirname(os.path.realpath(__file__))
+        cfg_file = f"{app_path}/cfg/space.ini"
+
+    run_worker(PosixSpaceServer, cfg_file)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
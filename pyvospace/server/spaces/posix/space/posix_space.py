@@ -33,7 +33,7 @@ from pyvospace.core.model import Views, View, Protocols, \
     Node, NodeTextLookup, NodeType, Properties, Property, Protocol,\
     PushToSpace, PullFromSpace, HTTPGet, HTTPSGet, HTTPPut, HTTPSPut, Endpoint, SecurityMethod, UWSJob
 
-from pyvospace.server.spaces.posix.utils import move, copy, mkdir, remove, rmtree, exists, touch
+from pyvospace.server.spaces.posix.utils import move, copy, mkdir, remove, rmtree, exists, touch, isfile
 from pyvospace.server.spaces.posix.auth import DBUserAuthentication, DBUserNodeAuthorizationPolicy
 from pyvospace.core.exception import VOSpaceError
 
@@ -81,6 +81,7 @@ class PosixSpaceServer(SpaceServer, AbstractSpace):
 
         await mkdir(self.root_dir)
         await mkdir(self.staging_dir)
+        await mkdir(f"{self.staging_dir}/trash")
 
         setup_session(self,
                       EncryptedCookieStorage(
@@ -164,6 +165,23 @@ class PosixSpaceServer(SpaceServer, AbstractSpace):
             if await exists(m_path):
                 await remove(m_path)
 
+    def _trash_path(self, node):
+        return f"{self.staging_dir}/trash/{node.id}"
+
+    async def trash_storage_node(self, node):
+        m_path = f"{self.root_dir}/{node.path}"
+        if await exists(m_path):
+            await move(m_path, self._trash_path(node))
+
+    async def purge_storage_node(self, node, root):
+        # Only the root of a deleted tree has been moved to the trash, the rest
+        # of the tree is below it. A container is purged after its children.
+        t_path = f"{self._trash_path(root)}{node.path[len(root.path):]}"
+        if await isfile(t_path):
+            await remove(t_path)
+        elif await exists(t_path):
+            await rmtree(t_path)
+
     async def get_transfer_protocols(self, job: UWSJob) -> List[Protocol]:
         new_protocols = []
         protocols = job.job_info.protocols
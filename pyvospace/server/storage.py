@@ -20,6 +20,7 @@
 #    MA 02111-1307  USA
 
 import json
+import math
 import asyncio
 import asyncpg
 import aiohttp
@@ -35,7 +36,7 @@ from pyvospace.core.model import Storage
 from pyvospace.core.exception import VOSpaceError, PermissionDenied, NodeBusyError, InvalidJobError, \
     InvalidJobStateError, NodeDoesNotExistError
 from .auth import SpacePermission
-from .uws import StorageUWSJobPool, StorageUWSJob
+from .uws import StorageUWSJobPool, StorageUWSJob, UWSJobScheduler
 
 
 class HTTPSpaceStorageServer(web.Application, SpacePermission):
@@ -57,6 +58,7 @@ class HTTPSpaceStorageServer(web.Application, SpacePermission):
         self.https = self.config.getboolean('Storage', 'https', fallback=False)
         self.port = self.config.getint('Storage', 'port')
         self.parameters = json.loads(self.config.get('Storage', 'parameters'))
+        self.max_busy_wait = self.config.getfloat('Storage', 'max_busy_wait', fallback=30.0)
         self.space_id = None
         self.db_pool = None
         self.executor = None
@@ -76,6 +78,7 @@ class HTTPSpaceStorageServer(web.Application, SpacePermission):
                 if not space_result:
                     raise VOSpaceError(404, f'Space not found. {self.name}')
                 self.space_id = space_result['id']
+                await conn.execute("select create_space_partitions($1)", self.space_id)
                 result = await conn.fetchrow("insert into storage (name, host, port, parameters, https) "
                                              "values ($1, $2, $3, $4, $5) on conflict (name, host, port) "
                                              "do update set parameters=$4, https=$5 returning *",
@@ -86,7 +89,9 @@ class HTTPSpaceStorageServer(web.Application, SpacePermission):
                                        result['parameters'], result['https'], result['enabled'])
 
         self.executor = StorageUWSJobPool(self.space_id, self.storage, self.db_pool,
-                                          self.config.get('Space', 'dsn'), self)
+                                          self.config.get('Space', 'dsn'), self,
+                                          UWSJobScheduler(self.config.getint('Storage', 'max_jobs', fallback=100),
+                                                          self.config.getint('Storage', 'max_user_jobs', fallback=10)))
         await self.executor.setup()
         self['AIOJOBS_SCHEDULER'] = await create_scheduler()
         self.set_router()
@@ -145,7 +150,16 @@ class HTTPSpaceStorageServer(web.Application, SpacePermission):
             if identity is None:
                 raise PermissionDenied(f'Credentials not found.')
 
-            response = await self.executor.execute(job_id, identity, func, request)
+            # a client can ask to wait for a busy node rather than being refused at once
+            try:
+                wait = float(request.query.get('wait', 0))
+            except ValueError:
+                wait = math.nan
+            if not math.isfinite(wait):
+                return web.Response(status=400, text='Invalid Argument. wait is not a number.')
+            wait = min(max(wait, 0), self.max_busy_wait)
+
+            response = await self.executor.execute(job_id, identity, func, request, wait=wait)
             await asyncio.shield(self.executor.set_completed(job_id))
             return response
 
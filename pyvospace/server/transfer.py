@@ -48,64 +48,69 @@ async def _perform_transfer_job(job, app, identity, sync, redirect):
     try:
         if isinstance(job.job_info, ProtocolTransfer):
 
-            async with db_pool.acquire() as conn:
-                async with conn.transaction():
+            async def protocol_transfer(conn):
+                if isinstance(job.job_info, PushToSpace):
+                    _, child_row = await app['db']._lock_node_and_parent(job.job_info.target.path, conn)
+                else:
+                    # a download only reads the target, concurrent ones do not wait on each other
                     _, child_row = await app['db']._get_node_and_parent(job.job_info.target.path, conn)
-                    if isinstance(job.job_info, PushToSpace):
-                        # If there is no Node at the target URI, then the service SHALL
-                        # create a new Node using the uri and the default xsi:type for the space.
-                        if child_row:
-                            node = NodeDatabase._resultset_to_node([child_row], [])
-                            # If a Node already exists at the target URI,
-                            # then the data SHALL be imported into the existing Node
-                            # and the Node properties SHALL be cleared unless the node is a ContainerNode.
-                            if node.node_type != NodeType.ContainerNode:
-                                await app['db'].delete_properties(path=job.job_info.target.path, conn=conn)
-                                node.remove_properties()
-                        else:
-                            node = DataNode(path=job.job_info.target.path)
-                            await app['db'].create(node=node, conn=conn, identity=identity)
-                            await app['abstract_space'].create_storage_node(node)
-
-                        '''import_views = app['accepts_views'].get(node.node_type_text, [])
-                        if transfer.view:
-                            if transfer.view.uri not in import_views:
-                                raise VOSpaceError(400, f"View Not Supported. "
-                                                        f"View {transfer.view.uri} not supported.")'''
+                if isinstance(job.job_info, PushToSpace):
+                    # If there is no Node at the target URI, then the service SHALL
+                    # create a new Node using the uri and the default xsi:type for the space.
+                    if child_row:
+                        node = NodeDatabase._resultset_to_node([child_row])
+                        # If a Node already exists at the target URI,
+                        # then the data SHALL be imported into the existing Node
+                        # and the Node properties SHALL be cleared unless the node is a ContainerNode.
+                        if node.node_type != NodeType.ContainerNode:
+                            await app['db'].delete_properties(path=job.job_info.target.path, conn=conn)
+                            node.remove_properties()
                     else:
-                        if not child_row:
-                            raise NodeDoesNotExistError(f"{job.job_info.target.path} not found.")
-                        node = NodeDatabase._resultset_to_node([child_row], [])
-
-                    # Can't upload or download data to/from linknode
-                    # Left out ContainerNode as the specific storage implementation might want to unpack
-                    # it and create nodes.
-                    if node.node_type == NodeType.LinkNode:
-                        raise VOSpaceError(400, 'Operation Not Supported. No data transfer to a LinkNode.')
-
-                    job.node_path_modified = node.path_modified
-                    job.job_info.target = node
-                    job.transfer = copy.deepcopy(job.job_info)
-                    new_protocols = await app['abstract_space'].get_transfer_protocols(job)
-                    job.transfer.set_protocols(new_protocols)
-
-                    job.results = [UWSResult('transferDetails',
-                                            {'{http://www.w3.org/1999/xlink}href':
-                                                 f"/vospace/transfers/{job.job_id}/results/transferDetails"}),
-                                   UWSResult('dataNode',
-                                            {'{http://www.w3.org/1999/xlink}href':
-                                                 f"vos://{app['uri']}!vospace/{job.job_info.target.path}"})]
-
-                    endpoint = None
-                    if redirect:
-                        if len(job.transfer.protocols) <= 0:
-                            raise InvalidArgument("Protocol endpoint not found.")
-                        endpoint = str(job.transfer.protocols[0].endpoint.url)
-
-                    await fuzz(2)
-                    job.phase = UWSPhase.Executing
-                    await app['executor']._update_uws_job(job, conn)
-                    return endpoint
+                        node = DataNode(path=job.job_info.target.path)
+                        await app['db'].create(node=node, conn=conn, identity=identity)
+                        await app['abstract_space'].create_storage_node(node)
+
+                    '''import_views = app['accepts_views'].get(node.node_type_text, [])
+                    if transfer.view:
+                        if transfer.view.uri not in import_views:
+                            raise VOSpaceError(400, f"View Not Supported. "
+                                                    f"View {transfer.view.uri} not supported.")'''
+                else:
+                    if not child_row:
+                        raise NodeDoesNotExistError(f"{job.job_info.target.path} not found.")
+                    node = NodeDatabase._resultset_to_node([child_row])
+
+                # Can't upload or download data to/from linknode
+                # Left out ContainerNode as the specific storage implementation might want to unpack
+                # it and create nodes.
+                if node.node_type == NodeType.LinkNode:
+                    raise VOSpaceError(400, 'Operation Not Supported. No data transfer to a LinkNode.')
+
+                job.node_id = node.id
+                job.job_info.target = node
+                job.transfer = copy.deepcopy(job.job_info)
+                new_protocols = await app['abstract_space'].get_transfer_protocols(job)
+                job.transfer.set_protocols(new_protocols)
+
+                job.results = [UWSResult('transferDetails',
+                                        {'{http://www.w3.org/1999/xlink}href':
+                                             f"/vospace/transfers/{job.job_id}/results/transferDetails"}),
+                               UWSResult('dataNode',
+                                        {'{http://www.w3.org/1999/xlink}href':
+                                             f"vos://{app['uri']}!vospace/{job.job_info.target.path}"})]
+
+                endpoint = None
+                if redirect:
+                    if len(job.transfer.protocols) <= 0:
+                        raise InvalidArgument("Protocol endpoint not found.")
+                    endpoint = str(job.transfer.protocols[0].endpoint.url)
+
+                await fuzz(2)
+                job.phase = UWSPhase.Executing
+                await app['executor']._update_uws_job(job, conn)
+                return endpoint
+
+            return await app['retry'].transaction('transfer', db_pool, protocol_transfer)
         else:
             if sync is True:
                 raise VOSpaceError(403, "Permission Denied. Move/Copy denied.")
@@ -126,6 +131,7 @@ async def _perform_transfer_job(job, app, identity, sync, redirect):
             # need to shield because we have successfully completed a potentially expensive operation
             with suppress(asyncio.CancelledError):
                 await asyncio.shield(app['executor'].set_completed(job.job_id))
+                await asyncio.shield(app['read_pool'].mark_written(identity))
 
     except VOSpaceError:
         raise
@@ -157,114 +163,93 @@ async def _move_nodes(app, target, direction, perform_copy, identity):
         else:
             direction_path_parent_tree = ''
 
-        async with app['db_pool'].acquire() as conn:
-            async with conn.transaction():
-                target_record = None
-                direct_record = None
-                direct_parent_record = None
-
-                if direction_path_parent_tree:
-                    results = await conn.fetch("select *, path = subltree($2, 0, nlevel(path)) as common "
-                                               "from nodes where path <@ $1 or path <@ $3 and space_id=$4 "
-                                               "order by path asc for update",
-                                               target_path_tree, direction_path_tree,
-                                               direction_path_parent_tree, space_id)
-                    for result in results:
-                        if result['path'] == target_path_tree:
-                            target_record = result
-                        if result['path'] == direction_path_parent_tree:
-                            direct_parent_record = result
-                        if result['path'] == direction_path_tree:
-                            direct_record = result
-                        if target_record and direct_record:
-                            break
-                else:
-                    results = await conn.fetch("select *, path = subltree($2, 0, nlevel(path)) as common "
-                                               "from nodes where path <@ $1 or path <@ $2 and space_id=$3 "
-                                               "order by path asc for update",
-                                               target_path_tree, direction_path_tree, space_id)
-                    for result in results:
-                        if result['path'] == target_path_tree:
-                            target_record = result
-                        if result['path'] == direction_path_tree:
-                            direct_record = result
-                        if target_record and direct_record:
-                            break
-
-                if target_record is None:
-                    raise VOSpaceError(404, f"Node Not Found. {target_path} not found.")
-
-                target_type = target_record['type']
-                if target_type == NodeType.LinkNode:
-                    raise VOSpaceError(400, "Invalid URI. Target is a LinkNode")
-
-                if target_record['common'] is True and target_record['type'] == NodeType.ContainerNode:
-                    raise VOSpaceError(400, f"Invalid URI. Moving {target_path} -> {direction_path} "
-                                            f"is invalid.")
-
-                if direct_record:
-                    raise VOSpaceError(400, f"Duplicate Node. {direction_path}")
-
-                if direction_path_parent_tree and direct_parent_record is None:
-                    raise VOSpaceError(404, f"Node Not Found. Direction {direction_path_parent} not found.")
-
-                if direction_path_parent_tree and direct_parent_record['type'] != NodeType.ContainerNode:
-                    raise VOSpaceError(400, f"Duplicate Node. Direction {direction_path_parent} not container.")
-
-                src = NodeDatabase.resultset_to_node_tree([target_record], [])
-                if direct_parent_record:
-                    dest_parent = NodeDatabase.resultset_to_node_tree([direct_parent_record], [])
-                else:
-                    dest_parent = ContainerNode('/')
-                dest = copy.deepcopy(direction)
-
-                if perform_copy:
-                    if not await app.permits(identity, 'copyNode', context=(src, dest_parent)):
-                        raise PermissionDenied('copyNode denied.')
-
-                    prop_results = await conn.fetch("select properties.uri, properties.value, "
-                                                    "properties.read_only, properties.space_id, "
-                                                    "$2||subpath(node_path, nlevel($1)-1) as concat "
-                                                    "from nodes inner join properties on "                    
-                                                    "nodes.path = properties.node_path and "
-                                                    "nodes.space_id = properties.space_id "
-                                                    "where nodes.path <@ $1 and nodes.space_id=$3",
-                                                    target_path_tree, direction_path_parent_tree, space_id)
-
-                    await conn.execute("insert into nodes(name, type, owner, groupread, groupwrite, "
-                                       "space_id, link, path) "
-                                       "(select name, type, owner, groupread, groupwrite, "
-                                       "space_id, link, $2||subpath(path, nlevel($1)-1) as concat "
-                                       "from nodes where path <@ $1 and space_id=$3)",
-                                       target_path_tree, direction_path_parent_tree, space_id)
-
-                    user_props_insert = []
-                    for prop in prop_results:
-                        user_props_insert.append(tuple(prop))
-
-                    await conn.executemany("insert into properties (uri, value, read_only, space_id, node_path) "
-                                           "values ($1, $2, $3, $4, $5)",
-                                           user_props_insert)
-
-                    await app['abstract_space'].copy_storage_node(src, dest)
-                else:
-                    if not await app.permits(identity, 'moveNode', context=(src, dest_parent)):
-                        raise PermissionDenied('moveNode denied.')
-
-                    # Behave the same way as a linux mv command.
-                    # mv /test/test1 /test/test2 - rename test1 to test2
-                    # mv /test/test1 /test/dir/test1 - move file to /test/dir/
-                    # mv /test/test1 /test/dir/test2 - move file to /test/dir/ and rename to test2
-                    await conn.execute("update nodes set name = ("
-                                       "case when nlevel(subpath(path, nlevel($1)-1))=1 then $4 else name end), "
-                                       "path = $2||regexp_replace(subpath(path, nlevel($1)-1)::text, "
-                                       "subpath(subpath(path, nlevel($1)-1), 0, 1)::text||'*', "
-                                       "subpath($3, -1, 1)::text)::ltree "
-                                       "where path <@ $1 and space_id=$5",
-                                       target_path_tree, direction_path_parent_tree,
-                                       direction_path_tree, direction.name, space_id)
-
-                    await app['abstract_space'].move_storage_node(src, dest)
+        async def move(conn):
+            # Lock the target and the direction in path order, the parent of the direction
+            # is intent locked with it. A copy only reads the target.
+            locks = [(target_path_tree, 'S' if perform_copy else 'X'), (direction_path_tree, 'X')]
+            for path_tree, mode in sorted(locks):
+                await app['db'].lock_path(path_tree, conn, mode)
+            records = {}
+            for path_tree in filter(None, [target_path_tree, direction_path_parent_tree]):
+                records[path_tree] = await conn.fetchrow("select nodes.*, walk.path from node_walk($2, $1) walk "
+                                                         "join nodes on nodes.space_id=$2 and nodes.id=walk.id "
+                                                         "where walk.path=$1",
+                                                         path_tree, space_id)
+            target_record = records[target_path_tree]
+            direct_parent_record = records.get(direction_path_parent_tree)
+            direct_record = await conn.fetchrow("select id from node_walk($2, $1) where path=$1",
+                                                direction_path_tree, space_id)
+
+            if target_record is None:
+                raise VOSpaceError(404, f"Node Not Found. {target_path} not found.")
+
+            target_type = target_record['type']
+            if target_type == NodeType.LinkNode:
+                raise VOSpaceError(400, "Invalid URI. Target is a LinkNode")
+
+            common = direction_path_tree == target_path_tree or \
+                direction_path_tree.startswith(f'{target_path_tree}.')
+            if common and target_record['type'] == NodeType.ContainerNode:
+                raise VOSpaceError(400, f"Invalid URI. Moving {target_path} -> {direction_path} "
+                                        f"is invalid.")
+
+            if direct_record:
+                raise VOSpaceError(400, f"Duplicate Node. {direction_path}")
+
+            if direction_path_parent_tree and direct_parent_record is None:
+                raise VOSpaceError(404, f"Node Not Found. Direction {direction_path_parent} not found.")
+
+            if direction_path_parent_tree and direct_parent_record['type'] != NodeType.ContainerNode:
+                raise VOSpaceError(400, f"Duplicate Node. Direction {direction_path_parent} not container.")
+
+            src = NodeDatabase.resultset_to_node_tree([target_record])
+            if direct_parent_record:
+                dest_parent = NodeDatabase.resultset_to_node_tree([direct_parent_record])
+            else:
+                dest_parent = ContainerNode('/')
+            dest = copy.deepcopy(direction)
+
+            if perform_copy:
+                if not await app.permits(identity, 'copyNode', context=(src, dest_parent)):
+                    raise PermissionDenied('copyNode denied.')
+
+                # each copied node gets a new id, its parent is the copy of its parent
+                await conn.execute("with tree as "
+                                   "(select id, uuid_generate_v4() as copy_id from node_tree($3, $1)) "
+                                   "insert into nodes(id, parent_id, name, label, type, owner, groupread, "
+                                   "groupwrite, space_id, link, size, properties) "
+                                   "(select tree.copy_id, coalesce(parent.copy_id, $2), nodes.name, nodes.label, "
+                                   "nodes.type, nodes.owner, nodes.groupread, nodes.groupwrite, nodes.space_id, "
+                                   "nodes.link, nodes.size, nodes.properties "
+                                   "from tree join nodes on nodes.space_id=$3 and nodes.id=tree.id "
+                                   "left join tree as parent on parent.id=nodes.parent_id)",
+                                   target_path_tree,
+                                   direct_parent_record['id'] if direct_parent_record else None, space_id)
+
+                app['db'].invalidate(direction_path_tree)
+                await app['abstract_space'].copy_storage_node(src, dest)
+            else:
+                if not await app.permits(identity, 'moveNode', context=(src, dest_parent)):
+                    raise PermissionDenied('moveNode denied.')
+
+                # Behave the same way as a linux mv command.
+                # mv /test/test1 /test/test2 - rename test1 to test2
+                # mv /test/test1 /test/dir/test1 - move file to /test/dir/
+                # mv /test/test1 /test/dir/test2 - move file to /test/dir/ and rename to test2
+                # Only the row of the target changes, the nodes below it follow their parent.
+                await conn.execute("update nodes set name=$2, label=$3, parent_id=$4 "
+                                   "where space_id=$5 and id=$1",
+                                   target_record['id'], direction.name,
+                                   direction_path_tree.rpartition('.')[2],
+                                   direct_parent_record['id'] if direct_parent_record else None,
+                                   space_id)
+
+                app['db'].invalidate(target_path_tree)
+                app['db'].invalidate(direction_path_tree)
+                await app['abstract_space'].move_storage_node(src, dest)
+
+        await app['retry'].transaction('copy_node' if perform_copy else 'move_node',
+                                       app['db_pool'], move)
 
     except asyncpg.exceptions.UniqueViolationError as f:
         raise VOSpaceError(409, f"Duplicate Node. {f.detail}")
@@ -19,34 +19,66 @@
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
 #    MA 02111-1307  USA
 
+import os
+import socket
 import datetime
 import asyncio
 import functools
 import asyncpg
 import json
 
-from contextlib import suppress
+from contextlib import suppress, contextmanager, asynccontextmanager
+from collections import defaultdict, deque, Counter, OrderedDict
 
-from pyvospace.core.model import UWSPhase, UWSJob, UWSResult, Transfer, \
-    ProtocolTransfer, Copy, Move, Node, ContainerNode
+from pyvospace.core.model import UWSPhase, UWSPhaseLookup, UWSJob, UWSResult, Transfer, \
+    ProtocolTransfer, PullFromSpace, NodeTransfer, Copy, Move, Node, ContainerNode
 from pyvospace.core.exception import VOSpaceError, JobDoesNotExistError, InvalidJobError, \
     InvalidJobStateError, PermissionDenied, NodeDoesNotExistError, ClosingError, NodeBusyError
 from .database import NodeDatabase
+from .replica import ReadPool
+from .retry import TransactionRetry
 from pyvospace.server import busy_fuzz
 
 
+# Prefix of the channels the triggers on uws_jobs notify on when a job is created,
+# deleted or changes phase. Each space has its own, the payload is the action and
+# the id, space_id, phase and owner of the job.
+UWS_JOBS_CHANNEL = 'uws_jobs'
+
+
+def uws_jobs_channel(space_id):
+    return f'{UWS_JOBS_CHANNEL}_{space_id}'
+
+
 class UWSJobPool(object):
-    def __init__(self, space_id, db_pool, permission):
+    # Seconds a partition DDL statement of the reaper waits for the jobs being worked on.
+    reap_lock_timeout = 1.0
+
+    def __init__(self, space_id, db_pool, permission, read_pool=None,
+                 sync_destruction=3000, async_destruction=3000, retry=None, scheduler=None):
         self.db_pool = db_pool
+        self.read_pool = read_pool if read_pool else ReadPool(db_pool)
         self.space_id = space_id
-        self.executor = UWSJobExecutor(space_id)
+        self.executor = UWSJobExecutor(space_id, scheduler)
         self.permission = permission
+        # seconds a job is kept for after its creation
+        self.sync_destruction = sync_destruction
+        self.async_destruction = async_destruction
+        self.retry = retry if retry else TransactionRetry()
+        # recorded on the jobs this pool runs, so no worker claims them
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
 
     async def close(self):
         await self.executor.close()
 
-    async def get_uws_job_phase(self, job_id):
-        async with self.db_pool.acquire() as conn:
+    def _read_conn(self, identity, primary):
+        # a read that must see the latest phase, not a replica behind a notification
+        if primary:
+            return self.db_pool.acquire()
+        return self.read_pool.acquire(identity)
+
+    async def get_uws_job_phase(self, job_id, identity=None, primary=False):
+        async with self._read_conn(identity, primary) as conn:
             async with conn.transaction():
                 result = await conn.fetchrow("select phase, owner from uws_jobs "
                                              "where id=$1 and space_id=$2",
@@ -85,12 +117,12 @@ class UWSJobPool(object):
                                      "(select id, space_id, phase from uws_jobs "
                                      "where id=$7 and space_id=$8 for update) "
                                      "update uws_jobs set phase=$1, results=$2, "
-                                     "transfer=$3, node_path=$4, node_path_modified=$5 "
+                                     "transfer=$3, node_path=$4, node_id=$5 "
                                      "from cte where cte.phase<=$6 and "
                                      "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
                                      "returning cte.id",
                                      job.phase, results_string, transfer_string,
-                                     target_tree, job.node_path_modified, UWSPhase.Executing,
+                                     target_tree, job.node_id, UWSPhase.Executing,
                                      job.job_id, self.space_id)
         if not result:
             raise InvalidJobStateError('Job not found or (ABORTED, ERROR)')
@@ -105,22 +137,55 @@ class UWSJobPool(object):
         job.owner = result['owner']
         return job
 
-    async def get(self, job_id):
-        async with self.db_pool.acquire() as conn:
+    async def get(self, job_id, identity=None, primary=False):
+        async with self._read_conn(identity, primary) as conn:
             result = await self._get_uws_job_conn(conn=conn, job_id=job_id)
         return self._resultset_to_job(result)
 
-    async def create(self, job_info, identity, phase=UWSPhase.Pending):
+    async def create(self, job_info, identity, phase=UWSPhase.Pending, sync=False):
         job_info_string = job_info.tostring()
-        destruction = datetime.datetime.utcnow() + datetime.timedelta(seconds=3000)
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                result = await conn.fetchrow("insert into uws_jobs (phase, destruction, job_info, owner, space_id) "
-                                             "values ($1, $2, $3, $4, $5) returning *",
-                                             phase, destruction, job_info_string, identity, self.space_id)
+        lifetime = self.sync_destruction if sync else self.async_destruction
+        destruction = datetime.datetime.utcnow() + datetime.timedelta(seconds=lifetime)
+        priority = UWSJobScheduler.INTERACTIVE if sync else UWSJobScheduler.BULK
+        result = await self._fetchrow('create_job',
+                                      "insert into uws_jobs (phase, destruction, job_info, owner, space_id, priority) "
+                                      "values ($1, $2, $3, $4, $5, $6) returning *",
+                                      phase, destruction, job_info_string, identity, self.space_id, priority)
         return self._resultset_to_job(result)
 
-    async def execute(self, job_id, identity, func, *args):
+    async def maintain_partitions(self):
+        """
+        Create the job partitions of the coming day and drop the days whose
+        jobs have all expired.
+        """
+        async with self.db_pool.acquire() as conn:
+            async with conn.transaction():
+                # partition DDL locks uws_jobs, never queue in front of the requests
+                await conn.execute(f"set local lock_timeout = {int(self.reap_lock_timeout * 1000)}")
+                await conn.execute("select create_job_partitions($1, 1)", self.space_id)
+                await conn.execute("select drop_job_partitions($1)", self.space_id)
+
+    async def reap(self, limit):
+        """
+        Delete at most limit of the jobs of the space past their destruction time.
+        Jobs locked by a transaction are left for a later call.
+
+        :return: number of jobs deleted.
+        """
+        now = datetime.datetime.utcnow()
+        async with self.db_pool.acquire() as conn:
+            results = await conn.fetch("delete from uws_jobs where space_id=$1 and id in "
+                                       "(select id from uws_jobs where space_id=$1 and destruction<$2 "
+                                       "limit $3 for update skip locked) returning id",
+                                       self.space_id, now, limit)
+        return len(results)
+
+    async def execute(self, job_id, identity, func, *args, queue=False):
+        """
+        Run a PENDING job, awaiting func(job, *args).
+
+        :param queue: leave a copy or move QUEUED for a worker to claim instead of running it.
+        """
         async with self.db_pool.acquire() as conn:
             async with conn.transaction():
                 result = await self._get_uws_job_conn(conn=conn, job_id=job_id, for_update=True)
@@ -132,66 +197,140 @@ class UWSJobPool(object):
                 if not await self.permission.permits(identity, 'runJob', context=job):
                     raise PermissionDenied('runJob denied.')
 
-                fut = self.executor.execute(job, func, *args)
+                if queue and isinstance(job.job_info, NodeTransfer):
+                    await conn.execute("update uws_jobs set phase=$1, worker=null, lease_expires=null "
+                                       "where id=$2 and space_id=$3",
+                                       UWSPhase.Queued, job.job_id, self.space_id)
+                    return None
+
+                # the job is QUEUED while it waits for the scheduler
+                fut = self.executor.execute(job, func, *args, priority=result['priority'],
+                                            queued=functools.partial(self.set_queued, job.job_id))
         return await fut
 
     async def abort(self, job_id, identity):
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                result = await self._get_uws_job_conn(conn=conn, job_id=job_id, for_update=True)
-                if result['phase'] in (UWSPhase.Completed, UWSPhase.Error):
-                    raise InvalidJobStateError("Can't cancel a job that is COMPLETED or in ERROR.")
+        async def abort(conn):
+            result = await self._get_uws_job_conn(conn=conn, job_id=job_id, for_update=True)
+            if result['phase'] in (UWSPhase.Completed, UWSPhase.Error):
+                raise InvalidJobStateError("Can't cancel a job that is COMPLETED or in ERROR.")
 
-                job = self._resultset_to_job(result)
-                if isinstance(job, Copy) or isinstance(job, Move):
-                    # aborting a file copy or move can produce weird results so ignore it
-                    if job.phase >= UWSPhase.Executing:
-                        raise InvalidJobStateError("Can't abort a move/copy that is EXECUTING.")
+            job = self._resultset_to_job(result)
+            if isinstance(job, Copy) or isinstance(job, Move):
+                # aborting a file copy or move can produce weird results so ignore it
+                if job.phase >= UWSPhase.Executing:
+                    raise InvalidJobStateError("Can't abort a move/copy that is EXECUTING.")
 
-                if not await self.permission.permits(identity, 'abortJob', context=job):
-                    raise PermissionDenied('abortJob denied.')
+            if not await self.permission.permits(identity, 'abortJob', context=job):
+                raise PermissionDenied('abortJob denied.')
 
-                with suppress(asyncio.CancelledError):
-                    await asyncio.shield(self.set_aborted(job_id, conn))
+            await self.set_aborted(job_id, conn)
+
+        with suppress(asyncio.CancelledError):
+            await asyncio.shield(self.retry.transaction('abort_job', self.db_pool, abort))
 
         with suppress(asyncio.CancelledError):
             await asyncio.shield(self.executor.abort(job_id))
 
+    async def set_queued(self, job_id):
+        return await self._fetchrow('set_queued',
+                                    "with cte as (select id, space_id, phase from uws_jobs "
+                                    "where id=$1 and space_id=$4 for update)"
+                                    "update uws_jobs set phase=$2, worker=$5 "
+                                    "from cte where cte.phase=$3 and "
+                                    "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
+                                    "returning cte.id",
+                                    job_id, UWSPhase.Queued,
+                                    UWSPhase.Pending, self.space_id, self.worker_id)
+
     async def set_executing(self, job_id):
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await conn.fetchrow("with cte as (select id, space_id, phase from uws_jobs "
-                                           "where id=$1 and space_id=$4 for update)"
-                                           "update uws_jobs set phase=$2 "
-                                           "from cte where cte.phase=$3 and "
-                                           "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
-                                           "returning cte.id",
-                                           job_id, UWSPhase.Executing,
-                                           UWSPhase.Pending, self.space_id)
+        return await self._fetchrow('set_executing',
+                                    "with cte as (select id, space_id, phase from uws_jobs "
+                                    "where id=$1 and space_id=$4 for update)"
+                                    "update uws_jobs set phase=$2 "
+                                    "from cte where cte.phase=any($3::integer[]) and "
+                                    "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
+                                    "returning cte.id",
+                                    job_id, UWSPhase.Executing,
+                                    [UWSPhase.Pending, UWSPhase.Queued], self.space_id)
 
     async def set_completed(self, job_id):
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await conn.fetchrow("with cte as (select id, space_id, phase from uws_jobs "
-                                           "where id=$1 and space_id=$4 for update)"
-                                           "update uws_jobs set phase=$2 "
-                                           "from cte where cte.phase=$3 and "
-                                           "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
-                                           "returning cte.id",
-                                           job_id, UWSPhase.Completed,
-                                           UWSPhase.Executing, self.space_id)
+        return await self._fetchrow('set_completed',
+                                    "with cte as (select id, space_id, phase from uws_jobs "
+                                    "where id=$1 and space_id=$4 for update)"
+                                    "update uws_jobs set phase=$2 "
+                                    "from cte where cte.phase=$3 and "
+                                    "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
+                                    "returning cte.id",
+                                    job_id, UWSPhase.Completed,
+                                    UWSPhase.Executing, self.space_id)
 
     async def set_error(self, job_id, error):
-        async with self.db_pool.acquire() as conn:
-            async with conn.transaction():
-                return await conn.fetchrow("with cte as (select id, space_id, phase from uws_jobs "
-                                           "where id=$1 and space_id=$5 for update)"
-                                           "update uws_jobs set phase=$3, error=$2 "
-                                           "from cte where cte.phase!=$4 and "
-                                           "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
-                                           "returning cte.id",
-                                           job_id, error, UWSPhase.Error,
-                                           UWSPhase.Aborted, self.space_id)
+        return await self._fetchrow('set_error',
+                                    "with cte as (select id, space_id, phase from uws_jobs "
+                                    "where id=$1 and space_id=$5 for update)"
+                                    "update uws_jobs set phase=$3, error=$2 "
+                                    "from cte where cte.phase!=$4 and "
+                                    "uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
+                                    "returning cte.id",
+                                    job_id, error, UWSPhase.Error,
+                                    UWSPhase.Aborted, self.space_id)
+
+    async def claim(self, limit, lease):
+        """
+        Claim QUEUED jobs that no one is running, by priority and then oldest first.
+        The claimed jobs are EXECUTING under a lease of lease seconds, see renew.
+
+        :return: list of the claimed jobs.
+        """
+        results = await self._fetch('claim_jobs',
+                                    "with cte as (select id, space_id from uws_jobs "
+                                    "where space_id=$1 and phase=$2 and worker is null "
+                                    "order by priority, id limit $3 for update skip locked) "
+                                    "update uws_jobs set phase=$4, worker=$5, "
+                                    "lease_expires=now() + make_interval(secs => $6) "
+                                    "from cte where uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
+                                    "returning uws_jobs.*",
+                                    self.space_id, UWSPhase.Queued, limit,
+                                    UWSPhase.Executing, self.worker_id, lease)
+        return [self._resultset_to_job(result) for result in results]
+
+    async def renew(self, lease):
+        """
+        Extend the leases of the jobs claimed by this pool to lease seconds from now.
+        """
+        return await self._fetch('renew_jobs',
+                                 "update uws_jobs set lease_expires=now() + make_interval(secs => $4) "
+                                 "where space_id=$1 and worker=$2 and phase=$3 and lease_expires is not null "
+                                 "returning id",
+                                 self.space_id, self.worker_id, UWSPhase.Executing, lease)
+
+    async def expire(self, limit):
+        """
+        Put the claimed jobs whose lease has run out in ERROR, their worker has gone.
+        A copy or move may have been left half done so it is not run again.
+
+        :return: number of jobs put in ERROR.
+        """
+        results = await self._fetch('expire_jobs',
+                                    "with cte as (select id, space_id from uws_jobs "
+                                    "where space_id=$1 and phase=$2 and lease_expires<now() "
+                                    "limit $3 for update skip locked) "
+                                    "update uws_jobs set phase=$4, error=$5 "
+                                    "from cte where uws_jobs.id=cte.id and uws_jobs.space_id=cte.space_id "
+                                    "returning uws_jobs.id",
+                                    self.space_id, UWSPhase.Executing, limit,
+                                    UWSPhase.Error, 'Job lease expired.')
+        return len(results)
+
+    async def _fetchrow(self, operation, query, *args):
+        async def fetchrow(conn):
+            return await conn.fetchrow(query, *args)
+        return await self.retry.transaction(operation, self.db_pool, fetchrow)
+
+    async def _fetch(self, operation, query, *args):
+        async def fetch(conn):
+            return await conn.fetch(query, *args)
+        return await self.retry.transaction(operation, self.db_pool, fetch)
 
     async def set_aborted(self, job_id, conn):
         return await conn.fetchrow("with cte as (select id, space_id, phase from uws_jobs "
@@ -291,34 +430,17 @@ class StorageUWSJob(UWSJob):
                 if job_result['phase'] != UWSPhase.Executing:
                     raise InvalidJobStateError('Invalid Job State')
 
-                query = f"""with node_cte as 
-                            (select * from nodes where path <@ $1 and space_id=$2 
-                            order by nlevel(path) asc for {'update' if self._exclusive else 'share'} of nodes)
-                            select node_cte.*, nlevel(node_cte.path), 
-                            storage.name as space_name, 
-                            storage.host, storage.port, storage.parameters, 
-                            storage.https, storage.enabled from node_cte 
-                            left join storage on node_cte.storage_id=storage.id 
-                            order by nlevel(node_cte.path) asc"""
-
-                node_results = await self._conn.fetch(query, job_result['node_path'], self._job._storage_pool.space_id)
+                node_db = self._job._storage_pool.node_db
+                node_results = await node_db.lock_tree(job_result['node_path'], self._conn,
+                                                       exclusive=self._exclusive)
                 if not node_results:
                     raise NodeDoesNotExistError("target node does not exist.")
 
-                # The first entry should always be the target path in the job
-                if node_results[0]['path'] != job_result['node_path']:
-                    raise InvalidJobError(f"{node_results[0]['path']} does not match target "
-                                          f"{job_result['node_path']}")
-
-                if node_results[0]['path_modified'] != job_result['node_path_modified']:
+                # The node at the target path has to be the one the job was created for
+                if node_results[0]['id'] != job_result['node_id']:
                     raise NodeDoesNotExistError('target has been modified.')
 
-                node_properties = await self._conn.fetch("select * from properties "
-                                                         "where node_path=any($1::ltree[]) and space_id=$2",
-                                                         [node['path'] for node in node_results],
-                                                         self._job._storage_pool.space_id)
-
-                root_node = NodeDatabase.resultset_to_node_tree(node_results, node_properties)
+                root_node = NodeDatabase.resultset_to_node_tree(node_results, properties=True)
                 self._target = NodeProxy(root_node, self)
 
         async def _rollback(self):
@@ -355,8 +477,8 @@ class StorageUWSJob(UWSJob):
 
 
 class StorageUWSJobPool(UWSJobPool):
-    def __init__(self, space_id, storage, db_pool, dsn, permission):
-        super().__init__(space_id, db_pool, permission)
+    def __init__(self, space_id, storage, db_pool, dsn, permission, scheduler=None):
+        super().__init__(space_id, db_pool, permission, scheduler=scheduler)
         self.storage = storage
         self.listener = None
         self.dsn = dsn
@@ -364,7 +486,7 @@ class StorageUWSJobPool(UWSJobPool):
 
     async def setup(self):
         self.listener = await asyncpg.connect(dsn=self.dsn)
-        await self.listener.add_listener('uws_jobs', self._jobs_callback)
+        await self.listener.add_listener(uws_jobs_channel(self.space_id), self._jobs_callback)
 
     async def close(self):
         await self.listener.close()
@@ -372,14 +494,10 @@ class StorageUWSJobPool(UWSJobPool):
 
     def _jobs_callback(self, connection, pid, channel, payload):
         job = json.loads(payload)
-        # check the job belongs to this space
-        if int(job['row']['space_id']) != self.space_id:
-            return
-        if job['action'] != 'UPDATE':
-            return
-        phase = job['row']['phase']
-        job_id = job['row']['id']
-        if phase == UWSPhase.Aborted:
+        phase = job['phase']
+        job_id = job['id']
+        # a job destroyed while its transfer runs is aborted
+        if job['action'] == 'DELETE' or (job['action'] == 'UPDATE' and phase == UWSPhase.Aborted):
             loop = asyncio.get_event_loop()
             asyncio.run_coroutine_threadsafe(self.executor.abort(job_id), loop)
 
@@ -387,14 +505,21 @@ class StorageUWSJobPool(UWSJobPool):
         job_info = Transfer.fromstring(result['job_info'])
         transfer = Transfer.fromstring(result['transfer'])
         job = StorageUWSJob(self, result['id'], result['phase'], result['destruction'], job_info, transfer)
-        job.node_path_modified = result['node_path_modified']
+        job.node_id = result['node_id']
         job.owner = result['owner']
         return job
 
     async def _execute(self, job, func, *args):
         return await func(job, *args)
 
-    async def execute(self, job_id, identity, func, *args):
+    async def execute(self, job_id, identity, func, *args, wait=0):
+        """
+        Run a protocol transfer job.
+
+        :param wait: seconds to wait for a node locked by another transfer,
+            NodeBusyError is raised at once if 0. A waiting transfer is queued
+            behind the holder by the database and starts as soon as it is released.
+        """
         async with self.db_pool.acquire() as conn:
             async with conn.transaction():
                 job_result = await self._get_uws_job_conn(conn=conn, job_id=job_id, for_update=True)
@@ -409,59 +534,152 @@ class StorageUWSJobPool(UWSJobPool):
                 if not await self.permission.permits(identity, 'runJob', context=job):
                     raise PermissionDenied('runJob denied.')
 
-                try:
-                    query = """with node_cte as 
-                               (select * from nodes where path <@ $1 and space_id=$2 
-                                order by nlevel(path) asc for update of nodes nowait)
-                               select node_cte.*, nlevel(node_cte.path), storage.name as space_name, 
-                               storage.host, storage.port, storage.parameters, 
-                               storage.https, storage.enabled from node_cte 
-                               left join storage on node_cte.storage_id=storage.id 
-                               order by nlevel(node_cte.path) asc"""
-
-                    node_results = await conn.fetch(query, job_result['node_path'], self.space_id)
-
-                except asyncpg.exceptions.LockNotAvailableError:
-                    raise NodeBusyError(f"Path: {NodeDatabase.ltree_to_path(job_result['node_path'])}")
+                if isinstance(job.job_info, PullFromSpace):
+                    # a download only reads the tree, concurrent ones do not wait on each other
+                    node_results = await self.node_db.get_tree(job_result['node_path'], conn)
+                else:
+                    try:
+                        # a lock_timeout of 0 would wait forever
+                        timeout = int(wait * 1000)
+                        if timeout > 0:
+                            await conn.execute(f"set local lock_timeout = {timeout}")
+                        node_results = await self.node_db.lock_tree(job_result['node_path'], conn,
+                                                                    nowait=timeout <= 0)
+
+                    except asyncpg.exceptions.LockNotAvailableError:
+                        raise NodeBusyError(f"Path: {NodeDatabase.ltree_to_path(job_result['node_path'])}")
 
                 await busy_fuzz()
 
                 if not node_results:
                     raise NodeDoesNotExistError("target node does not exist.")
 
-                # The first entry should always be the target path in the job
-                if node_results[0]['path'] != job_result['node_path']:
-                    raise InvalidJobError(f"{node_results[0]['path']} does not match target "
-                                          f"{job_result['node_path']}")
-
-                if node_results[0]['path_modified'] != job_result['node_path_modified']:
+                # The node at the target path has to be the one the job was created for
+                if node_results[0]['id'] != job_result['node_id']:
                     raise NodeDoesNotExistError('target has been modified.')
 
-                node_properties = await conn.fetch("select * from properties "
-                                                   "where node_path=any($1::ltree[]) and space_id=$2",
-                                                   [node['path'] for node in node_results], self.space_id)
-
-                root_node = NodeDatabase.resultset_to_node_tree(node_results, node_properties)
+                root_node = NodeDatabase.resultset_to_node_tree(node_results, properties=True)
                 job.transfer.target = root_node
                 if not await self.permission.permits(identity, 'dataTransfer', context=job):
                     raise PermissionDenied('data transfer denied.')
 
-                fut = self.executor.execute(job, self._execute, func, *args)
+                fut = self.executor.execute(job, self._execute, func, *args,
+                                            priority=job_result['priority'])
 
         return await fut
 
 
+class UWSJobScheduler(object):
+    """
+    Admits jobs to run, at most max_jobs at a time and at most max_user_jobs
+    of an owner. Jobs that can not run yet wait in order of priority, among
+    jobs of a priority the owners take turns so that a burst of jobs of one
+    owner does not hold up the others.
+
+    :param max_jobs: most jobs running.
+    :param max_user_jobs: most jobs of an owner running.
+    """
+    # priorities of jobs, a synchronous transfer has a client waiting on it
+    INTERACTIVE = 0
+    BULK = 1
+
+    def __init__(self, max_jobs=100, max_user_jobs=10):
+        self.max_jobs = max_jobs
+        self.max_user_jobs = max_user_jobs
+        self.running = 0
+        self.running_by_owner = Counter()
+        # priority -> owner -> futures of the waiting jobs, owners in turn order
+        self._waiting = {self.INTERACTIVE: OrderedDict(), self.BULK: OrderedDict()}
+
+    @property
+    def waiting(self):
+        return sum(len(futures) for owners in self._waiting.values() for futures in owners.values())
+
+    def can_run(self, owner):
+        return self.running < self.max_jobs and self.running_by_owner[owner] < self.max_user_jobs
+
+    @asynccontextmanager
+    async def slot(self, owner, priority, queued=None):
+        """
+        Wait for the job of owner to be admitted and hold its place until it ends.
+
+        :param queued: coroutine function awaited when the job has to wait.
+        """
+        if not self.can_run(owner) and queued:
+            await queued()
+        await self._admit(owner, priority)
+        try:
+            yield
+        finally:
+            self._release(owner)
+
+    async def _admit(self, owner, priority):
+        if self.can_run(owner):
+            self._start(owner)
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[priority].setdefault(owner, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # admitted as it was cancelled
+                self._release(owner)
+            else:
+                futures = self._waiting[priority].get(owner)
+                if futures is not None and future in futures:
+                    futures.remove(future)
+                    if not futures:
+                        del self._waiting[priority][owner]
+            raise
+
+    def _start(self, owner):
+        self.running += 1
+        self.running_by_owner[owner] += 1
+
+    def _release(self, owner):
+        self.running -= 1
+        self.running_by_owner[owner] -= 1
+        if not self.running_by_owner[owner]:
+            del self.running_by_owner[owner]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.max_jobs:
+            admitted = self._next()
+            if admitted is None:
+                return
+            future, owner = admitted
+            self._start(owner)
+            future.set_result(None)
+
+    def _next(self):
+        for priority in (self.INTERACTIVE, self.BULK):
+            owners = self._waiting[priority]
+            for owner in list(owners):
+                if self.running_by_owner[owner] >= self.max_user_jobs:
+                    continue
+                futures = owners.pop(owner)
+                future = futures.popleft()
+                if futures:
+                    # to the back of the turn order
+                    owners[owner] = futures
+                return future, owner
+        return None
+
+
 class UWSJobExecutor(object):
-    def __init__(self, space_id):
+    def __init__(self, space_id, scheduler=None):
         self.job_tasks = {}
         self.space_id = space_id
+        self.scheduler = scheduler if scheduler else UWSJobScheduler()
         self._closing = False
 
     @property
     def closing(self):
         return self._closing
 
-    def execute(self, job, func, *args):
+    def execute(self, job, func, *args, priority=UWSJobScheduler.BULK, queued=None):
         if self._closing:
             return ClosingError()
 
@@ -469,11 +687,15 @@ class UWSJobExecutor(object):
         task = self.job_tasks.get(key, None)
         if task:
             raise InvalidJobStateError("Job already running")
-        task = asyncio.ensure_future(func(job, *args))
+        task = asyncio.ensure_future(self._run(job, priority, queued, func, *args))
         self.job_tasks[key] = (task, *args)
         task.add_done_callback(functools.partial(self._done, job))
         return task
 
+    async def _run(self, job, priority, queued, func, *args):
+        async with self.scheduler.slot(job.owner, priority, queued):
+            return await func(job, *args)
+
     def _done(self, job, task):
         with suppress(Exception):
             task.exception()
@@ -501,3 +723,189 @@ class UWSJobExecutor(object):
         if len(self.job_tasks) > 0:
             raise InvalidJobStateError('There are still job tasks')
 
+
+
+class UWSPhaseSubscription(object):
+    """
+    Phase changes of the jobs of an owner, or of some of them, queued for one
+    consumer. The queue is bounded: when a consumer falls behind its events
+    are dropped and replaced by a single reset after which nothing more is queued.
+    A reset means events were lost and the jobs have to be read again.
+
+    :param owner: owner of the jobs.
+    :param job_ids: set of the ids of the jobs, all of them if None.
+    :param maxsize: most events queued.
+    """
+    RESET = ('reset', None)
+
+    def __init__(self, owner, job_ids, maxsize):
+        self.owner = owner
+        self.job_ids = job_ids
+        self.queue = asyncio.Queue(maxsize)
+        self.ended = False
+
+    def matches(self, job):
+        return job['owner'] == self.owner and (self.job_ids is None or job['id'] in self.job_ids)
+
+    def put(self, event):
+        if self.ended:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.reset()
+
+    def reset(self):
+        if self.ended:
+            return
+        self.ended = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(self.RESET)
+
+    async def get(self):
+        """
+        :return: tuple(event, data), RESET is the last.
+        """
+        return await self.queue.get()
+
+
+class UWSPhaseListener(object):
+    """
+    One LISTEN on the uws_jobs channel of the space shared by every request blocked on
+    the phase of a job and every stream of phase changes. A waiting request
+    costs nothing until a notification for its job arrives. While the listener
+    is down nothing waits and every subscription is reset, it reconnects with
+    a backoff of up to max_reconnect_delay seconds.
+
+    :param space_id: space of the jobs.
+    """
+    # Seconds of the first and of the longest wait before reconnecting a lost listener.
+    reconnect_delay = 0.1
+    max_reconnect_delay = 10.0
+
+    def __init__(self, space_id):
+        self.space_id = space_id
+        self.listener = None
+        self.dsn = None
+        # job id -> futures of the requests waiting on it
+        self._waiters = defaultdict(set)
+        self._subscriptions = set()
+        self._queued = set()
+        self._reconnect = None
+        self._closing = False
+
+    async def setup(self, dsn):
+        self.dsn = dsn
+        listener = await asyncpg.connect(dsn=dsn)
+        try:
+            await listener.add_listener(uws_jobs_channel(self.space_id), self._notify_callback)
+        except BaseException:
+            await listener.close()
+            raise
+        listener.add_termination_listener(self._terminated)
+        self.listener = listener
+
+    async def close(self):
+        self._closing = True
+        if self._reconnect:
+            self._reconnect.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._reconnect
+        if self.listener:
+            listener, self.listener = self.listener, None
+            await listener.close()
+        self._wake_all()
+
+    @property
+    def enabled(self):
+        return self.listener is not None and not self.listener.is_closed()
+
+    @contextmanager
+    def watch(self, job_id):
+        """
+        :return: future done on the next change of the job, watch before reading the job so none is missed.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._waiters[job_id].add(future)
+        try:
+            yield future
+        finally:
+            waiters = self._waiters.get(job_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[job_id]
+
+    @contextmanager
+    def subscribe(self, owner, job_ids=None, maxsize=1000):
+        """
+        :return: UWSPhaseSubscription of the phase changes of the jobs of owner, or of job_ids.
+        """
+        subscription = UWSPhaseSubscription(owner, job_ids, maxsize)
+        if not self.enabled:
+            subscription.reset()
+        self._subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            self._subscriptions.discard(subscription)
+
+    @contextmanager
+    def watch_queued(self):
+        """
+        :return: asyncio.Event set whenever a job is QUEUED, and while the listener is down.
+        """
+        event = asyncio.Event()
+        if not self.enabled:
+            event.set()
+        self._queued.add(event)
+        try:
+            yield event
+        finally:
+            self._queued.discard(event)
+
+    def _wake(self, job_id):
+        for future in self._waiters.pop(job_id, ()):
+            if not future.done():
+                future.set_result(None)
+
+    def _wake_all(self):
+        for job_id in list(self._waiters):
+            self._wake(job_id)
+        for subscription in self._subscriptions:
+            subscription.reset()
+        for event in self._queued:
+            event.set()
+
+    def _terminated(self, connection):
+        self.listener = None
+        self._wake_all()
+        if not self._closing and self._reconnect is None:
+            self._reconnect = asyncio.ensure_future(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        delay = self.reconnect_delay
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await self.setup(self.dsn)
+                    break
+                except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                    delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            self._reconnect = None
+        # changes made while nothing listened were missed, everyone reads the jobs again
+        self._wake_all()
+
+    def _notify_callback(self, connection, pid, channel, payload):
+        job = json.loads(payload)
+        self._wake(job['id'])
+        if job['phase'] == UWSPhase.Queued:
+            for event in self._queued:
+                event.set()
+        for subscription in self._subscriptions:
+            if subscription.matches(job):
+                subscription.put(('phase', {'job_id': job['id'], 'action': job['action'],
+                                            'phase': UWSPhaseLookup[job['phase']]}))
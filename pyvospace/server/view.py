@@ -19,11 +19,16 @@
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
 #    MA 02111-1307  USA
 
+import json
+import math
+import uuid
+import asyncio
+
 from contextlib import suppress
 from aiohttp_security import authorized_userid, permits
 
 from pyvospace.core.exception import VOSpaceError, PermissionDenied, InvalidURI, \
-    InvalidJobStateError, InvalidArgument
+    InvalidJobStateError, InvalidArgument, InvalidJobError
 from pyvospace.core.model import UWSPhase, UWSPhaseLookup, Node, DataNode, ContainerNode, \
     Transfer, Protocol, View, PullFromSpace
 
@@ -38,12 +43,16 @@ async def get_properties_request(request):
     properties = request.app['abstract_space'].get_properties()
     if not properties:
         raise InvalidArgument('properties empty')
-    results = await request.app['db'].get_contains_properties()
-    properties.contains = NodeDatabase._resultset_to_properties(results)
+    properties.contains = await request.app['db'].get_contains_properties()
     return properties
 
 
-async def get_node_request(request):
+async def get_node_request(request, chunk_size=65536):
+    """
+    Generator of the serialised node. Everything that can fail is checked before
+    the first chunk is produced. A container listing is read from a cursor and
+    serialised incrementally so that memory use does not grow with its size.
+    """
     identity = await authorized_userid(request)
     if identity is None:
         raise PermissionDenied(f'Credentials not found.')
@@ -61,22 +70,38 @@ async def get_node_request(request):
                 raise Exception()
         except:
             raise InvalidURI(f'limit invalid: {limit}')
+    start = request.query.get('uri', None)
+    if start:
+        start = Node.uri_to_path(start)
+    sort = request.query.get('sort', 'name')
+    order = request.query.get('order', 'asc')
 
-    async with request.app['db_pool'].acquire() as conn:
+    async with request.app['read_pool'].acquire(identity) as conn:
         async with conn.transaction():
-            node = await request.app['db'].directory(node_path.path, conn, identity)
-
-    if detail == 'min':
-        node.remove_properties()
-
-    if isinstance(node, DataNode):
-        if detail == 'max':
-            node.accepts = request.app['abstract_space'].get_accept_views(node)
-            node.provides = request.app['abstract_space'].get_provide_views(node)
-    if isinstance(node, ContainerNode):
-        if limit:
-            node.nodes = node.nodes[:limit]
-    return node
+            node, children = await request.app['db'].directory_cursor(node_path.path, conn, identity,
+                                                                      limit=limit, start=start,
+                                                                      sort=sort, order=order)
+            if detail == 'min':
+                node.remove_properties()
+
+            # a ContainerNode is a DataNode, its views are in the envelope
+            if isinstance(node, DataNode) and detail == 'max':
+                node.accepts = request.app['abstract_space'].get_accept_views(node)
+                node.provides = request.app['abstract_space'].get_provide_views(node)
+
+            if not isinstance(node, ContainerNode):
+                yield node.tostring().encode('utf-8')
+                return
+
+            head, tail = node.tostring_envelope()
+            chunk = bytearray(head)
+            async for row in children:
+                chunk += ContainerNode.tostring_child(NodeDatabase._create_node(row))
+                if len(chunk) >= chunk_size:
+                    yield bytes(chunk)
+                    chunk.clear()
+            chunk += tail
+            yield bytes(chunk)
 
 
 async def delete_node_request(app, request):
@@ -84,11 +109,21 @@ async def delete_node_request(app, request):
     if identity is None:
         raise PermissionDenied(f'Credentials not found.')
     path = request.path.replace('/vospace/nodes', '')
-    async with app['db_pool'].acquire() as conn:
-        async with conn.transaction():
-            node = await request.app['db'].delete(path, conn, identity)
-    with suppress(OSError):
-        await app['abstract_space'].delete_storage_node(node)
+
+    async def delete(conn):
+        if app['trash']:
+            node = await app['db'].detach(path, conn, identity)
+            # before the commit, no reaper can purge the tree until its storage is in the trash
+            with suppress(OSError):
+                await app['abstract_space'].trash_storage_node(node)
+            return node
+        return await app['db'].delete(path, conn, identity)
+
+    node = await app['retry'].transaction('delete_node', app['db_pool'], delete)
+    await app['read_pool'].mark_written(identity)
+    if not app['trash']:
+        with suppress(OSError):
+            await app['abstract_space'].delete_storage_node(node)
 
 
 async def create_node_request(request):
@@ -101,11 +136,13 @@ async def create_node_request(request):
     if node.path != Node.uri_to_path(url_path):
         raise InvalidURI("Paths do not match")
 
-    async with request.app['db_pool'].acquire() as conn:
-        async with conn.transaction():
-            await request.app['db'].create(node, conn, identity)
-            await request.app['abstract_space'].create_storage_node(node)
-            node.accepts = request.app['abstract_space'].get_accept_views(node)
+    async def create(conn):
+        await request.app['db'].create(node, conn, identity)
+        await request.app['abstract_space'].create_storage_node(node)
+        node.accepts = request.app['abstract_space'].get_accept_views(node)
+
+    await request.app['retry'].transaction('create_node', request.app['db_pool'], create)
+    await request.app['read_pool'].mark_written(identity)
     return node
 
 
@@ -119,9 +156,11 @@ async def set_node_properties_request(request):
     if node.path != Node.uri_to_path(path):
         raise InvalidURI("Paths do not match")
 
-    async with request.app['db_pool'].acquire() as conn:
-        async with conn.transaction():
-            node = await request.app['db'].update(node, conn, identity)
+    async def update(conn):
+        return await request.app['db'].update(node, conn, identity)
+
+    node = await request.app['retry'].transaction('set_node_properties', request.app['db_pool'], update)
+    await request.app['read_pool'].mark_written(identity)
     return node
 
 
@@ -134,6 +173,7 @@ async def create_transfer_request(request):
     if not await request.app.permits(identity, 'createTransfer', context=transfer):
         raise PermissionDenied('creating transfer job denied.')
     job = await request.app['executor'].create(transfer, identity, UWSPhase.Pending)
+    await request.app['read_pool'].mark_written(identity)
     return job
 
 
@@ -167,20 +207,114 @@ async def sync_transfer_request(request):
 
     if not await request.app.permits(identity, 'createTransfer', context=transfer):
         raise PermissionDenied('creating transfer job denied.')
-    job = await request.app['executor'].create(transfer, identity, UWSPhase.Executing)
+    job = await request.app['executor'].create(transfer, identity, UWSPhase.Executing, sync=True)
     endpoint = await perform_transfer_job(job, request.app, identity, sync=True, redirect=redirect_endpoint)
+    await request.app['read_pool'].mark_written(identity)
     return job, endpoint
 
 
+# phases a UWS 1.1 blocking request waits in
+ACTIVE_PHASES = (UWSPhase.Pending, UWSPhase.Queued, UWSPhase.Executing)
+
+
+async def wait_job_request(request, job_id, read, phase_of):
+    """
+    UWS 1.1 blocking of a job request. With WAIT set it returns once the phase
+    of the job is no longer active or no longer PHASE, or after WAIT seconds.
+    A WAIT that is negative or above max_job_wait is max_job_wait.
+
+    The job is read from the primary while waiting, a replica may not have
+    replayed the change of phase that was notified, or any change before it.
+
+    :param read: coroutine function reading the job, from the primary with primary=True.
+    :param phase_of: phase of what read returns.
+    :return: what read returns.
+    """
+    wait = request.query.get('WAIT')
+    if wait is None:
+        return await read()
+    try:
+        seconds = float(wait)
+    except ValueError:
+        seconds = math.nan
+    if not math.isfinite(seconds):
+        raise InvalidArgument(f'WAIT invalid: {wait}')
+    wait = seconds
+    max_wait = request.app['max_job_wait']
+    if wait < 0 or wait > max_wait:
+        wait = max_wait
+    phase = request.query.get('PHASE')
+    if phase is not None:
+        phase = phase.upper()
+        if phase not in UWSPhaseLookup.values():
+            raise InvalidArgument(f'PHASE invalid: {phase}')
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        raise InvalidJobError(f"Invalid JobId: {job_id}")
+
+    listener = request.app['phase_listener']
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + wait
+    while True:
+        with listener.watch(job_id) as changed:
+            result = await read(primary=True)
+            current = phase_of(result)
+            timeout = deadline - loop.time()
+            if current not in ACTIVE_PHASES or (phase and phase != UWSPhaseLookup[current]) \
+                    or timeout <= 0 or not listener.enabled:
+                return result
+            try:
+                await asyncio.wait_for(changed, timeout)
+            except asyncio.TimeoutError:
+                return result
+
+
 async def get_job_request(request):
     identity = await authorized_userid(request)
     if identity is None:
         raise PermissionDenied(f'Credentials not found.')
     job_id = request.match_info.get('job_id', None)
-    job = await request.app['executor'].get(job_id)
-    if identity != job.owner:
-        raise PermissionDenied(f'{identity} is not the owner of the job.')
-    return job
+
+    async def read(primary=False):
+        job = await request.app['executor'].get(job_id, identity, primary=primary)
+        if identity != job.owner:
+            raise PermissionDenied(f'{identity} is not the owner of the job.')
+        return job
+
+    return await wait_job_request(request, job_id, read, lambda job: job.phase)
+
+
+async def job_events_request(request, keepalive=15.0):
+    """
+    Generator of the server-sent events of the phase changes of the jobs of
+    the caller, or of the jobs given by JOB parameters. Each is a phase event
+    with a json object of job_id, action and phase. A reset event ends the
+    stream when events were lost, by a slow reader or the database connection.
+    Comments are sent every keepalive seconds while nothing happens.
+    """
+    identity = await authorized_userid(request)
+    if identity is None:
+        raise PermissionDenied(f'Credentials not found.')
+    job_ids = None
+    if 'JOB' in request.query:
+        try:
+            job_ids = {str(uuid.UUID(job_id)) for job_id in request.query.getall('JOB')}
+        except ValueError:
+            raise InvalidJobError(f"Invalid JobId: {request.query.getall('JOB')}")
+
+    with request.app['phase_listener'].subscribe(identity, job_ids,
+                                                 request.app['job_event_queue_size']) as subscription:
+        yield b': subscribed\n\n'
+        while True:
+            try:
+                event, data = await asyncio.wait_for(subscription.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+                continue
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+            if (event, data) == subscription.RESET:
+                return
 
 
 async def get_transfer_details_request(request):
@@ -203,9 +337,14 @@ async def get_job_phase_request(request):
     if identity is None:
         raise PermissionDenied(f'Credentials not found.')
     job_id = request.match_info.get('job_id', None)
-    job = await request.app['executor'].get_uws_job_phase(job_id)
-    if identity != job['owner']:
-        raise PermissionDenied(f'{identity} is not the owner of the job.')
+
+    async def read(primary=False):
+        job = await request.app['executor'].get_uws_job_phase(job_id, identity, primary=primary)
+        if identity != job['owner']:
+            raise PermissionDenied(f'{identity} is not the owner of the job.')
+        return job
+
+    job = await wait_job_request(request, job_id, read, lambda job: job['phase'])
     return UWSPhaseLookup[job['phase']]
 
 
@@ -221,10 +360,12 @@ async def modify_job_request(request):
     phase = uws_cmd.upper()
     if phase == "PHASE=RUN":
         await request.app['executor'].execute(job_id, identity, perform_transfer_job,
-                                              request.app, identity, False, False)
+                                              request.app, identity, False, False,
+                                              queue=request.app['job_queue'])
     elif phase == "PHASE=ABORT":
         await request.app['executor'].abort(job_id, identity)
     else:
         raise VOSpaceError(400, f"Invalid Request. Unknown UWS phase input {uws_cmd}")
 
+    await request.app['read_pool'].mark_written(identity)
     return job_id
@@ -0,0 +1,135 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+
+"""
+Run the copy and move jobs of a space away from its space servers.
+
+A space server with job_queue set leaves the copy and move jobs run with
+PHASE=RUN QUEUED in uws_jobs. Any number of workers claim them with
+FOR UPDATE SKIP LOCKED and renew a lease on them while they run, a job
+whose lease runs out because its worker has gone is put in ERROR.
+"""
+
+import signal
+import asyncio
+
+from contextlib import suppress
+
+from .transfer import perform_transfer_job
+
+
+class UWSJobWorker(object):
+    """
+    Claims and runs the QUEUED jobs of the space of app.
+
+    :param app: SpaceServer that is set up, its database and storage run the jobs.
+    :param max_jobs: most jobs run at a time.
+    :param lease: seconds a claimed job is leased for, renewed every third of it.
+    :param poll_interval: most seconds between looking for jobs, a job being QUEUED wakes the worker sooner.
+    """
+    def __init__(self, app, max_jobs=10, lease=30.0, poll_interval=1.0):
+        self.app = app
+        self.executor = app['executor']
+        self.max_jobs = max_jobs
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.tasks = set()
+        self._closing = False
+        self._wakeup = None
+
+    def stop(self):
+        """
+        Stop claiming jobs, run returns once the running ones have ended.
+        """
+        self._closing = True
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def run(self):
+        renew = asyncio.ensure_future(self._renew())
+        try:
+            with self.app['phase_listener'].watch_queued() as wakeup:
+                self._wakeup = wakeup
+                while not self._closing:
+                    wakeup.clear()
+                    with suppress(Exception):
+                        await self.claim()
+                    with suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            # the leases of the running jobs are renewed until they end
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+        finally:
+            self._wakeup = None
+            renew.cancel()
+            with suppress(asyncio.CancelledError):
+                await renew
+
+    async def claim(self):
+        """
+        Claim as many jobs as there are free slots and start them.
+
+        :return: number of jobs started.
+        """
+        free = self.max_jobs - len(self.tasks)
+        if free <= 0:
+            return 0
+        jobs = await self.executor.claim(free, self.lease)
+        for job in jobs:
+            task = asyncio.ensure_future(perform_transfer_job(job, self.app, job.owner, False))
+            self.tasks.add(task)
+            task.add_done_callback(self._done)
+        return len(jobs)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        with suppress(Exception):
+            task.exception()
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            with suppress(Exception):
+                await self.executor.renew(self.lease)
+                await self.executor.expire(self.max_jobs)
+
+
+def run_worker(space_class, cfg_file):
+    """
+    Run a worker for the space of cfg_file until SIGINT or SIGTERM.
+
+    :param space_class: SpaceServer implementation of the space, the jobs are run with it.
+    """
+    loop = asyncio.get_event_loop()
+    app = loop.run_until_complete(space_class.create(cfg_file))
+    worker = UWSJobWorker(app,
+                          app.config.getint('Worker', 'max_jobs', fallback=10),
+                          app.config.getfloat('Worker', 'lease', fallback=30.0),
+                          app.config.getfloat('Worker', 'poll_interval', fallback=1.0))
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    try:
+        loop.run_until_complete(worker.run())
+    finally:
+        loop.run_until_complete(app.shutdown())
@@ -3,6 +3,7 @@ from setuptools import setup, find_packages
 setup(name='pyvospace',
       version='0.1.0',
       packages=find_packages(),
+      package_data={'pyvospace.server': ['deploy/*.sql', 'deploy/migrations/*.sql']},
       install_requires=['aiohttp',
                         'aiohttp_jinja2',
                         'aiohttp_security',
@@ -23,5 +24,9 @@ setup(name='pyvospace',
           'posix_space = pyvospace.server.spaces.posix.space.__main__:main',
           'posix_storage = pyvospace.server.spaces.posix.storage.__main__:main',
           'ngas_space = pyvospace.server.spaces.ngas.space.__main__:main',
-          'ngas_storage = pyvospace.server.spaces.ngas.storage.__main__:main']
+          'ngas_storage = pyvospace.server.spaces.ngas.storage.__main__:main',
+          'posix_worker = pyvospace.server.spaces.posix.space.__main__:worker',
+          'ngas_worker = pyvospace.server.spaces.ngas.space.__main__:worker',
+          'vospace_reencode_paths = pyvospace.server.reencode:main',
+          'vospace_migrate = pyvospace.server.migrate:main']
       })
@@ -0,0 +1,77 @@
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia, 2018
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+
+"""
+Micro-benchmark of decoding the paths of a 100k row subtree load.
+
+    python -m test.bench_codec
+"""
+
+import base64
+import timeit
+
+from pyvospace.server import codec
+
+
+def legacy_ltree_to_path(ltree_path):
+    path_array = list(filter(None, ltree_path.split('.')))
+    path_array_result = [base64.b16decode(i).decode() for i in path_array]
+    path = '/'.join(path_array_result)
+    return path.replace('%2E', '.')
+
+
+def legacy_path_to_ltree(path):
+    path_array = list(filter(None, path.replace('.', '%2E').split('/')))
+    return '.'.join([base64.b16encode(i.encode()).decode('ascii') for i in path_array])
+
+
+def subtree(containers=100, files=1000):
+    paths = ['archive/observations/2018']
+    for i in range(containers):
+        container = f'archive/observations/2018/scan_{i:04d}'
+        paths.append(container)
+        paths += [f'{container}/visibility.{j:06d}.ms' for j in range(files - 1)]
+    return paths
+
+
+def main():
+    paths = subtree()
+    legacy = [legacy_path_to_ltree(path) for path in paths]
+    compact = [codec.encode_path(path) for path in paths]
+    assert [codec.decode_path(p) for p in compact] == paths
+    assert codec.decode_paths(compact) == paths
+
+    def cold(func, ltree_paths):
+        codec._decode_prefix.cache_clear()
+        return func(ltree_paths)
+
+    runs = [('base16, per row (before)', lambda: [legacy_ltree_to_path(p) for p in legacy]),
+            ('compact, per row, lru', lambda: cold(lambda ps: [codec.decode_path(p) for p in ps], compact)),
+            ('compact, decode_paths', lambda: cold(codec.decode_paths, compact))]
+
+    print(f'{len(paths)} rows')
+    for name, func in runs:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print(f'{name:<28} {best * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
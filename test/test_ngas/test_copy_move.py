@@ -80,6 +80,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
 
             orig_node = ContainerNode('/root1/test2',
                                       properties=properties,
@@ -98,6 +100,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             orig_node = ContainerNode('/root2')
             self.assertEqual(node, orig_node)
 
@@ -120,6 +124,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            self.assertEqual('2', node.remove_property('ivo://icrar.org/vospace/core#treecount').value)
             moved_node = ContainerNode('/root2/test2',
                                        properties=properties,
                                        nodes=[ContainerNode('/root2/test2/test3'),
@@ -137,6 +143,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            self.assertEqual('0', node.remove_property('ivo://icrar.org/vospace/core#treecount').value)
             orig_node = ContainerNode('/root1')
             self.assertEqual(node, orig_node)
 
@@ -302,6 +310,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            self.assertEqual('1', node.remove_property('ivo://icrar.org/vospace/core#treecount').value)
             self.assertEqual(node, copy_node)
 
             # check original node is still there
@@ -315,6 +325,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             self.assertEqual(node, orig_node)
 
         self.loop.run_until_complete(run())
@@ -136,6 +136,8 @@ class TestCreate(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             prop = [Property('ivo://ivoa.net/vospace/core#title', "NewTitle", False)]
             orig_node = ContainerNode('/test1', properties=prop)
             self.assertEqual(node, orig_node)
@@ -240,6 +242,8 @@ class TestCreate(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             cmp_node = ContainerNode('/test1',
                                      properties=properties,
                                      nodes=[Node('/test1/data')])
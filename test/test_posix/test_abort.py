@@ -72,6 +72,9 @@ class TestAbort(TestBase):
             await push_task
             set_fuzz01(False)
 
+            # the upload is shielded, it completes after the client has gone
+            await self.poll_job(os.path.basename(put_end))
+
             node = Node('/syncdatanode')
             pull = PullFromSpace(node, [HTTPGet()])
             transfer = await self.sync_transfer_node(pull)
@@ -19,9 +19,17 @@
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
 #    MA 02111-1307  USA
 
+import json
+import asyncio
+import asyncpg
 import unittest
+import unittest.mock
+
+from contextlib import asynccontextmanager
 
 from pyvospace.core.model import *
+from pyvospace.server.uws import UWSPhaseSubscription, UWSJobScheduler, uws_jobs_channel
+from pyvospace.server.worker import UWSJobWorker
 from test.test_base import TestBase
 
 
@@ -81,6 +89,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
 
             orig_node = ContainerNode('/root1/test2',
                                       properties=properties,
@@ -99,6 +109,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             orig_node = ContainerNode('/root2')
             self.assertEqual(node, orig_node)
 
@@ -121,6 +133,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            self.assertEqual('2', node.remove_property('ivo://icrar.org/vospace/core#treecount').value)
             moved_node = ContainerNode('/root2/test2',
                                        properties=properties,
                                        nodes=[ContainerNode('/root2/test2/test3'),
@@ -138,6 +152,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            self.assertEqual('0', node.remove_property('ivo://icrar.org/vospace/core#treecount').value)
             orig_node = ContainerNode('/root1')
             self.assertEqual(node, orig_node)
 
@@ -187,6 +203,228 @@ class TestCopyMove(TestBase):
             await self.change_job_state(job.job_id, 'PHASE=RUN')
             await self.poll_job(job.job_id, expected_status='COMPLETED')
 
+            # the moved node should be listed under its new parent only
+            node = await self.get_node('data0', params={'detail': 'min'})
+            self.assertEqual(node, ContainerNode('/data0', nodes=[Node('/data0/newnode')]))
+
+            node = await self.get_node('/', params={'detail': 'min'})
+            self.assertNotIn('newnode', [child.name for child in node.nodes])
+
+        self.loop.run_until_complete(run())
+
+    def test_wait_job_phase(self):
+        async def run():
+            await self.create_node(Node('/data0'))
+            job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+            url = f'http://localhost:8080/vospace/transfers/{job.job_id}'
+
+            # not blocked when the phase is not the one given
+            status, response = await self.get(f'{url}/phase', params={'WAIT': 5, 'PHASE': 'EXECUTING'})
+            self.assertEqual((200, 'PENDING'), (status, response))
+            for wait in ('x', 'nan', 'inf'):
+                status, response = await self.get(f'{url}/phase', params={'WAIT': wait})
+                self.assertEqual(400, status, msg=response)
+
+            start = self.loop.time()
+            status, response = await self.get(f'{url}/phase', params={'WAIT': 1})
+            self.assertEqual((200, 'PENDING'), (status, response))
+            self.assertGreaterEqual(self.loop.time() - start, 1)
+
+            # woken by the change of phase
+            waiting = asyncio.ensure_future(self.get(url, params={'WAIT': 10, 'PHASE': 'PENDING'}))
+            await asyncio.sleep(0.2)
+            self.assertFalse(waiting.done())
+            await self.change_job_state(job.job_id, 'PHASE=RUN')
+            status, response = await asyncio.wait_for(waiting, 5)
+            self.assertEqual(200, status, msg=response)
+            self.assertNotEqual(UWSPhase.Pending, UWSJob.fromstring(response).phase)
+            await self.poll_job(job.job_id, expected_status='COMPLETED')
+
+        self.loop.run_until_complete(run())
+
+    def test_wait_job_phase_stale_replica(self):
+        async def run():
+            await self.create_node(Node('/data0'))
+            job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+            url = f'http://localhost:8080/vospace/transfers/{job.job_id}/phase'
+            executor = self.app['executor']
+
+            class StaleReadPool(object):
+                # a replica that has not replayed anything since the job was PENDING
+                def __init__(self, conn):
+                    self.conn = conn
+
+                @asynccontextmanager
+                async def acquire(self, identity=None):
+                    yield self.conn
+
+            async with self.app['db_pool'].acquire() as conn:
+                async with conn.transaction(isolation='repeatable_read'):
+                    await conn.fetchval("select phase from uws_jobs where id=$1", job.job_id)
+                    await self.change_job_state(job.job_id, 'PHASE=RUN')
+                    await self.poll_job(job.job_id, expected_status='COMPLETED')
+
+                    with unittest.mock.patch.object(executor, 'read_pool', StaleReadPool(conn)):
+                        status, response = await self.get(url)
+                        self.assertEqual((200, 'PENDING'), (status, response))
+
+                        # a blocking request does not wait on the phase the replica has
+                        start = self.loop.time()
+                        status, response = await self.get(url, params={'WAIT': 5})
+                        self.assertEqual((200, 'COMPLETED'), (status, response))
+                        self.assertLess(self.loop.time() - start, 5)
+
+        self.loop.run_until_complete(run())
+
+    def test_phase_listener_reconnect(self):
+        async def run():
+            await self.create_node(Node('/data0'))
+            job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+            url = f'http://localhost:8080/vospace/transfers/{job.job_id}'
+            listener = self.app['phase_listener']
+
+            async with self.app['db_pool'].acquire() as conn:
+                await conn.execute("select pg_terminate_backend($1)", listener.listener.get_server_pid())
+            for _ in range(50):
+                if listener.enabled:
+                    break
+                await asyncio.sleep(0.1)
+            self.assertTrue(listener.enabled)
+
+            # woken by the change of phase once listening again
+            waiting = asyncio.ensure_future(self.get(url, params={'WAIT': 10, 'PHASE': 'PENDING'}))
+            await asyncio.sleep(0.2)
+            self.assertFalse(waiting.done())
+            await self.change_job_state(job.job_id, 'PHASE=RUN')
+            status, response = await asyncio.wait_for(waiting, 5)
+            self.assertEqual(200, status, msg=response)
+            await self.poll_job(job.job_id, expected_status='COMPLETED')
+
+        self.loop.run_until_complete(run())
+
+    def test_job_events(self):
+        async def run():
+            async def next_event(resp):
+                event = {}
+                while True:
+                    line = (await resp.content.readline()).decode().rstrip('\n')
+                    if not line and 'event' in event:
+                        return event['event'], json.loads(event['data'])
+                    if line and not line.startswith(':'):
+                        name, _, value = line.partition(': ')
+                        event[name] = value
+
+            await self.create_node(Node('/data0'))
+            async with self.session.get('http://localhost:8080/vospace/transfers/events') as resp:
+                self.assertEqual(200, resp.status)
+                self.assertEqual(': subscribed\n', (await resp.content.readline()).decode())
+
+                job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+                await self.change_job_state(job.job_id, 'PHASE=RUN')
+                phases = []
+                while not phases or phases[-1] not in ('COMPLETED', 'ERROR'):
+                    event, data = await asyncio.wait_for(next_event(resp), 5)
+                    self.assertEqual('phase', event)
+                    self.assertEqual(str(job.job_id), data['job_id'])
+                    phases.append(data['phase'])
+                self.assertEqual(['PENDING', 'EXECUTING', 'COMPLETED'], phases)
+
+            status, _ = await self.get('http://localhost:8080/vospace/transfers/events', params={'JOB': 'x'})
+            self.assertEqual(400, status)
+
+            # a reader that falls behind loses its events for a reset
+            subscription = UWSPhaseSubscription('test', None, 2)
+            for phase in ('PENDING', 'EXECUTING', 'COMPLETED'):
+                subscription.put(('phase', {'phase': phase}))
+            subscription.put(('phase', {'phase': 'ERROR'}))
+            self.assertEqual(subscription.RESET, await subscription.get())
+            self.assertTrue(subscription.queue.empty())
+
+        self.loop.run_until_complete(run())
+
+    def test_job_notify(self):
+        async def run():
+            payloads = asyncio.Queue()
+            conn = await asyncpg.connect(dsn=self.app.config['Space']['dsn'])
+            try:
+                await conn.add_listener(uws_jobs_channel(self.app['space_id']),
+                                        lambda *args: payloads.put_nowait(args[3]))
+                await self.create_node(Node('/data0'))
+                job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+                payload = json.loads(await asyncio.wait_for(payloads.get(), 5))
+                self.assertEqual({'action': 'INSERT', 'id': str(job.job_id), 'space_id': self.app['space_id'],
+                                  'phase': UWSPhase.Pending, 'owner': 'test'}, payload)
+            finally:
+                await conn.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_job_scheduler(self):
+        async def run():
+            await self.create_node(Node('/data0'))
+            job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+            scheduler = self.app['executor'].executor.scheduler
+            scheduler.max_jobs = 1
+            try:
+                # QUEUED until the job of another owner ends
+                async with scheduler.slot('other', UWSJobScheduler.BULK):
+                    running = asyncio.ensure_future(self.change_job_state(job.job_id, 'PHASE=RUN'))
+                    await self.poll_job(job.job_id, poll_until=('QUEUED',), expected_status='QUEUED')
+                    self.assertEqual(1, scheduler.waiting)
+                await asyncio.wait_for(running, 5)
+                await self.poll_job(job.job_id, expected_status='COMPLETED')
+            finally:
+                scheduler.max_jobs = 100
+
+            # interactive jobs go first, then owners take turns
+            scheduler = UWSJobScheduler(max_jobs=1, max_user_jobs=1)
+            order = []
+
+            async def run_job(owner, priority):
+                async with scheduler.slot(owner, priority):
+                    order.append(owner)
+                    await asyncio.sleep(0)
+
+            async with scheduler.slot('a', UWSJobScheduler.BULK):
+                jobs = [asyncio.ensure_future(run_job(owner, priority)) for owner, priority in
+                        [('a', UWSJobScheduler.BULK), ('a', UWSJobScheduler.BULK),
+                         ('b', UWSJobScheduler.BULK), ('c', UWSJobScheduler.INTERACTIVE)]]
+                await asyncio.sleep(0.1)
+                self.assertEqual(4, scheduler.waiting)
+            await asyncio.gather(*jobs)
+            self.assertEqual(['c', 'a', 'b', 'a'], order)
+            self.assertEqual(0, scheduler.running)
+
+        self.loop.run_until_complete(run())
+
+    def test_job_worker(self):
+        async def run():
+            await self.create_node(Node('/data0'))
+            job = await self.transfer_node(Move(Node('/data0'), Node('/newnode')))
+            self.app['job_queue'] = True
+            try:
+                await self.change_job_state(job.job_id, 'PHASE=RUN')
+            finally:
+                self.app['job_queue'] = False
+            await self.poll_job(job.job_id, poll_until=('QUEUED',), expected_status='QUEUED')
+
+            worker = UWSJobWorker(self.app, lease=0.3, poll_interval=0.1)
+            running = asyncio.ensure_future(worker.run())
+            try:
+                await asyncio.wait_for(self.poll_job(job.job_id), 5)
+            finally:
+                worker.stop()
+                await asyncio.wait_for(running, 5)
+            await self.get_node('newnode', {'detail': 'min'}, 200)
+
+            # the lease of a job whose worker has gone runs out
+            job = await self.transfer_node(Move(Node('/newnode'), Node('/data0')))
+            async with self.app['db_pool'].acquire() as conn:
+                await conn.execute("update uws_jobs set phase=$1, worker='gone', lease_expires=now() "
+                                   "where id=$2", UWSPhase.Executing, job.job_id)
+            self.assertEqual(1, await self.app['executor'].expire(10))
+            await self.get_error_summary(job.job_id, 'Job lease expired.')
+
         self.loop.run_until_complete(run())
 
     def test_invalid_copy_move(self):
@@ -303,6 +541,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            self.assertEqual('1', node.remove_property('ivo://icrar.org/vospace/core#treecount').value)
             self.assertEqual(node, copy_node)
 
             # check original node is still there
@@ -316,6 +556,8 @@ class TestCopyMove(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             self.assertEqual(node, orig_node)
 
         self.loop.run_until_complete(run())
@@ -19,13 +19,20 @@
 #    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
 #    MA 02111-1307  USA
 
+import time
+import asyncio
+import asyncpg
 import unittest
+import unittest.mock
 import xml.etree.ElementTree as ET
 
+from contextlib import suppress
 from xml.etree.ElementTree import tostring
 
 from test.test_base import TestBase
 from pyvospace.core.model import *
+from pyvospace.server.replica import Replica
+from pyvospace.server.database import NodeDatabase, TRASH_PARENT_ID
 
 
 class TestCreate(TestBase):
@@ -82,6 +89,241 @@ class TestCreate(TestBase):
                 node = Node(f'/test1/{i}')
                 await self.create_node(node)
 
+            # listing is streamed from a cursor, make it span several fetches
+            self.app['db'].cursor_prefetch = 7
+            node = await self.get_node('test1', params={'detail': 'min'})
+            cmp_node = ContainerNode('/test1',
+                                     nodes=sorted([Node(f'/test1/{i}') for i in range(100)] +
+                                                  [Node('/test1/zzz'), ContainerNode('/test1/test2')],
+                                                  key=lambda n: n.name.encode()))
+            self.assertEqual(node, cmp_node)
+
+        self.loop.run_until_complete(run())
+
+    def test_tree_deltas(self):
+        async def run():
+            async def totals(path):
+                node = await self.get_node(path, params={'detail': 'properties'})
+                return (node.properties['ivo://icrar.org/vospace/core#treecount'].value,
+                        node.properties['ivo://icrar.org/vospace/core#treesize'].value)
+
+            await self.create_node(ContainerNode('test1'))
+            await self.create_node(ContainerNode('/test1/test2'))
+            async with self.app['db_pool'].acquire() as conn:
+                async with conn.transaction():
+                    await self.app['db'].create(DataNode('/test1/test2/data1'), conn, 'test')
+                    # a sibling is created while the first create holds its transaction open
+                    await asyncio.wait_for(self.create_node(DataNode('/test1/test2/data2')), 5)
+
+            # the totals read include the changes that are not yet folded
+            self.assertEqual(('3', '0'), await totals('test1'))
+            while await self.app.fold_tree_totals():
+                pass
+            async with self.app['db_pool'].acquire() as conn:
+                self.assertEqual(0, await conn.fetchval("select count(*) from tree_deltas"))
+                self.assertEqual(3, await conn.fetchval("select tree_count from nodes where name='test1'"))
+
+            status, _ = await self.delete_node(ContainerNode('/test1/test2/data1'))
+            self.assertEqual(204, status)
+            self.assertEqual(('1', '0'), await totals('test1/test2'))
+            status, _ = await self.delete_node(ContainerNode('/test1/test2'))
+            self.assertEqual(204, status)
+            self.assertEqual(('0', '0'), await totals('test1'))
+
+        self.loop.run_until_complete(run())
+
+    def test_delete_trash(self):
+        async def run():
+            node = ContainerNode('test1')
+            await self.create_node(node)
+            await self.create_node(ContainerNode('/test1/test2'))
+            await self.create_node(DataNode('/test1/test2/data',
+                                            properties=[Property('ivo://ivoa.net/vospace/core#title',
+                                                                 'data', True)]))
+            await self.create_node(Node('/test1/zzz'))
+
+            self.app['trash'] = True
+            self.app['trash_batch_size'] = 2
+            try:
+                status, _ = await self.delete_node(node)
+                self.assertEqual(204, status)
+                await self.get_node('test1', params={'detail': 'min'}, expected_status=404)
+                await self.get_node('test1/test2/data', params={'detail': 'min'}, expected_status=404)
+
+                root = await self.get_node('', params={'detail': 'min'})
+                self.assertNotIn('test1', [n.name for n in root.nodes])
+
+                # the path can be reused before the trash is reaped
+                await self.create_node(ContainerNode('test1'))
+                await self.create_node(ContainerNode('/test1/test2'))
+
+                # the storage is in the trash once the delete returns, each batch purges its leaves
+                trash, = os.listdir(f'{self.app.staging_dir}/trash')
+                trash = f'{self.app.staging_dir}/trash/{trash}'
+                self.assertEqual(2, await self.app.reap_trash())
+                self.assertEqual(['test2'], os.listdir(trash))
+                self.assertEqual([], os.listdir(f'{trash}/test2'))
+            finally:
+                self.app['trash'] = False
+                while await self.app.reap_trash():
+                    pass
+
+            async with self.app['db_pool'].acquire() as conn:
+                self.assertEqual(0, await conn.fetchval("select count(*) from nodes where parent_id=$1",
+                                                      TRASH_PARENT_ID))
+                self.assertEqual(0, await conn.fetchval("select count(*) from trash"))
+            self.assertEqual([], os.listdir(f'{self.app.staging_dir}/trash'))
+
+            node = await self.get_node('test1', params={'detail': 'min'})
+            self.assertEqual(node, ContainerNode('/test1', nodes=[ContainerNode('/test1/test2')]))
+
+        self.loop.run_until_complete(run())
+
+    def test_node_names(self):
+        async def run():
+            node = ContainerNode('test1')
+            await self.create_node(node)
+
+            # names that need escaping or look like the legacy hex encoding
+            names = ['CAFE', '12', 'a.b', 'x_y', 'file (1).fits', '日本語ファイル名']
+            for name in names:
+                await self.create_node(Node(f'/test1/{name}'))
+
+            node = await self.get_node('test1', params={'detail': 'min'})
+            cmp_node = ContainerNode('/test1',
+                                     nodes=sorted([Node(f'/test1/{name}') for name in names],
+                                                  key=lambda n: n.name.encode()))
+            self.assertEqual(node, cmp_node)
+
+            for name in names:
+                node = await self.get_node(f'test1/{name}', params={'detail': 'min'})
+                self.assertEqual(node.name, name)
+
+        self.loop.run_until_complete(run())
+
+    def test_read_replica(self):
+        async def run():
+            read_pool = self.app['read_pool']
+            replica_pool = await asyncpg.create_pool(dsn=self.app.config['Space']['dsn'],
+                                                     server_settings={'application_name': 'replica'})
+            read_pool.replicas = [Replica(replica_pool)]
+            try:
+                async def application_name(identity):
+                    async with read_pool.acquire(identity) as conn:
+                        return await conn.fetchval("show application_name")
+
+                # the replica dsn points at the primary so it never lags
+                await self.create_node(ContainerNode('test1'))
+                node = await self.get_node('test1', params={'detail': 'min'})
+                self.assertEqual(node, ContainerNode('/test1'))
+                self.assertEqual('replica', await application_name('test'))
+
+                # a replica that has not replayed a write of the session is not read from
+                replica = read_pool.replicas[0]
+
+                async def check(conn):
+                    replica.checked = time.monotonic()
+                replica.check = check
+                replica.standby = True
+                replica.replay_lsn = 0
+                await read_pool.mark_written('test')
+                self.assertNotEqual('replica', await application_name('test'))
+                self.assertEqual('replica', await application_name('other'))
+
+                # nor one lagging too far behind
+                replica.lag = read_pool.max_lag + 1
+                self.assertNotEqual('replica', await application_name('other'))
+            finally:
+                read_pool.replicas = []
+                await replica_pool.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_container_views(self):
+        async def run():
+            await self.create_node(ContainerNode('test1'))
+            view = View('ivo://ivoa.net/vospace/core#anyview')
+            with unittest.mock.patch.object(self.app, 'get_accept_views', return_value=[view]), \
+                    unittest.mock.patch.object(self.app, 'get_provide_views', return_value=[view]):
+                node = await self.get_node('test1', params={'detail': 'max'})
+                self.assertEqual([view], node.accepts)
+                self.assertEqual([view], node.provides)
+                node = await self.get_node('test1', params={'detail': 'min'})
+                self.assertEqual([], node.accepts)
+
+        self.loop.run_until_complete(run())
+
+    def test_node_cache(self):
+        async def run():
+            async def logged_stats():
+                # the counters as an operator sees them, in the log of the reporter
+                with self.assertLogs('pyvospace.server.space', 'INFO') as logs:
+                    reporter = asyncio.ensure_future(self.app._node_cache_reporter(0.01))
+                    try:
+                        while not logs.output:
+                            await asyncio.sleep(0.01)
+                    finally:
+                        reporter.cancel()
+                        with suppress(asyncio.CancelledError):
+                            await reporter
+                message = logs.records[0].getMessage()
+                self.assertTrue(message.startswith('node cache: '), msg=message)
+                return dict(field.split('=') for field in message[len('node cache: '):].split())
+
+            cache = self.app['node_cache']
+            title = 'ivo://ivoa.net/vospace/core#title'
+            await self.create_node(ContainerNode('test1', properties=[Property(title, 'Hello1')]))
+            await self.get_node('test1', params={'detail': 'max'})
+            stats = await logged_stats()
+            await self.get_node('test1', params={'detail': 'max'})
+            after = await logged_stats()
+            self.assertEqual(int(stats['hits']) + 1, int(after['hits']))
+            self.assertEqual(str(cache.maxsize), after['maxsize'])
+            self.assertLess(0.0, float(after['hit_ratio']))
+
+            # a write through this server is seen straight away
+            await self.set_node_properties(ContainerNode('test1', properties=[Property(title, 'Hello2')]))
+            node = await self.get_node('test1', params={'detail': 'max'})
+            self.assertEqual('Hello2', node.properties[title].value)
+
+            # a write made elsewhere is seen once its notification arrives
+            async with self.app['db_pool'].acquire() as conn:
+                await conn.execute("update nodes set properties=jsonb_set(properties, "
+                                   "'{ivo://ivoa.net/vospace/core#title,value}', '\"Hello3\"') "
+                                   "where name='test1'")
+            for _ in range(50):
+                if cache.get(NodeDatabase.path_to_ltree('test1')) is None:
+                    break
+                await asyncio.sleep(0.1)
+            node = await self.get_node('test1', params={'detail': 'max'})
+            self.assertEqual('Hello3', node.properties[title].value)
+
+        self.loop.run_until_complete(run())
+
+    def test_transaction_retry(self):
+        async def run():
+            retry = self.app['retry']
+            attempts = []
+
+            async def deadlock(conn):
+                attempts.append(await conn.fetchval("select txid_current()"))
+                if len(attempts) == 1:
+                    await conn.execute("do $$ begin raise exception using errcode = 'deadlock_detected'; end $$")
+                return len(attempts)
+
+            # run again in a new transaction
+            self.assertEqual(2, await retry.transaction('test', self.app['db_pool'], deadlock))
+            self.assertNotEqual(attempts[0], attempts[1])
+            self.assertEqual(1, retry.stats()['retries']['test'])
+
+            # nothing is retried once the budget is spent
+            retry.tokens = 0
+            attempts.clear()
+            with self.assertRaises(asyncpg.exceptions.DeadlockDetectedError):
+                await retry.transaction('test', self.app['db_pool'], deadlock)
+            self.assertEqual(1, len(attempts))
+            self.assertEqual(1, retry.stats()['failures']['test'])
+
         self.loop.run_until_complete(run())
 
     def test_get_protocol(self):
@@ -107,9 +349,24 @@ class TestCreate(TestBase):
 
             status, response = await self.get('http://localhost:8080/vospace/properties', params=None)
             self.assertEqual(200, status, msg=response)
+            self.assertEqual(['ivo://ivoa.net/vospace/core#description', 'ivo://ivoa.net/vospace/core#title'],
+                             self.contains_uris(response))
+
+            # still referenced by another node
+            await self.create_node(ContainerNode('/test2', properties=properties[:1]))
+            await self.delete_node(node1)
+            status, response = await self.get('http://localhost:8080/vospace/properties', params=None)
+            self.assertEqual(200, status, msg=response)
+            self.assertEqual(['ivo://ivoa.net/vospace/core#title'], self.contains_uris(response))
 
         self.loop.run_until_complete(run())
 
+    def contains_uris(self, response):
+        root = ET.fromstring(response)
+        return [prop.attrib['uri'] for prop in
+                root.findall('{http://www.ivoa.net/xml/VOSpace/v2.1}contains/'
+                             '{http://www.ivoa.net/xml/VOSpace/v2.1}property')]
+
     def test_set_properties(self):
         async def run():
             properties = [Property('ivo://ivoa.net/vospace/core#title', "Hello1", False),
@@ -135,6 +392,8 @@ class TestCreate(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             prop = [Property('ivo://ivoa.net/vospace/core#title', "NewTitle", False)]
             orig_node = ContainerNode('/test1', properties=prop)
             self.assertEqual(node, orig_node)
@@ -239,6 +498,8 @@ class TestCreate(TestBase):
             node.remove_property('ivo://ivoa.net/vospace/core#ctime')
             node.remove_property('ivo://ivoa.net/vospace/core#mtime')
             node.remove_property('ivo://icrar.org/vospace/core#statfs')
+            node.remove_property('ivo://icrar.org/vospace/core#treesize')
+            node.remove_property('ivo://icrar.org/vospace/core#treecount')
             cmp_node = ContainerNode('/test1',
                                      properties=properties,
                                      nodes=[Node('/test1/data')])
@@ -261,6 +522,36 @@ class TestCreate(TestBase):
 
             self.assertEqual(node, cmp_node)
 
+            # resume the listing from a child uri
+            params = {'detail': 'min', 'limit': 1, 'uri': 'vos://icrar.org!vospace/test1/test2'}
+            node = await self.get_node('test1', params)
+            cmp_node = ContainerNode('test1',
+                                     nodes=[ContainerNode('/test1/test2')])
+            self.assertEqual(node, cmp_node)
+
+            params = {'detail': 'min', 'order': 'desc'}
+            node = await self.get_node('test1', params)
+            cmp_node = ContainerNode('test1',
+                                     nodes=[ContainerNode('/test1/test2'),
+                                            Node('/test1/data')])
+            self.assertEqual(node, cmp_node)
+
+            params = {'detail': 'min', 'sort': 'size', 'order': 'desc'}
+            node = await self.get_node('test1', params)
+            self.assertEqual(len(node.nodes), 2)
+
+            params = {'uri': 'vos://icrar.org!vospace/test1/test10'}
+            await self.get_node('test1', params, expected_status=404)
+
+            params = {'uri': 'vos://icrar.org!vospace/data'}
+            await self.get_node('test1', params, expected_status=400)
+
+            params = {'sort': 'invalid'}
+            await self.get_node('test1', params, expected_status=400)
+
+            params = {'order': 'invalid'}
+            await self.get_node('test1', params, expected_status=400)
+
         self.loop.run_until_complete(run())
 
 if __name__ == '__main__':
@@ -20,9 +20,13 @@
 #    MA 02111-1307  USA
 
 import unittest
+import unittest.mock
 import asyncio
 
+import asyncpg
+
 from aiohttp import web
+from contextlib import suppress
 
 from pyvospace.core.model import *
 from pyvospace.server import set_fuzz, set_busy_fuzz
@@ -87,6 +91,28 @@ class TestPushPull(TestBase):
             put_end = transfer.protocols[0].endpoint.url
             await self.push_to_space(put_end, '/tmp/mytar.tar.gz', expected_status=200)
 
+            # push again through the COPY path, existing nodes are merged
+            self.posix_runner.app.executor.node_db.bulk_threshold = 1
+            transfer = await self.sync_transfer_node(container_push)
+            put_end = transfer.protocols[0].endpoint.url
+            await self.push_to_space(put_end, '/tmp/mytar.tar.gz', expected_status=200)
+
+            # and into a fresh container
+            await self.create_node(ContainerNode('/root/bulk'))
+            bulk_push = PushToSpace(ContainerNode('/root/bulk'), [HTTPPut(security_method=security_method)],
+                                    view=View('ivo://ivoa.net/vospace/core#tar'),
+                                    params=[Parameter("ivo://ivoa.net/vospace/core#length", 1234)])
+            transfer = await self.sync_transfer_node(bulk_push)
+            put_end = transfer.protocols[0].endpoint.url
+            await self.push_to_space(put_end, '/tmp/mytar.tar.gz', expected_status=200)
+
+            for path in ['root/tmp/tar/dir1', 'root/bulk/tmp/tar/dir1']:
+                node = await self.get_node(path, params={'detail': 'min'})
+                cmp_node = ContainerNode(f'/{path}',
+                                         nodes=[ContainerNode(f'/{path}/dir2'),
+                                                StructuredDataNode(f'/{path}/test1')])
+                self.assertEqual(node, cmp_node)
+
             pull = PullFromSpace(root_node, [HTTPGet()], view=View('ivo://ivoa.net/vospace/core#tar'))
             transfer = await self.sync_transfer_node(pull)
             pull_end = transfer.protocols[0].endpoint.url
@@ -148,6 +174,12 @@ class TestPushPull(TestBase):
             put_end = transfer.protocols[0].endpoint.url
             await self.push_to_space(put_end, '/tmp/datafile.dat', expected_status=200)
 
+            # container totals follow the upload
+            container = await self.get_node('syncdatanode', {'detail': 'properties'})
+            self.assertEqual(str(os.path.getsize('/tmp/datafile.dat')),
+                             container.properties['ivo://icrar.org/vospace/core#treesize'].value)
+            self.assertEqual('1', container.properties['ivo://icrar.org/vospace/core#treecount'].value)
+
             # retrieve leaf data
             push = PullFromSpace(node, [HTTPGet()])
             transfer = await self.sync_transfer_node(push)
@@ -169,6 +201,43 @@ class TestPushPull(TestBase):
 
         self.loop.run_until_complete(run())
 
+    def test_pull_from_space_unlocked(self):
+        async def run():
+            node = Node('/syncdatanode1.fits')
+            push = PushToSpace(node, [HTTPPut()])
+            transfer = await self.sync_transfer_node_parameterised(push)
+            await self.push_to_space(transfer.protocols[0].endpoint.url, '/tmp/datafile.dat', expected_status=200)
+
+            # a download neither waits for nor is refused by a writer holding the node
+            async with self.app['db_pool'].acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("select 1 from nodes where space_id=$1 and name=$2 for no key update",
+                                       self.app['space_id'], 'syncdatanode1.fits')
+                    pull = PullFromSpace(node, [HTTPGet()])
+                    transfer = await asyncio.wait_for(self.sync_transfer_node(pull), 5)
+                    await asyncio.wait_for(self.pull_from_space(transfer.protocols[0].endpoint.url,
+                                                                '/tmp/download/'), 5)
+
+        self.loop.run_until_complete(run())
+
+    def test_tree_lock_siblings(self):
+        async def run():
+            await self.create_node(ContainerNode('/root'))
+            await self.create_node(ContainerNode('/root/read'))
+
+            # a download of a subtree only holds locks on its path, its siblings stay writable
+            async with self.app['db_pool'].acquire() as conn:
+                async with conn.transaction():
+                    await self.app['db'].lock_tree('root.read', conn, exclusive=False)
+                    await asyncio.wait_for(self.create_node(ContainerNode('/root/write')), 5)
+
+                    inside = asyncio.ensure_future(self.create_node(ContainerNode('/root/read/write')))
+                    await asyncio.sleep(0.5)
+                    self.assertFalse(inside.done())
+            await asyncio.wait_for(inside, 5)
+
+        self.loop.run_until_complete(run())
+
     def test_push_to_space_async(self):
         async def run():
             node1 = ContainerNode('/datanode')
@@ -320,6 +389,88 @@ class TestPushPull(TestBase):
 
         self.loop.run_until_complete(run())
 
+    def test_push_to_space_wait(self):
+        async def run():
+            push = PushToSpace(Node('/syncdatanode1.fits'), [HTTPPut()])
+            transfer = await self.sync_transfer_node(push)
+            end = transfer.protocols[0].endpoint.url
+
+            async with self.app['db_pool'].acquire() as conn:
+                async with conn.transaction():
+                    db = self.app['db']
+                    await db.lock_tree(db.path_to_ltree('/syncdatanode1.fits'), conn)
+                    # refused once the wait runs out, the job can still be run
+                    await self.push_to_space(f'{end}?wait=0.2', '/tmp/datafile.dat', expected_status=400)
+                    for wait in ('x', 'nan', 'inf'):
+                        await self.push_to_space(f'{end}?wait={wait}', '/tmp/datafile.dat', expected_status=400)
+
+                    waiting = asyncio.ensure_future(self.push_to_space_defer_error(f'{end}?wait=5',
+                                                                                   '/tmp/datafile.dat'))
+                    await asyncio.sleep(0.5)
+                    self.assertFalse(waiting.done())
+            status, response = await asyncio.wait_for(waiting, 5)
+            self.assertEqual(200, status, msg=response)
+
+        self.loop.run_until_complete(run())
+
+    def test_reap_jobs(self):
+        async def run():
+            executor = self.app['executor']
+            executor.sync_destruction = 0
+            try:
+                push = PushToSpace(Node('/syncdatanode1.fits'), [HTTPPut()])
+                transfer = await self.sync_transfer_node(push)
+                job = await self.transfer_node(PushToSpace(Node('/datanode'), [HTTPPut()]))
+            finally:
+                executor.sync_destruction = 3000
+
+            # only the synchronous job has expired
+            while await self.app.reap_jobs():
+                pass
+            put_end = transfer.protocols[0].endpoint.url
+            await self.push_to_space(put_end, '/tmp/datafile.dat', expected_status=404)
+            status, response = await self.get(f'http://localhost:8080/vospace/transfers/{job.job_id}/phase')
+            self.assertEqual(200, status, msg=response)
+            self.assertEqual('PENDING', response)
+
+        self.loop.run_until_complete(run())
+
+    def test_job_reaper(self):
+        async def run():
+            executor = self.app['executor']
+            batch = self.app['job_batch_size']
+            calls = []
+            caught_up = asyncio.Event()
+            results = iter([batch, batch, 0])
+
+            async def maintain_partitions():
+                calls.append('maintain')
+                raise asyncpg.LockNotAvailableError('lock timeout')
+
+            async def reap(limit):
+                calls.append('reap')
+                deleted = next(results)
+                if deleted < limit:
+                    caught_up.set()
+                return deleted
+
+            with unittest.mock.patch.object(executor, 'maintain_partitions', new=maintain_partitions), \
+                    unittest.mock.patch.object(executor, 'reap', new=reap), \
+                    self.assertLogs('pyvospace.server.space', 'ERROR') as logs:
+                reaper = asyncio.ensure_future(self.app._job_reaper())
+                try:
+                    await asyncio.wait_for(caught_up.wait(), 5)
+                finally:
+                    reaper.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await reaper
+
+            # partitions are maintained once a run, a failure is logged and the batches still run
+            self.assertEqual(['maintain', 'reap', 'reap', 'reap'], calls)
+            self.assertIn('job partition maintenance failed', logs.output[0])
+
+        self.loop.run_until_complete(run())
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file